@@ -0,0 +1,263 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Close approach (conjunction) screening of many TLEs over a time window, used
+# by nasa_tle. Comparing every pair at every time is O(n^2) per step, so it
+# is done in three passes:
+#
+#   1. orbital shells, two satellites can only meet when the perigee to
+#      apogee range of one overlaps the other's. A satellite whose shell
+#      overlaps no other one is dropped before anything is propagated, and a
+#      pair whose shells do not overlap is never compared.
+#   2. spatial hashing, at every step of the window the positions are binned
+#      into cubes as wide as the threshold plus the distance two satellites
+#      can close in half a step, so only satellites in neighbouring cubes are
+#      compared. The closest approach of each of those pairs within the step
+#      is estimated from their relative velocity.
+#   3. refinement, every pair that came close enough is propagated again
+#      around that moment, and the time of closest approach is found with a
+#      golden section search.
+#
+# Two orbits cross twice a revolution, so a pair can meet every half orbit.
+# A step much coarser than that merges encounters or misses them (the
+# refinement only searches a step either side), so the window is screened at
+# most STEP_FRACTION of the shortest orbital period apart, whatever the times
+# asked for.
+#
+# The steps of the window are split into slices screened by a pool of
+# processes, each propagating every satellite over its own slice.
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_sgp4 import ElementSets, golden_section
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import default_processes, process_pool
+
+# python3 -m pip install numpy
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# the mean elements leave out the short period terms, the osculating radius
+# strays this far (km) from the mean perigee / apogee
+SHELL_SLACK_KM = 30.0
+
+# the most two objects near the Earth can accelerate towards each other
+# (km/s^2, twice the gravity at the surface), bounds the error of the
+# straight line estimate of the closest approach within a step
+MAX_RELATIVE_ACCEL = 2 * 0.00981
+
+# the screening step is at most this fraction of the shortest orbital period
+STEP_FRACTION = 1.0 / 20.0
+
+# cube coordinates are packed into one int64, 21 bits each
+CELL_BITS = 21
+CELL_BIAS = 1 << (CELL_BITS - 1)
+
+
+def shell_filter(perigee, apogee, threshold):
+    """True for every satellite whose shell (perigee to apogee, widened) overlaps the shell of another one"""
+    reach = threshold + SHELL_SLACK_KM
+    order = np.argsort(perigee, kind='stable')
+    low, high = perigee[order], apogee[order]
+    keep = np.zeros(len(order), dtype=bool)
+    if len(order) < 2:
+        return keep
+    # sorted on perigee, a shell overlaps one that starts later only if it overlaps the next one
+    nxt = low[1:] <= high[:-1] + reach
+    # and one that starts earlier only if the highest apogee before it reaches it
+    before = np.maximum.accumulate(high)[:-1]
+    prv = low[1:] <= before + reach
+    keep[:-1] |= nxt
+    keep[1:] |= prv
+    result = np.zeros(len(order), dtype=bool)
+    result[order] = keep
+    return result
+
+
+def _neighbours():
+    """the 14 cube offsets that, with the pairs of one cube, cover every neighbouring pair once"""
+    offsets = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                if (dx, dy, dz) > (0, 0, 0) or (dx, dy, dz) == (0, 0, 0):
+                    offsets.append((dx << (2 * CELL_BITS)) + (dy << CELL_BITS) + dz)
+    return offsets
+
+
+NEIGHBOURS = _neighbours()
+
+
+def near_pairs(r, cell):
+    """every pair (i, j) of positions r (n, 3) in the same or neighbouring cubes of size cell"""
+    empty = np.empty(0, dtype=np.intp)
+    idx = np.flatnonzero(~np.isnan(r[:, 0]))
+    if idx.size < 2:
+        return empty, empty
+    c = np.floor(r[idx] / cell).astype(np.int64) + CELL_BIAS
+    keys = (c[:, 0] << (2 * CELL_BITS)) + (c[:, 1] << CELL_BITS) + c[:, 2]
+    order = np.argsort(keys, kind='stable')
+    # the occupied cubes, sorted, with where their members start in order and how many there are
+    cubes, first, size = np.unique(keys[order], return_index=True, return_counts=True)
+    firsts, seconds = [], []
+    for offset in NEIGHBOURS:
+        # the occupied cubes next to each occupied cube, looked up in sorted order
+        pos = np.searchsorted(cubes, cubes + offset)
+        hit = pos < cubes.size
+        hit[hit] = cubes[pos[hit]] == cubes[hit] + offset
+        cu, cw = np.flatnonzero(hit), pos[hit]
+        if not cu.size:
+            continue
+        # every member of one cube with every member of the other
+        nu, nw = size[cu], size[cw]
+        pairs = nu * nw
+        total = int(pairs.sum())
+        which = np.repeat(np.arange(cu.size), pairs)
+        local = np.arange(total) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+        a = first[cu][which] + local // nw[which]
+        b = first[cw][which] + local % nw[which]
+        # within one cube every pair is found twice and every satellite with itself, keep a < b
+        if offset == 0:
+            keep = a < b
+            a, b = a[keep], b[keep]
+        firsts.append(idx[order[a]])
+        seconds.append(idx[order[b]])
+    if not firsts:
+        return empty, empty
+    i, j = np.concatenate(firsts), np.concatenate(seconds)
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def screen_slice(job):
+    """screen one slice of the window, run in a worker process
+
+    job is (tles, times, first step, step seconds, threshold, perigee, apogee). returns
+    (i, j, step, estimated miss distance, estimated offset of the closest
+    approach from that step in seconds) arrays of every pair that may come
+    within threshold
+    """
+    tles, times, first, dt, threshold, perigee, apogee = job
+    sets = ElementSets(tles)
+    positions, velocities, _ = sets.propagate(times)
+    # one step at a time is read below, lay the arrays out as (times, satellites, 3)
+    positions = np.ascontiguousarray(positions.transpose(1, 0, 2))
+    velocities = np.ascontiguousarray(velocities.transpose(1, 0, 2))
+    half = dt / 2.0
+    speed = np.nanmax(np.linalg.norm(velocities, axis=2)) if np.any(~np.isnan(velocities)) else 0.0
+    # two satellites close at most twice the top speed, bins have to catch every pair that could
+    cell = threshold + 2.0 * speed * half
+    # the straight line estimate is off by at most a * t^2 / 2 over half a step
+    slack = MAX_RELATIVE_ACCEL * half * half / 2.0
+    reach = threshold + SHELL_SLACK_KM
+
+    found = dict(i=[], j=[], step=[], miss=[], offset=[])
+    for k in range(len(times)):
+        i, j = near_pairs(positions[k], cell)
+        if not i.size:
+            continue
+        shells = (perigee[i] <= apogee[j] + reach) & (perigee[j] <= apogee[i] + reach)
+        i, j = i[shells], j[shells]
+        dr = positions[k, j] - positions[k, i]
+        dv = velocities[k, j] - velocities[k, i]
+        vv = np.einsum('ij,ij->i', dv, dv)
+        tca = np.where(vv > 0, -np.einsum('ij,ij->i', dr, dv) / np.where(vv > 0, vv, 1.0), 0.0)
+        tca = np.clip(tca, -half, half)
+        miss = np.linalg.norm(dr + dv * tca[:, None], axis=1)
+        close = miss <= threshold + slack
+        if np.any(close):
+            found['i'].append(i[close])
+            found['j'].append(j[close])
+            found['step'].append(np.full(int(close.sum()), first + k))
+            found['miss'].append(miss[close])
+            found['offset'].append(tca[close])
+    return tuple(np.concatenate(found[key]) if found[key] else np.empty(0) for key in ('i', 'j', 'step', 'miss', 'offset'))
+
+
+def refine(sets, i, j, low, high, iterations=40):
+    """golden section search for the closest approach of every pair (i[n], j[n]) between low[n] and high[n]
+
+    returns (time of closest approach, miss distance km, relative speed km/s)
+    """
+    def distance(t):
+        ri, _, _ = sets.propagate_at(i, t)
+        rj, _, _ = sets.propagate_at(j, t)
+        return np.linalg.norm(rj - ri, axis=1)
+
+    t = golden_section(distance, low, high, iterations)
+    ri, vi, _ = sets.propagate_at(i, t)
+    rj, vj, _ = sets.propagate_at(j, t)
+    return t, np.linalg.norm(rj - ri, axis=1), np.linalg.norm(vj - vi, axis=1)
+
+
+def screen(tles, times, threshold, processes=None, slices_per_process=4):
+    """every close approach under threshold (km) between the TLEs within times (POSIX timestamps, evenly spaced)
+
+    returns (conjunctions, statistics). conjunctions are dicts of i and j
+    (indices into tles), tca (POSIX timestamp), miss_km and
+    relative_speed_kps, closest first. A pair that meets more than once in
+    the window is listed once per encounter. Times further apart than
+    STEP_FRACTION of the shortest orbital period are screened on a finer
+    grid over the same window.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    sets = ElementSets(tles)
+    perigee, apogee = sets.radii()
+    # deep space and unreadable TLEs are never propagated, they can not be screened
+    usable = (sets.error == 0) & shell_filter(perigee, apogee, threshold)
+    rows = np.flatnonzero(usable)
+    stats = dict(satellites=len(tles), screened=int(rows.size), steps=int(times.size), candidates=0, encounters=0)
+    if rows.size < 2 or not times.size:
+        return [], stats
+
+    # screened no coarser than STEP_FRACTION of the shortest period (minutes, no_unkozai is radians per minute)
+    coarsest = float(np.min(2.0 * np.pi / sets.no_unkozai[rows])) * 60.0 * STEP_FRACTION
+    if times.size > 1 and times[1] - times[0] > coarsest:
+        times = np.linspace(times[0], times[-1], int(np.ceil((times[-1] - times[0]) / coarsest)) + 1)
+        stats['steps'] = int(times.size)
+
+    subset = [tles[n] for n in rows]
+    processes = max(1, int(processes or default_processes()))
+    count = min(times.size, processes * slices_per_process) if processes > 1 else 1
+    bounds = np.linspace(0, times.size, count + 1).astype(int)
+    dt = times[1] - times[0] if times.size > 1 else 0.0
+    jobs = [(subset, times[bounds[n]:bounds[n + 1]], int(bounds[n]), dt, float(threshold), perigee[rows], apogee[rows])
+            for n in range(count) if bounds[n + 1] > bounds[n]]
+    if processes > 1 and len(jobs) > 1:
+        with process_pool(min(processes, len(jobs))) as pool:
+            parts = list(pool.map(screen_slice, jobs))
+    else:
+        parts = [screen_slice(job) for job in jobs]
+    i, j, step, miss, offset = (np.concatenate([part[n] for part in parts]) for n in range(5))
+    stats['candidates'] = int(i.size)
+    if not i.size:
+        return [], stats
+
+    # one encounter is a run of consecutive steps of the same pair, refined from its closest step
+    i, j, step = i.astype(np.intp), j.astype(np.intp), step.astype(np.intp)
+    order = np.lexsort((step, j, i))
+    i, j, step, miss, offset = i[order], j[order], step[order], miss[order], offset[order]
+    new = np.ones(i.size, dtype=bool)
+    new[1:] = (i[1:] != i[:-1]) | (j[1:] != j[:-1]) | (step[1:] != step[:-1] + 1)
+    group = np.cumsum(new) - 1
+    # the closest estimate of each group
+    by_miss = np.lexsort((miss, group))
+    firsts = np.ones(by_miss.size, dtype=bool)
+    firsts[1:] = group[by_miss][1:] != group[by_miss][:-1]
+    best = by_miss[firsts]
+    stats['encounters'] = int(best.size)
+
+    centre = times[step[best]] + offset[best]
+    low = np.maximum(centre - dt, times[0])
+    high = np.minimum(centre + dt, times[-1])
+    gi, gj = rows[i[best]], rows[j[best]]
+    tca, distance, speed = refine(sets, gi, gj, low, high)
+
+    conjunctions = []
+    for n in np.argsort(distance, kind='stable'):
+        if not distance[n] <= threshold:
+            continue
+        conjunctions.append(dict(i=int(gi[n]), j=int(gj[n]), tca=float(tca[n]),
+                                 miss_km=float(distance[n]), relative_speed_kps=float(speed[n])))
+    return conjunctions, stats
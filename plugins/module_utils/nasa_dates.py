@@ -0,0 +1,60 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# date helpers shared by the rzfeeser.nasa_api modules that split a long
+# startdate..enddate span into several smaller API lookups
+
+from datetime import datetime, timedelta, timezone
+
+
+def parse_date(value):
+    """YYYY-MM-DD string to a date, raises ValueError for anything else"""
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def parse_time(value):
+    """ISO 8601 string (or now) to an aware datetime, a time without an offset is UTC"""
+    if value is None or value == 'now':
+        return datetime.now(timezone.utc)
+    moment = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def split_windows(sd, ed, days):
+    """split the range sd..ed (inclusive, YYYY-MM-DD) into windows of at most `days` days
+
+    returns a list of (start, end) YYYY-MM-DD tuples, in date order
+    """
+    start = parse_date(sd)
+    end = parse_date(ed)
+    if end < start:
+        raise ValueError(f"end date {ed} is before start date {sd}")
+    days = max(1, int(days))
+    windows = []
+    while start <= end:
+        stop = min(start + timedelta(days=days - 1), end)
+        windows.append((start.isoformat(), stop.isoformat()))
+        start = stop + timedelta(days=1)
+    return windows
+
+
+def split_months(sd, ed):
+    """split the range sd..ed (inclusive, YYYY-MM-DD) at calendar month boundaries
+
+    returns a list of (start, end) YYYY-MM-DD tuples, in date order
+    """
+    start = parse_date(sd)
+    end = parse_date(ed)
+    if end < start:
+        raise ValueError(f"end date {ed} is before start date {sd}")
+    windows = []
+    while start <= end:
+        # the first day of the next month, less one day
+        first = start.replace(day=1)
+        following = (first + timedelta(days=32)).replace(day=1)
+        stop = min(following - timedelta(days=1), end)
+        windows.append((start.isoformat(), stop.isoformat()))
+        start = stop + timedelta(days=1)
+    return windows
@@ -0,0 +1,308 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# A local SQLite store of every DONKI notification nasa_donki has fetched,
+# keyed on messageID. It remembers the newest messageIssueTime seen, so a
+# sync only has to ask the API for what came after it.
+#
+# The store also keeps a full-text index over every messageBody. SQLite FTS5
+# is used when the sqlite3 library was built with it, otherwise a plain
+# (token, messageID, count) table is kept and ranked with tf-idf.
+#
+# Events from the typed DONKI endpoints (CME, FLR, GST, ...) are kept in the
+# same store, keyed on their activity ID, along with an adjacency table built
+# from their linkedEvents, so chains like flare -> CME -> storm are walked
+# locally instead of with one API lookup per hop.
+
+import json
+import math
+import re
+import shlex
+import sqlite3
+
+TOKEN = re.compile(r'[a-z0-9]+')
+
+# the typed DONKI event endpoints, with the field holding each event's
+# activity ID and the field holding the time the event started
+EVENT_TYPES = {
+    'CME': ('activityID', 'startTime'),
+    'FLR': ('flrID', 'beginTime'),
+    'GST': ('gstID', 'startTime'),
+    'IPS': ('activityID', 'eventTime'),
+    'SEP': ('sepID', 'eventTime'),
+    'MPC': ('mpcID', 'eventTime'),
+    'RBE': ('rbeID', 'eventTime'),
+}
+
+
+def event_type(activity_id):
+    """the type is part of every activity ID, 2016-01-01T23:36:00-FLR-001 is a FLR"""
+    for part in reversed((activity_id or '').split('-')):
+        if part in EVENT_TYPES:
+            return part
+    return None
+
+
+def tokenize(text):
+    """lower case words, split the same way the FTS5 unicode61 tokenizer splits them"""
+    return TOKEN.findall((text or '').lower())
+
+
+def parse_query(query):
+    """split a search into phrases, "quoted words" stay together, everything else is one word per phrase
+
+    Earth-directed is the phrase (earth, directed), the same as FTS5 would see it
+    """
+    try:
+        parts = shlex.split(query)
+    except ValueError:
+        parts = query.split()
+    return [p for p in (tokenize(part) for part in parts) if p]
+
+
+class DonkiStore(object):
+    """notifications (keyed on messageID) and events (keyed on activity ID) seen so far"""
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT PRIMARY KEY,
+            message_type TEXT,
+            issue_time TEXT,
+            url TEXT,
+            body TEXT,
+            data TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS messages_issue_time ON messages (issue_time)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        '''CREATE TABLE IF NOT EXISTS events (
+            activity_id TEXT PRIMARY KEY,
+            event_type TEXT,
+            event_time TEXT,
+            data TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS links (
+            src TEXT,
+            dst TEXT,
+            PRIMARY KEY (src, dst)
+        ) WITHOUT ROWID''',
+    )
+
+    # the fallback index, used when sqlite3 has no FTS5
+    TOKEN_SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS tokens (
+            token TEXT,
+            message_id TEXT,
+            tf INTEGER,
+            PRIMARY KEY (token, message_id)
+        ) WITHOUT ROWID''',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.fts = self._create_index()
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _create_index(self):
+        """create the full-text index if needed, returns True for FTS5 and False for the token table"""
+        existing = [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE name IN ('messages_fts', 'tokens')")]
+        if 'messages_fts' in existing:
+            return True
+        if 'tokens' in existing:
+            return False
+        try:
+            self.db.execute('CREATE VIRTUAL TABLE messages_fts USING fts5(message_id UNINDEXED, body)')
+            fts = True
+        except sqlite3.OperationalError:
+            for statement in self.TOKEN_SCHEMA:
+                self.db.execute(statement)
+            fts = False
+        # a store made before the index existed, index what is already in it
+        self._index(self.db.execute('SELECT message_id, body FROM messages').fetchall(), fts)
+        return fts
+
+    def _index(self, rows, fts=None):
+        """add (message_id, body) rows to the full-text index"""
+        fts = self.fts if fts is None else fts
+        if fts:
+            self.db.executemany('INSERT INTO messages_fts (message_id, body) VALUES (?, ?)', rows)
+            return
+        for message_id, body in rows:
+            counts = {}
+            for token in tokenize(body):
+                counts[token] = counts.get(token, 0) + 1
+            self.db.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+                                [(token, message_id, tf) for token, tf in counts.items()])
+
+    def last_issue_time(self):
+        """the newest messageIssueTime in the store, or None when it is empty"""
+        return self.db.execute('SELECT MAX(issue_time) FROM messages').fetchone()[0]
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def add(self, notifications, commit=True):
+        """store (and index) the notifications not seen before, returns only those (in the order given)
+
+        a notification without a messageID can not be told apart from the
+        next one, it is left out. With commit=False the caller commits (or
+        rolls back) once it has done what it needs with the new ones
+        """
+        new = []
+        for entry in notifications:
+            if not entry.get('messageID'):
+                continue
+            cur = self.db.execute(
+                'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+                (entry.get('messageID'), entry.get('messageType'), entry.get('messageIssueTime'),
+                 entry.get('messageURL'), entry.get('messageBody'), json.dumps(entry)))
+            if cur.rowcount:
+                new.append(entry)
+        self._index([(entry.get('messageID'), entry.get('messageBody')) for entry in new])
+        if commit:
+            self.db.commit()
+        return new
+
+    def search(self, query, limit=20):
+        """messages whose body has every phrase of query, best match first
+
+        returns dicts of messageID, messageType, messageIssueTime, snippet and
+        rank (smaller is better, as with the FTS5 bm25 function)
+        """
+        phrases = parse_query(query)
+        if not phrases:
+            return []
+        if self.fts:
+            match = ' AND '.join('"' + ' '.join(p) + '"' for p in phrases)
+            rows = self.db.execute(
+                "SELECT f.message_id, m.message_type, m.issue_time, "
+                "snippet(messages_fts, 1, '[', ']', '...', 16), bm25(messages_fts) "
+                "FROM messages_fts f JOIN messages m ON m.message_id = f.message_id "
+                "WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?",
+                (match, int(limit))).fetchall()
+        else:
+            rows = self._search_tokens(phrases, int(limit))
+        return [dict(messageID=r[0], messageType=r[1], messageIssueTime=r[2], snippet=r[3], rank=r[4]) for r in rows]
+
+    def _search_tokens(self, phrases, limit):
+        """the fallback search, every word must be indexed and every phrase found in the body"""
+        total = self.count() or 1
+        scores = None
+        for word in sorted(set(w for p in phrases for w in p)):
+            posting = dict(self.db.execute('SELECT message_id, tf FROM tokens WHERE token = ?', (word,)))
+            idf = math.log(1 + total / (1 + len(posting)))
+            if scores is None:
+                scores = dict((mid, tf * idf) for mid, tf in posting.items())
+            else:
+                scores = dict((mid, score + posting[mid] * idf) for mid, score in scores.items() if mid in posting)
+            if not scores:
+                return []
+
+        # words of a phrase must follow each other, separated by anything that is not a word
+        patterns = [re.compile(r'\b' + r'[^a-z0-9]+'.join(p) + r'\b', re.IGNORECASE) for p in phrases]
+        rows = []
+        for mid, score in sorted(scores.items(), key=lambda item: (-item[1], item[0])):
+            mtype, issued, body = self.db.execute(
+                'SELECT message_type, issue_time, body FROM messages WHERE message_id = ?', (mid,)).fetchone()
+            found = [pattern.search(body or '') for pattern in patterns]
+            if not all(found):
+                continue
+            first = min(found, key=lambda m: m.start())
+            start = max(0, first.start() - 60)
+            snippet = body[start:first.start()] + '[' + first.group(0) + ']' + body[first.end():first.end() + 60]
+            rows.append((mid, mtype, issued, ('...' if start else '') + ' '.join(snippet.split()) + '...', -score))
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def add_events(self, etype, events):
+        """store events of one type and their links (both directions), returns how many were new or changed"""
+        id_field, time_field = EVENT_TYPES[etype]
+        changed = 0
+        for event in events:
+            aid = event.get(id_field)
+            if not aid:
+                continue
+            data = json.dumps(event, sort_keys=True)
+            row = self.db.execute('SELECT data FROM events WHERE activity_id = ?', (aid,)).fetchone()
+            if row is None or row[0] != data:
+                self.db.execute('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)',
+                                (aid, etype, event.get(time_field), data))
+                changed += 1
+            for linked in event.get('linkedEvents') or []:
+                other = linked.get('activityID')
+                if other and other != aid:
+                    self.db.executemany('INSERT OR IGNORE INTO links VALUES (?, ?)', [(aid, other), (other, aid)])
+        self.db.commit()
+        return changed
+
+    def event_count(self):
+        return self.db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def traverse(self, start, path=None, forward_only=True):
+        """walk the linked events from the activity ID start
+
+        path is a list of event types, each step only moves to linked events of
+        that type (FLR -> [CME, GST] finds the storms linked to the CMEs linked
+        to the flare). Without a path every event reachable from start is
+        returned. With forward_only a step never moves to an event that started
+        before the one it came from.
+
+        returns a list of dicts of activityID, type, time, depth, via (the
+        activity ID it was reached from) and event (the stored event, or None
+        when only its ID is known from a link)
+        """
+        # the whole adjacency and every event time, loaded once
+        adjacency = {}
+        for src, dst in self.db.execute('SELECT src, dst FROM links'):
+            adjacency.setdefault(src, []).append(dst)
+        times = dict(self.db.execute('SELECT activity_id, event_time FROM events'))
+
+        def later(a, b):
+            if not forward_only or not times.get(a) or not times.get(b):
+                return True
+            return times[b] >= times[a]
+
+        found = []
+        seen = set([start])
+        frontier = [start]
+        depth = 0
+        while frontier:
+            if path is not None and depth >= len(path):
+                break
+            want = path[depth].upper() if path is not None else None
+            depth += 1
+            step = []
+            for aid in frontier:
+                for other in sorted(adjacency.get(aid, [])):
+                    if other in seen or (want and event_type(other) != want) or not later(aid, other):
+                        continue
+                    seen.add(other)
+                    step.append(other)
+                    found.append(dict(activityID=other, type=event_type(other), time=times.get(other),
+                                      depth=depth, via=aid))
+            frontier = step
+
+        # with a path only the last step is the answer, the rest is how we got there
+        if path is not None:
+            found = [f for f in found if f['depth'] == len(path)]
+        for f in found:
+            row = self.db.execute('SELECT data FROM events WHERE activity_id = ?', (f['activityID'],)).fetchone()
+            f['event'] = json.loads(row[0]) if row else None
+        return found
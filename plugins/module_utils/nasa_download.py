@@ -0,0 +1,268 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# A streaming download shared by the rzfeeser.nasa_api modules that save
+# binaries (APOD HD images, Earth imagery, ...).
+#
+# The body is written in fixed-size chunks to <dest>.part (never held in
+# memory), and an interrupted transfer picks up where it stopped with an
+# HTTP Range request, both inside one run (retries) and across runs (the
+# .part file is left behind). The ETag / Last-Modified of the file the .part
+# came from is kept next to it in <part>.validator and sent as If-Range, so a
+# file that changed on the server is downloaded again from the start instead
+# of being spliced onto the old bytes.
+#
+# Once complete the length is checked, and the digest is compared with the
+# one given by the caller or, failing that, the one the server sent (Digest,
+# Repr-Digest or Content-MD5 headers). Without either the digest is only
+# reported. Only then is the .part file renamed to dest.
+
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import time
+
+# python3 -m pip install requests
+import requests
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# errors that mean "the connection dropped", worth resuming from
+RETRYABLE = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+class DownloadError(Exception):
+    """raised when a download could not be completed (or failed verification)"""
+
+    def __init__(self, msg, status_code=0):
+        super(DownloadError, self).__init__(msg)
+        self.status_code = status_code
+
+
+def _hash_file(path, algorithm, chunk_size=CHUNK_SIZE):
+    """start a hash object from the bytes already on disk (used when resuming)"""
+    h = hashlib.new(algorithm)
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h
+
+
+def _total_size(resp, offset):
+    """the size of the whole file, from Content-Range on a 206 or Content-Length on a 200"""
+    if resp.status_code == 206:
+        m = re.match(r'bytes \d+-\d+/(\d+)', resp.headers.get('Content-Range', ''))
+        return int(m.group(1)) if m else None
+    length = resp.headers.get('Content-Length')
+    # a Content-Encoding (gzip) means Content-Length is not the size we write to disk
+    if length is None or resp.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    return int(length) + offset
+
+
+def _validator(resp):
+    """what identifies the version of the file a response is from, the ETag and Last-Modified headers"""
+    return dict(etag=resp.headers.get('ETag'), last_modified=resp.headers.get('Last-Modified'))
+
+
+def _load_validator(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_validator(path, validator):
+    if not (validator.get('etag') or validator.get('last_modified')):
+        # nothing to tell the next run which version the .part file is from
+        if os.path.isfile(path):
+            os.unlink(path)
+        return
+    with open(path, 'w') as f:
+        json.dump(validator, f)
+
+
+def _if_range(validator):
+    """the If-Range value for validator, a weak ETag can not be used there"""
+    etag = validator.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validator.get('last_modified')
+
+
+def _same_version(validator, resp):
+    """False when a 206 answered with the range of a different version than the .part file holds"""
+    new = _validator(resp)
+    for key in ('etag', 'last_modified'):
+        if validator.get(key) and new.get(key) and validator[key] != new[key]:
+            return False
+    return True
+
+
+# digest header names, as sent by the server, and the hashlib algorithm they are
+DIGEST_ALGORITHMS = {'sha-256': 'sha256', 'sha-512': 'sha512', 'md5': 'md5'}
+
+
+def server_digest(resp):
+    """the (algorithm, hex digest) of the whole file the server sent along with resp, or None
+
+    Digest (RFC 3230) and Repr-Digest (RFC 9530) describe the whole file,
+    Content-MD5 only the body, so it is only used on a 200
+    """
+    for header in ('Repr-Digest', 'Digest'):
+        for item in (resp.headers.get(header) or '').split(','):
+            name, _, value = item.strip().partition('=')
+            algorithm = DIGEST_ALGORITHMS.get(name.strip().lower())
+            if algorithm and value:
+                try:
+                    return algorithm, binascii.hexlify(base64.b64decode(value.strip().strip(':'))).decode()
+                except (binascii.Error, ValueError):
+                    continue
+    if resp.status_code == 200 and resp.headers.get('Content-MD5'):
+        try:
+            return 'md5', binascii.hexlify(base64.b64decode(resp.headers['Content-MD5'])).decode()
+        except (binascii.Error, ValueError):
+            return None
+    return None
+
+
+def download(url, dest, part=None, headers=None, chunk_size=CHUNK_SIZE, retries=3, timeout=60,
+             expected_size=None, expected_digest=None, algorithm='sha256', session=None):
+    """stream url to dest, resuming a partial download with an HTTP Range request
+
+    part is the file bytes are written to until the download is verified,
+    defaults to <dest>.part. Returns a dict of statistics about the transfer,
+    verified is how the digest was checked (expected, server or empty when
+    it could not be). Raises DownloadError when the file could not be
+    fetched or verified.
+    """
+    part = part or f"{dest}.part"
+    validator_path = f"{part}.validator"
+    # a .part file left by another run is only resumed when we know which version of the file it holds
+    validator = _load_validator(validator_path) if os.path.isfile(part) else None
+    if os.path.isfile(part) and validator is None:
+        os.unlink(part)
+    checksum = None
+    get = session.get if session is not None else requests.get
+    started = time.time()
+    transferred = 0
+    resumed = False
+    status_code = 0
+    total = None
+    hasher = None
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        h = dict(headers or {})
+        if offset:
+            h['Range'] = f"bytes={offset}-"
+            if validator and _if_range(validator):
+                h['If-Range'] = _if_range(validator)
+
+        try:
+            with get(url, headers=h, stream=True, timeout=timeout) as resp:
+                status_code = resp.status_code
+
+                # 416 means we asked for bytes past the end, the .part file may already be complete
+                if resp.status_code == 416 and offset:
+                    total = offset
+                    break
+
+                if resp.status_code not in (200, 206):
+                    raise DownloadError(f"A {resp.status_code} response was returned as we tried to download {url}", resp.status_code)
+
+                if resp.status_code == 206 and validator is not None and not _same_version(validator, resp):
+                    # the server ignored If-Range and sent bytes of another version, start over
+                    resp.close()
+                    os.unlink(part)
+                    validator = None
+                    hasher = None
+                    continue
+
+                # a 200 to a Range request means the server ignored it (or the file changed), start over from zero
+                if resp.status_code == 200:
+                    offset = 0
+                    hasher = hashlib.new(algorithm)
+                    validator = _validator(resp)
+                    _save_validator(validator_path, validator)
+                else:
+                    resumed = True
+                    # hash what is already on disk once, then keep hashing as we stream
+                    if hasher is None:
+                        hasher = _hash_file(part, algorithm)
+
+                total = _total_size(resp, offset)
+                checksum = server_digest(resp) or checksum
+                with open(part, 'ab' if offset else 'wb') as f:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            transferred += len(chunk)
+            break
+        except RETRYABLE as err:
+            # the bytes written before the drop are already in hasher, carry on from there
+            if attempt == retries:
+                raise DownloadError(f"Gave up downloading {url} after {retries + 1} attempts: {err}", status_code)
+            # back off a little before resuming (1s, 2s, 4s, ...)
+            time.sleep(2 ** attempt)
+        except (requests.exceptions.RequestException, OSError) as err:
+            # a bad url, a redirect loop or a .part file we cannot write, retrying will not help
+            raise DownloadError(f"Could not download {url}: {err}", status_code)
+
+    if not os.path.isfile(part):
+        raise DownloadError(f"{url} changed on the server while it was being resumed, try again", status_code)
+    size = os.path.getsize(part)
+    want = expected_size if expected_size is not None else total
+    if want is not None and size != want:
+        # too many bytes can never be fixed by resuming, too few can
+        if size > want:
+            os.unlink(part)
+        raise DownloadError(f"Downloaded {size} bytes of {url}, expected {want}", status_code)
+
+    # a .part file that was already complete (416) was never streamed through hasher
+    digest = (hasher or _hash_file(part, algorithm)).hexdigest()
+    verified = ''
+    if expected_digest:
+        check, want_digest, got, verified = algorithm, expected_digest, digest, 'expected'
+    elif checksum:
+        check, want_digest = checksum
+        got = digest if check == algorithm else _hash_file(part, check).hexdigest()
+        verified = 'server'
+    if verified and got.lower() != want_digest.lower():
+        # a bad file must not be resumed next time
+        os.unlink(part)
+        if os.path.isfile(validator_path):
+            os.unlink(validator_path)
+        raise DownloadError(f"{check} of {url} was {got}, expected {want_digest}", status_code)
+
+    try:
+        os.replace(part, dest)
+    except OSError as err:
+        raise DownloadError(f"Could not move {part} to {dest}: {err}", status_code)
+    if os.path.isfile(validator_path):
+        os.unlink(validator_path)
+
+    seconds = max(time.time() - started, 1e-6)
+    return dict(
+        status_code=status_code,
+        bytes=size,
+        transferred=transferred,
+        resumed=resumed,
+        seconds=round(seconds, 3),
+        throughput=int(transferred / seconds),  # bytes per second
+        digest=digest,
+        algorithm=algorithm,
+        verified=verified,
+    )
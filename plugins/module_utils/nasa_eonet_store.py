@@ -0,0 +1,338 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# A local SQLite store of the EONET events nasa_eonet_events has synced,
+# keyed on the EONET event id. Each sync only asks for what changed since the
+# last one; the geometry points it returns are merged into the events already
+# stored, and events that gained a closed date are marked closed.
+#
+# The store can also keep a spatial-temporal index over every geometry point
+# and polygon, so bbox + date range + category questions are answered locally.
+# Each point is indexed by its bounding box and its day in an SQLite R*Tree
+# when the sqlite3 library was built with it, otherwise in a uniform grid of
+# GRID_DEGREES cells.
+
+import json
+import math
+import sqlite3
+
+from datetime import date
+
+# cell size of the fallback grid, in degrees of longitude and latitude
+GRID_DEGREES = 10
+GRID_ROWS = 180 // GRID_DEGREES
+GRID_COLS = 360 // GRID_DEGREES
+
+# the most event ids looked up in one IN (...), well under sqlite's parameter limit
+ID_CHUNK = 500
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def geometry_key(point):
+    """a geometry entry is the same point when its date, type and coordinates are"""
+    return (point.get('date') or '', point.get('type') or '', json.dumps(point.get('coordinates'), sort_keys=True))
+
+
+def merge_event(old, new):
+    """the newer copy of an event, with every geometry point either copy has (in date order)"""
+    merged = dict(new)
+    points = {}
+    for point in (old or {}).get('geometry') or []:
+        points[geometry_key(point)] = point
+    for point in new.get('geometry') or []:
+        points[geometry_key(point)] = point
+    merged['geometry'] = [points[key] for key in sorted(points)]
+    return merged
+
+
+def bounds(coordinates):
+    """(min_lon, max_lon, min_lat, max_lat) of a Point, or of every corner of a Polygon"""
+    lons, lats = [], []
+    stack = [coordinates]
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, (list, tuple)) or not item:
+            continue
+        if isinstance(item[0], (int, float)) and len(item) >= 2:
+            lons.append(float(item[0]))
+            lats.append(float(item[1]))
+        else:
+            stack.extend(item)
+    if not lons:
+        return None
+    return min(lons), max(lons), min(lats), max(lats)
+
+
+def day_number(value):
+    """days since 1970-01-01 of a YYYY-MM-DD (or ISO 8601 date time) string"""
+    return date.fromisoformat(value[:10]).toordinal() - EPOCH
+
+
+def parse_bbox(value):
+    """an EONET bbox (upper left lon,lat then lower right lon,lat) as (min_lon, max_lon, min_lat, max_lat)"""
+    try:
+        lon1, lat1, lon2, lat2 = [float(v) for v in value.split(',')]
+    except ValueError:
+        raise ValueError(f"bbox must be four numbers, lon,lat,lon,lat, not {value}")
+    return min(lon1, lon2), max(lon1, lon2), min(lat1, lat2), max(lat1, lat2)
+
+
+def grid_cells(min_lon, max_lon, min_lat, max_lat):
+    """every fallback grid cell a bounding box touches"""
+    def col(lon):
+        return min(GRID_COLS - 1, max(0, int(math.floor((lon + 180) / GRID_DEGREES))))
+
+    def row(lat):
+        return min(GRID_ROWS - 1, max(0, int(math.floor((lat + 90) / GRID_DEGREES))))
+
+    return [x * GRID_ROWS + y
+            for x in range(col(min_lon), col(max_lon) + 1)
+            for y in range(row(min_lat), row(max_lat) + 1)]
+
+
+class EonetStore(object):
+    """EONET events seen so far, keyed on event id"""
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS events (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            closed TEXT,
+            last_date TEXT,
+            data TEXT
+        )''',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    )
+
+    # one row per geometry point (or polygon) of every event, and the categories of every event
+    SPATIAL_SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS geoms (
+            gid INTEGER PRIMARY KEY,
+            event_id TEXT,
+            point INTEGER,
+            day INTEGER,
+            min_lon REAL,
+            max_lon REAL,
+            min_lat REAL,
+            max_lat REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS geoms_event ON geoms (event_id)',
+        'CREATE INDEX IF NOT EXISTS geoms_day ON geoms (day)',
+        '''CREATE TABLE IF NOT EXISTS categories (
+            event_id TEXT,
+            category TEXT,
+            PRIMARY KEY (event_id, category)
+        ) WITHOUT ROWID''',
+    )
+
+    # the fallback index, used when sqlite3 has no R*Tree
+    GRID_SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS grid (
+            cell INTEGER,
+            gid INTEGER,
+            PRIMARY KEY (cell, gid)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS grid_gid ON grid (gid)',
+    )
+
+    def __init__(self, path, spatial=False):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        # None when there is no spatial index, otherwise 'rtree' or 'grid'
+        self.spatial = None
+        # True when the spatial index was created (and filled) by this open
+        self.built = False
+        self.spatial = self._create_spatial(spatial)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _create_spatial(self, wanted):
+        """find the spatial index, creating it (and indexing every stored event) when wanted"""
+        existing = [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE name IN ('geoms_rtree', 'grid')")]
+        if 'geoms_rtree' in existing:
+            return 'rtree'
+        if 'grid' in existing:
+            return 'grid'
+        if not wanted:
+            return None
+        for statement in self.SPATIAL_SCHEMA:
+            self.db.execute(statement)
+        try:
+            self.db.execute('CREATE VIRTUAL TABLE geoms_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat, min_day, max_day)')
+            self.spatial = 'rtree'
+        except sqlite3.OperationalError:
+            for statement in self.GRID_SCHEMA:
+                self.db.execute(statement)
+            self.spatial = 'grid'
+        self.built = True
+        # a store synced before the index existed, index what is already in it
+        for eid, data in self.db.execute('SELECT id, data FROM events').fetchall():
+            self._index(eid, json.loads(data))
+        return self.spatial
+
+    def _index(self, eid, event):
+        """(re)index every geometry entry and category of one event"""
+        if self.spatial == 'rtree':
+            self.db.execute('DELETE FROM geoms_rtree WHERE id IN (SELECT gid FROM geoms WHERE event_id = ?)', (eid,))
+        else:
+            self.db.execute('DELETE FROM grid WHERE gid IN (SELECT gid FROM geoms WHERE event_id = ?)', (eid,))
+        self.db.execute('DELETE FROM geoms WHERE event_id = ?', (eid,))
+        self.db.execute('DELETE FROM categories WHERE event_id = ?', (eid,))
+
+        for n, point in enumerate(event.get('geometry') or []):
+            box = bounds(point.get('coordinates'))
+            if box is None or not point.get('date'):
+                continue
+            day = day_number(point['date'])
+            gid = self.db.execute(
+                'INSERT INTO geoms (event_id, point, day, min_lon, max_lon, min_lat, max_lat) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (eid, n, day) + box).lastrowid
+            if self.spatial == 'rtree':
+                self.db.execute('INSERT INTO geoms_rtree VALUES (?, ?, ?, ?, ?, ?, ?)', (gid,) + box + (day, day))
+            else:
+                self.db.executemany('INSERT OR IGNORE INTO grid VALUES (?, ?)', [(cell, gid) for cell in grid_cells(*box)])
+        self.db.executemany('INSERT OR IGNORE INTO categories VALUES (?, ?)',
+                            [(eid, c.get('id')) for c in event.get('categories') or [] if c.get('id')])
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def count(self, status=None):
+        """how many events are stored, only the open or closed ones when status is given"""
+        sql = 'SELECT COUNT(*) FROM events'
+        if status == 'open':
+            sql += ' WHERE closed IS NULL'
+        elif status == 'closed':
+            sql += ' WHERE closed IS NOT NULL'
+        return self.db.execute(sql).fetchone()[0]
+
+    def get(self, event_id):
+        row = self.db.execute('SELECT data FROM events WHERE id = ?', (event_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def events(self, status=None):
+        """every stored event, ordered by id"""
+        sql = 'SELECT data FROM events'
+        if status == 'open':
+            sql += ' WHERE closed IS NULL'
+        elif status == 'closed':
+            sql += ' WHERE closed IS NOT NULL'
+        return [json.loads(row[0]) for row in self.db.execute(sql + ' ORDER BY id')]
+
+    def merge(self, events):
+        """merge events returned by the API into the store
+
+        returns a dict of the ids that were added, updated (new geometry
+        points or changed fields) and closed (a stored event that gained a
+        closed date)
+        """
+        changes = dict(added=[], updated=[], closed=[])
+        for event in events:
+            eid = event.get('id')
+            if not eid:
+                continue
+            old = self.get(eid)
+            merged = merge_event(old, event)
+            data = json.dumps(merged, sort_keys=True)
+            if old is not None and json.dumps(old, sort_keys=True) == data:
+                continue
+            dates = [point.get('date') for point in merged['geometry'] if point.get('date')]
+            self.db.execute('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+                            (eid, merged.get('title'), merged.get('closed'), max(dates) if dates else None, data))
+            if self.spatial:
+                self._index(eid, merged)
+            if old is None:
+                changes['added'].append(eid)
+            else:
+                changes['updated'].append(eid)
+            if old is not None and merged.get('closed') and not old.get('closed'):
+                changes['closed'].append(eid)
+        self.db.commit()
+        return changes
+
+    def query(self, bbox=None, start=None, end=None, categories=None, status=None, limit=None):
+        """events with a geometry point inside bbox, dated start..end, in one of categories
+
+        bbox is (min_lon, max_lon, min_lat, max_lat), start and end are
+        YYYY-MM-DD (inclusive) and status is 'open', 'closed' or None for
+        both. Each event returned only keeps the geometry points that
+        matched, events are ordered by id. Needs the spatial index.
+        """
+        if not self.spatial:
+            raise ValueError("the store has no spatial index")
+        first = day_number(start) if start else None
+        last = day_number(end) if end else None
+
+        # the exact test, on the geoms table
+        where, args = [], []
+        if bbox is not None:
+            where.append('g.max_lon >= ? AND g.min_lon <= ? AND g.max_lat >= ? AND g.min_lat <= ?')
+            args.extend([bbox[0], bbox[1], bbox[2], bbox[3]])
+        if first is not None:
+            where.append('g.day >= ?')
+            args.append(first)
+        if last is not None:
+            where.append('g.day <= ?')
+            args.append(last)
+        if categories:
+            where.append("EXISTS (SELECT 1 FROM categories k WHERE k.event_id = g.event_id "
+                         f"AND k.category IN ({', '.join('?' * len(categories))}))")
+            args.extend(categories)
+        if status == 'open':
+            where.append('e.closed IS NULL')
+        elif status == 'closed':
+            where.append('e.closed IS NOT NULL')
+
+        # the index narrows down the candidates the exact test is run on, CROSS JOIN
+        # keeps sqlite from starting with the category (or day) index instead
+        pre, pre_args = [], []
+        if bbox is None:
+            sql = 'SELECT g.event_id, g.point FROM geoms g'
+        elif self.spatial == 'rtree':
+            sql = 'SELECT g.event_id, g.point FROM geoms_rtree r CROSS JOIN geoms g ON g.gid = r.id'
+            pre.append('r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?')
+            pre_args.extend([bbox[0], bbox[1], bbox[2], bbox[3]])
+            if first is not None:
+                pre.append('r.max_day >= ?')
+                pre_args.append(first)
+            if last is not None:
+                pre.append('r.min_day <= ?')
+                pre_args.append(last)
+        else:
+            cells = grid_cells(*bbox)
+            sql = 'SELECT DISTINCT g.event_id, g.point FROM grid c CROSS JOIN geoms g ON g.gid = c.gid'
+            pre.append(f"c.cell IN ({', '.join('?' * len(cells))})")
+            pre_args.extend(cells)
+        if status in ('open', 'closed'):
+            sql += ' JOIN events e ON e.id = g.event_id'
+        if pre or where:
+            sql += ' WHERE ' + ' AND '.join(pre + where)
+
+        matched = {}
+        for eid, point in self.db.execute(sql, pre_args + args):
+            matched.setdefault(eid, set()).add(point)
+
+        ids = sorted(matched)[:limit or None]
+        found = []
+        # in chunks, a wide bbox over a full mirror matches more events than sqlite takes parameters
+        for start in range(0, len(ids), ID_CHUNK):
+            chunk = ids[start:start + ID_CHUNK]
+            for eid, data in self.db.execute(
+                    f"SELECT id, data FROM events WHERE id IN ({', '.join('?' * len(chunk))}) ORDER BY id", chunk):
+                event = json.loads(data)
+                event['geometry'] = [p for n, p in enumerate(event.get('geometry') or []) if n in matched[eid]]
+                found.append(event)
+        return found
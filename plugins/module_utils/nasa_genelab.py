@@ -0,0 +1,180 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Helpers for nasa_genelab: expanding GLDS study id ranges on the client, and
+# a local SQLite manifest of every study file seen (study id -> file urls,
+# with the metadata the files API returned and when it was last seen), so a
+# rerun only writes what is new or changed. Files downloaded and verified are
+# recorded too, so a rerun can skip them without hashing them again.
+#
+# The manifest doubles as a catalog: file name, study, size, category and date
+# are indexed, so a selection (file_pattern / file_category) is resolved
+# locally instead of walking the API again.
+
+import fnmatch
+import re
+import sqlite3
+
+from datetime import datetime, timezone
+
+# the metadata fields compared to decide a file changed
+FINGERPRINT = ('remote_url', 'file_size', 'date_created', 'date_modified', 'md5', 'checksum')
+
+
+def expand_study_ids(value):
+    """87-95,137 (or GLDS-87-GLDS-95) to a sorted list of unique study numbers"""
+    ids = set()
+    for part in str(value).split(','):
+        part = re.sub(r'(?i)glds-', '', part.strip())
+        if not part:
+            continue
+        m = re.match(r'^(\d+)(?:-(\d+))?$', part)
+        if not m:
+            raise ValueError(f"{part} is not a study id or a range of study ids")
+        low = int(m.group(1))
+        high = int(m.group(2) or low)
+        if high < low:
+            raise ValueError(f"the range {part} ends before it starts")
+        ids.update(range(low, high + 1))
+    return sorted(ids)
+
+
+def group_ids(ids, size):
+    """split study numbers into groups of at most size, each as the comma list the API takes"""
+    size = max(1, int(size))
+    return [','.join(str(i) for i in ids[n:n + size]) for n in range(0, len(ids), size)]
+
+
+def fingerprint(study_file):
+    return '|'.join(str(study_file.get(field, '')) for field in FINGERPRINT)
+
+
+def matches(study_file, file_pattern=None, file_category=None):
+    """the same test select() runs in SQL, file_pattern is a case sensitive glob, file_category ignores case"""
+    if file_pattern and not fnmatch.fnmatchcase(study_file.get('file_name') or '', file_pattern):
+        return False
+    if file_category and (study_file.get('category') or '').lower() != file_category.lower():
+        return False
+    return True
+
+
+class GenelabManifest(object):
+    """every study file seen so far, keyed on (study id, file name)"""
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS files (
+            study_id TEXT,
+            file_name TEXT,
+            url TEXT,
+            file_size INTEGER,
+            category TEXT,
+            date_created TEXT,
+            checksum TEXT,
+            fingerprint TEXT,
+            first_seen TEXT,
+            last_seen TEXT,
+            PRIMARY KEY (study_id, file_name)
+        )''',
+        'CREATE INDEX IF NOT EXISTS files_name ON files (file_name)',
+        'CREATE INDEX IF NOT EXISTS files_category ON files (category COLLATE NOCASE)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        '''CREATE TABLE IF NOT EXISTS downloads (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            digest TEXT
+        )''',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def update(self, study_id, study_files, root=''):
+        """record the files the API listed for one study
+
+        returns a dict of new, changed and removed file entries (dicts of
+        study_id, file_name and url). removed are files recorded for the
+        study before that the API no longer lists, they are dropped from
+        the manifest.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        known = dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            'SELECT file_name, fingerprint, url FROM files WHERE study_id = ?', (study_id,)))
+        diff = dict(new=[], changed=[], removed=[])
+        listed = set()
+        for study_file in study_files:
+            name = study_file.get('file_name') or study_file.get('remote_url')
+            listed.add(name)
+            url = f"{root}{study_file.get('remote_url')}"
+            entry = dict(study_id=study_id, file_name=name, url=url)
+            fp = fingerprint(study_file)
+            if name not in known:
+                diff['new'].append(entry)
+                self.db.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (study_id, name, url, study_file.get('file_size'), study_file.get('category'),
+                                 study_file.get('date_created'), study_file.get('md5') or study_file.get('checksum'),
+                                 fp, now, now))
+                continue
+            if known[name][0] != fp:
+                diff['changed'].append(entry)
+                self.db.execute('UPDATE files SET url = ?, file_size = ?, category = ?, date_created = ?, checksum = ?, '
+                                'fingerprint = ?, last_seen = ? WHERE study_id = ? AND file_name = ?',
+                                (url, study_file.get('file_size'), study_file.get('category'), study_file.get('date_created'),
+                                 study_file.get('md5') or study_file.get('checksum'), fp, now, study_id, name))
+            else:
+                self.db.execute('UPDATE files SET last_seen = ? WHERE study_id = ? AND file_name = ?', (now, study_id, name))
+        for name in sorted(set(known) - listed):
+            diff['removed'].append(dict(study_id=study_id, file_name=name, url=known[name][1]))
+            self.db.execute('DELETE FROM files WHERE study_id = ? AND file_name = ?', (study_id, name))
+        self.db.commit()
+        return diff
+
+    def verified(self, path, size, mtime, digest=None):
+        """True when path was verified before and has not been touched since"""
+        row = self.db.execute('SELECT size, mtime, digest FROM downloads WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            return False
+        return not digest or (row[2] or '').lower() == digest.lower()
+
+    def mark_verified(self, path, size, mtime, digest):
+        self.db.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?)', (path, size, mtime, digest))
+        self.db.commit()
+
+    def select(self, study_ids=None, file_pattern=None, file_category=None, root=''):
+        """the recorded files matching every filter given, as (study id, study file) ordered by study and name
+
+        study files are rebuilt the way the files API lists them (file_name,
+        remote_url, file_size, category, date_created, md5), root is stripped
+        off the stored url to get remote_url back
+        """
+        where, args = [], []
+        if study_ids:
+            where.append(f"study_id IN ({', '.join('?' * len(study_ids))})")
+            args.extend(study_ids)
+        if file_pattern:
+            where.append('file_name GLOB ?')
+            args.append(file_pattern)
+        if file_category:
+            where.append('category = ? COLLATE NOCASE')
+            args.append(file_category)
+        sql = 'SELECT study_id, file_name, url, file_size, category, date_created, checksum FROM files'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        selected = []
+        for study_id, name, url, size, category, created, checksum in self.db.execute(sql + ' ORDER BY study_id, file_name', args):
+            remote_url = url[len(root):] if root and url.startswith(root) else url
+            selected.append((study_id, dict(file_name=name, remote_url=remote_url, file_size=size, category=category,
+                                            date_created=created, md5=checksum)))
+        return selected
@@ -0,0 +1,215 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# A content-addressed store for the images pulled by nasa_apod and nasa_earth.
+#
+# The layout on disk is:
+#   <store>/objects/<first 2 chars of sha256>/<sha256>   the image bytes
+#   <store>/urls/<sha256 of the source url>              the sha256 of the image that url returned
+#   <store>/tmp/<sha256 of the source url>.part          a download in progress (resumable)
+#   <store>/tmp/<sha256 of the source url>.part.validator its ETag / Last-Modified
+#
+# An image that is already in the store is placed at dest with a hard link
+# (or a reflink / copy when dest is on another filesystem), so it is never
+# downloaded twice. The store can be shared by many tasks on the same host.
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_download import DownloadError, download
+
+# query parameters that change per user, but never change the image returned
+IGNORED_PARAMS = ('api_key',)
+
+# linux ioctl used to reflink (copy-on-write clone) a file on btrfs / xfs
+FICLONE = 0x40049409
+
+
+def url_key(url):
+    """sha256 of the source url, ignoring the api_key so every user shares the same entry"""
+    parsed = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k not in IGNORED_PARAMS]
+    clean = urlunparse(parsed._replace(query=urlencode(sorted(query))))
+    return hashlib.sha256(clean.encode()).hexdigest()
+
+
+def _reflink(src, dest):
+    """try a copy-on-write clone of src to dest, returns False if the filesystem can't"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dest)
+            return False
+    return True
+
+
+class ImageStore(object):
+    """content-addressed image store with size based eviction"""
+
+    def __init__(self, path, max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes  # 0 means the store is never trimmed
+        self.objects = os.path.join(path, 'objects')
+        self.urls = os.path.join(path, 'urls')
+        self.tmp = os.path.join(path, 'tmp')
+        for d in (self.objects, self.urls, self.tmp):
+            if not os.path.isdir(d):
+                os.makedirs(d, exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def lookup(self, url):
+        """return the digest stored for url, or None if the image is not in the store"""
+        try:
+            with open(os.path.join(self.urls, url_key(url))) as f:
+                digest = f.read().strip()
+        except (IOError, OSError):
+            return None
+        # the object may have been evicted since the url was recorded
+        if not digest or not os.path.isfile(self.object_path(digest)):
+            return None
+        return digest
+
+    def _write_atomic(self, path, data):
+        """write data next to path, then rename it into place so readers never see half a file"""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def part_path(self, url):
+        """where a download of url is streamed to, stable across runs so it can be resumed"""
+        return os.path.join(self.tmp, f"{url_key(url)}.part")
+
+    def add_file(self, url, path, digest):
+        """move a verified download at path into the store as the image returned by url"""
+        obj = self.object_path(digest)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        # hard links handed out share this mode
+        os.chmod(path, 0o644)
+        if os.path.isfile(obj):
+            os.unlink(path)
+        else:
+            os.replace(path, obj)
+        self._write_atomic(os.path.join(self.urls, url_key(url)), digest.encode())
+        self.evict(keep=digest)
+        return digest
+
+    def materialize(self, digest, dest):
+        """place the stored image at dest
+
+        returns 'present' if dest already is that image, otherwise the method
+        used to put it there ('hardlink', 'reflink' or 'copy')
+        """
+        obj = self.object_path(digest)
+        # mark the object as recently used, eviction removes the oldest first
+        os.utime(obj, None)
+
+        if os.path.exists(dest) and os.path.samefile(obj, dest):
+            return 'present'
+
+        tmp = os.path.join(os.path.dirname(os.path.abspath(dest)), f".{os.path.basename(dest)}.{digest[:12]}")
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            os.link(obj, tmp)
+            method = 'hardlink'
+        except OSError as err:
+            # EXDEV is a different filesystem, EPERM / EMLINK are filesystems that refuse links
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            if _reflink(obj, tmp):
+                method = 'reflink'
+            else:
+                shutil.copyfile(obj, tmp)
+                method = 'copy'
+        os.replace(tmp, dest)
+        return method
+
+    def size(self):
+        """total bytes used by every object in the store"""
+        return sum(size for _, size, _ in self._objects())
+
+    def _objects(self):
+        for root, _, files in os.walk(self.objects):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                yield p, st.st_size, st.st_mtime
+
+    def evict(self, keep=None):
+        """remove the least recently used objects until the store fits in max_bytes
+
+        url entries pointing at an evicted object are ignored by lookup(), so
+        they are left alone. Hard links already handed out keep their data.
+        """
+        if not self.max_bytes:
+            return []
+        objects = sorted(self._objects(), key=lambda o: o[2])
+        total = sum(size for _, size, _ in objects)
+        evicted = []
+        for p, size, _ in objects:
+            if total <= self.max_bytes:
+                break
+            if keep and os.path.basename(p) == keep:
+                continue
+            try:
+                os.unlink(p)
+            except OSError:
+                continue
+            total -= size
+            evicted.append(os.path.basename(p))
+        return evicted
+
+
+def save_image(url, dest, store=None):
+    """download the image at url to dest, going through the store when one is given
+
+    returns a dict with status ('downloaded', 'cached' or 'failed'), msg,
+    digest, method (how dest was written) and download (the transfer statistics)
+    """
+    item = dict(status='failed', msg='', digest='', method='', download={})
+
+    # an image we have seen before never touches the network
+    if store is not None:
+        digest = store.lookup(url)
+        if digest:
+            item.update(status='cached', digest=digest, method=store.materialize(digest, dest))
+            return item
+
+    try:
+        if store is not None:
+            # stream into the store, then link the stored image to dest
+            part = store.part_path(url)
+            stats = download(url, part + '.done', part=part)
+            store.add_file(url, part + '.done', stats['digest'])
+            item['method'] = store.materialize(stats['digest'], dest)
+        else:
+            stats = download(url, dest)
+            item['method'] = 'write'
+    except (DownloadError, OSError) as err:
+        # the store could not take the image, or dest could not be written
+        item['msg'] = str(err)
+        return item
+
+    item.update(status='downloaded', digest=stats['digest'], download=stats)
+    return item
@@ -0,0 +1,304 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Close-approach analytics over a NEOW feed, and a local mirror of the NEOW
+# browse catalog, used by nasa_neow.
+#
+# Every close_approach_data entry of the feed is flattened into columns
+# (one array per field). With NumPy installed the summary is computed on
+# numpy arrays, otherwise the stdlib array module and heapq are used. Both
+# paths return exactly the same summary.
+
+import heapq
+import json
+import sqlite3
+import zlib
+
+from array import array
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_words import PREFIX_END, name_words
+
+# python3 -m pip install numpy (optional, only makes the summary faster)
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class CloseApproaches(object):
+    """columnar view of every close approach in a NEOW feed"""
+
+    def __init__(self):
+        # one entry per close approach
+        self.obj = array('l')         # index into self.ids / self.names
+        self.day = array('l')         # index into self.days
+        self.miss_km = array('d')
+        self.velocity_kps = array('d')
+        # one entry per object
+        self.ids = []
+        self.names = []
+        self.hazardous = array('b')
+        self.diameter_km = array('d')  # mean of the min / max estimated diameter
+        # one entry per day
+        self.days = []
+
+    @classmethod
+    def from_feed(cls, feed):
+        ca = cls()
+        objects = {}
+        days = {}
+        for feedday in sorted(feed.get('near_earth_objects', {})):
+            days.setdefault(feedday, len(days))
+            for neo in feed['near_earth_objects'][feedday]:
+                oid = neo.get('id') or neo.get('neo_reference_id')
+                if oid not in objects:
+                    objects[oid] = len(ca.ids)
+                    ca.ids.append(oid)
+                    ca.names.append(neo.get('name', ''))
+                    ca.hazardous.append(1 if neo.get('is_potentially_hazardous_asteroid') else 0)
+                    km = neo.get('estimated_diameter', {}).get('kilometers', {})
+                    ca.diameter_km.append((_float(km.get('estimated_diameter_min')) + _float(km.get('estimated_diameter_max'))) / 2)
+                for approach in neo.get('close_approach_data', []):
+                    day = approach.get('close_approach_date', feedday)
+                    days.setdefault(day, len(days))
+                    ca.obj.append(objects[oid])
+                    ca.day.append(days[day])
+                    ca.miss_km.append(_float(approach.get('miss_distance', {}).get('kilometers')))
+                    ca.velocity_kps.append(_float(approach.get('relative_velocity', {}).get('kilometers_per_second')))
+        ca.days = list(days)
+        return ca
+
+    def __len__(self):
+        return len(self.miss_km)
+
+    def _row(self, i):
+        """one close approach as a dict, missing values (NaN) become None so the result stays valid JSON"""
+        o = self.obj[i]
+        miss = self.miss_km[i]
+        vel = self.velocity_kps[i]
+        return dict(
+            id=self.ids[o],
+            name=self.names[o],
+            date=self.days[self.day[i]],
+            miss_distance_km=None if miss != miss else miss,
+            velocity_kps=None if vel != vel else vel,
+            hazardous=bool(self.hazardous[o]),
+        )
+
+    def summary(self, top_k=5, use_numpy=None):
+        """top_k nearest misses and fastest approaches, hazardous counts per day and diameter statistics"""
+        if use_numpy is None:
+            use_numpy = HAS_NUMPY
+        if use_numpy and not HAS_NUMPY:
+            raise ImportError("numpy is not installed")
+        calc = self._numpy if use_numpy else self._python
+        nearest, fastest, per_day, diameter = calc(max(0, int(top_k)))
+        return dict(
+            backend='numpy' if use_numpy else 'array',
+            objects=len(self.ids),
+            close_approaches=len(self),
+            hazardous_objects=sum(self.hazardous),
+            nearest_misses=[self._row(i) for i in nearest],
+            fastest=[self._row(i) for i in fastest],
+            hazardous_per_day=dict(sorted(zip(self.days, per_day))),
+            diameter_km=diameter,
+        )
+
+    def _numpy(self, k):
+        n = len(self)
+        miss = np.frombuffer(self.miss_km, dtype=np.float64) if n else np.empty(0)
+        vel = np.frombuffer(self.velocity_kps, dtype=np.float64) if n else np.empty(0)
+        # NaN (missing values) sort last for nearest, and never win fastest
+        miss = np.where(np.isnan(miss), np.inf, miss)
+        vel = np.where(np.isnan(vel), -np.inf, vel)
+
+        def smallest(col):
+            kk = min(k, n)
+            if kk == 0:
+                return []
+            if kk < n:
+                # partition to find the k-th value, then keep everything up to it so
+                # ties at the cut off are broken on position, same as the python path
+                cutoff = col[np.argpartition(col, kk - 1)[kk - 1]]
+                idx = np.flatnonzero(col <= cutoff)
+            else:
+                idx = np.arange(n)
+            return idx[np.lexsort((idx, col[idx]))][:kk].tolist()
+
+        nearest = smallest(miss)
+        fastest = smallest(-vel)
+
+        # an approach counts for its day when its object is potentially hazardous
+        obj = np.frombuffer(self.obj, dtype=self.obj.typecode) if n else np.empty(0, dtype=np.int64)
+        day = np.frombuffer(self.day, dtype=self.day.typecode) if n else np.empty(0, dtype=np.int64)
+        haz = np.frombuffer(self.hazardous, dtype=np.int8).astype(bool) if len(self.ids) else np.empty(0, dtype=bool)
+        per_day = np.bincount(day[haz[obj]], minlength=len(self.days)).tolist() if n else [0] * len(self.days)
+
+        diam = np.frombuffer(self.diameter_km, dtype=np.float64) if len(self.ids) else np.empty(0)
+        diam = diam[~np.isnan(diam)]
+        if diam.size:
+            diameter = dict(count=int(diam.size), min=float(diam.min()), max=float(diam.max()),
+                            mean=float(diam.mean()), median=float(np.median(diam)))
+        else:
+            diameter = dict(count=0, min=None, max=None, mean=None, median=None)
+        return nearest, fastest, per_day, diameter
+
+    def _python(self, k):
+        n = len(self)
+        inf = float('inf')
+        miss = [inf if m != m else m for m in self.miss_km]
+        vel = [-inf if v != v else v for v in self.velocity_kps]
+        nearest = heapq.nsmallest(k, range(n), key=lambda i: (miss[i], i))
+        fastest = heapq.nsmallest(k, range(n), key=lambda i: (-vel[i], i))
+
+        per_day = [0] * len(self.days)
+        for o, d in zip(self.obj, self.day):
+            if self.hazardous[o]:
+                per_day[d] += 1
+
+        diam = sorted(d for d in self.diameter_km if d == d)
+        if diam:
+            mid = len(diam) // 2
+            median = diam[mid] if len(diam) % 2 else (diam[mid - 1] + diam[mid]) / 2
+            diameter = dict(count=len(diam), min=diam[0], max=diam[-1],
+                            mean=sum(diam) / len(diam), median=median)
+        else:
+            diameter = dict(count=0, min=None, max=None, mean=None, median=None)
+        return nearest, fastest, per_day, diameter
+
+
+def summarize_feed(feed, top_k=5, use_numpy=None):
+    """flatten a NEOW feed and return the close approach summary"""
+    return CloseApproaches.from_feed(feed).summary(top_k=top_k, use_numpy=use_numpy)
+
+
+class NeoCatalog(object):
+    """local mirror of the NEOW browse catalog, kept in SQLite
+
+    Each object is stored once, as zlib compressed JSON, next to the columns
+    that are indexed for lookups (neo_reference_id, hazardous flag and orbit
+    class). Every word of every name is indexed too, so a name is looked up
+    with prefix range scans instead of reading the whole table. The pages
+    mirrored by a run are recorded until the run completes, so an
+    interrupted mirror resumes where it stopped and a complete one starts
+    over the next time.
+    """
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS neos (
+            neo_reference_id TEXT PRIMARY KEY,
+            name TEXT,
+            hazardous INTEGER,
+            orbit_class TEXT,
+            absolute_magnitude REAL,
+            diameter_min_km REAL,
+            diameter_max_km REAL,
+            data BLOB
+        )''',
+        '''CREATE TABLE IF NOT EXISTS words (
+            word TEXT,
+            neo_reference_id TEXT,
+            PRIMARY KEY (word, neo_reference_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS neos_hazardous ON neos (hazardous)',
+        'CREATE INDEX IF NOT EXISTS neos_orbit_class ON neos (orbit_class)',
+        'CREATE TABLE IF NOT EXISTS pages (page INTEGER PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        new_words = not self.db.execute("SELECT name FROM sqlite_master WHERE name = 'words'").fetchone()
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        if new_words:
+            # a catalog mirrored before names were indexed by word, index what is already in it
+            for oid, name in self.db.execute('SELECT neo_reference_id, name FROM neos').fetchall():
+                self._index_name(oid, name)
+        self.db.commit()
+
+    def _index_name(self, oid, name):
+        self.db.execute('DELETE FROM words WHERE neo_reference_id = ?', (oid,))
+        self.db.executemany('INSERT OR IGNORE INTO words VALUES (?, ?)', [(word, oid) for word in name_words(name)])
+
+    def close(self):
+        self.db.close()
+
+    def done_pages(self):
+        return set(row[0] for row in self.db.execute('SELECT page FROM pages'))
+
+    def reset_pages(self):
+        """forget which pages were mirrored (the run completed, or refresh), the next mirror fetches everything again"""
+        self.db.execute('DELETE FROM pages')
+        self.db.commit()
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def add_page(self, page, neos):
+        """store the objects of one browse page, returns how many rows were new or changed"""
+        changed = 0
+        for neo in neos:
+            oid = neo.get('neo_reference_id') or neo.get('id')
+            km = neo.get('estimated_diameter', {}).get('kilometers', {})
+            data = zlib.compress(json.dumps(neo, sort_keys=True, separators=(',', ':')).encode())
+            row = self.db.execute('SELECT data FROM neos WHERE neo_reference_id = ?', (oid,)).fetchone()
+            if row and row[0] == data:
+                continue
+            self.db.execute(
+                'INSERT OR REPLACE INTO neos VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (oid, neo.get('name'), 1 if neo.get('is_potentially_hazardous_asteroid') else 0,
+                 neo.get('orbital_data', {}).get('orbit_class', {}).get('orbit_class_type'),
+                 neo.get('absolute_magnitude_h'), km.get('estimated_diameter_min'),
+                 km.get('estimated_diameter_max'), data))
+            self._index_name(oid, neo.get('name'))
+            changed += 1
+        self.db.execute('INSERT OR IGNORE INTO pages (page) VALUES (?)', (page,))
+        self.db.commit()
+        return changed
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM neos').fetchone()[0]
+
+    def lookup(self, neo_id=None, name=None, hazardous=None, orbit_class=None, limit=100):
+        """return the stored objects matching every filter given
+
+        name matches when every word of it starts a word of the object name,
+        ignoring case (eros finds 433 Eros (A898 PA), 2010 pk finds (2010 PK9))
+        """
+        where, args = [], []
+        if neo_id:
+            where.append('neo_reference_id = ?')
+            args.append(str(neo_id))
+        for word in name_words(name) if name else []:
+            where.append('neo_reference_id IN (SELECT neo_reference_id FROM words WHERE word >= ? AND word < ?)')
+            args.extend([word, word + PREFIX_END])
+        if hazardous is not None:
+            where.append('hazardous = ?')
+            args.append(1 if hazardous else 0)
+        if orbit_class:
+            where.append('orbit_class = ?')
+            args.append(orbit_class.upper())
+        sql = 'SELECT data FROM neos'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY neo_reference_id'
+        if limit:
+            sql += ' LIMIT ?'
+            args.append(int(limit))
+        return [json.loads(zlib.decompress(row[0])) for row in self.db.execute(sql, args)]
@@ -0,0 +1,254 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Ground station pass prediction for many observers and many TLEs at once,
+# used by nasa_tle.
+#
+# Every satellite is propagated once over the time grid, its TEME positions
+# are turned into Earth fixed ones (rotated by the Greenwich mean sidereal
+# time), and the elevation of every satellite x time above every observer
+# comes out of two matrix products against the observers' positions and
+# local vertical, instead of one scalar look angle per observer, satellite
+# and time. A pass is a run of steps above the minimum elevation, its rise
+# and set are then found by false position (the Illinois variant) between the
+# two steps around them and its culmination by a golden section search, every
+# pass at once.
+#
+# The satellites are split into batches, spread over a pool of processes
+# when the observers x satellites x times matrix is large.
+
+import math
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_sgp4 import GOLDEN, ElementSets, golden_section
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import default_processes, process_pool
+
+# python3 -m pip install numpy
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# WGS-84, the ellipsoid the observers' latitude, longitude and altitude are given on
+WGS84_A = 6378.137
+WGS84_F = 1.0 / 298.257223563
+
+# how many satellite x time x observer cells one batch holds, bounds the memory
+# used by the elevation arrays (a handful of them, 8 bytes per cell)
+BATCH_CELLS = 1 << 21
+
+# below this many cells the matrix is predicted in this process, a pool costs more than it saves
+POOL_CELLS = 1 << 24
+
+# false position steps for rise and set, each step about squares the error of a linear guess between two steps
+CROSSING_ITERATIONS = 6
+
+# the golden section search for the culmination stops when the time is known to this many seconds
+CULMINATION_TOLERANCE = 0.1
+
+
+def gmst(times):
+    """the Greenwich mean sidereal time (radians, IAU 1982) at times (POSIX timestamps), UT1 taken as UTC"""
+    t = (np.asarray(times, dtype=np.float64) / 86400.0 + 2440587.5 - 2451545.0) / 36525.0
+    seconds = 67310.54841 + (876600.0 * 3600.0 + 8640184.812866) * t + 0.093104 * t * t - 6.2e-6 * t * t * t
+    return np.mod(seconds * 2.0 * math.pi / 86400.0, 2.0 * math.pi)
+
+
+def teme_to_ecef(r, times):
+    """TEME positions r (..., 3) at times (broadcasting against r[..., 0]) rotated into the Earth fixed frame
+
+    polar motion (a few metres) is left out
+    """
+    g = gmst(times)
+    cos, sin = np.cos(g), np.sin(g)
+    x, y = r[..., 0], r[..., 1]
+    return np.stack((cos * x + sin * y, cos * y - sin * x, r[..., 2]), axis=-1)
+
+
+def observer_frames(latitudes, longitudes, altitudes):
+    """the Earth fixed position (km) and local up, east and north unit vectors of every observer
+
+    latitudes and longitudes are geodetic degrees, altitudes km above the
+    WGS-84 ellipsoid. returns four (observers, 3) arrays
+    """
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    alt = np.asarray(altitudes, dtype=np.float64)
+    e2 = WGS84_F * (2.0 - WGS84_F)
+    n = WGS84_A / np.sqrt(1.0 - e2 * np.sin(lat) ** 2)
+    position = np.stack(((n + alt) * np.cos(lat) * np.cos(lon), (n + alt) * np.cos(lat) * np.sin(lon),
+                         (n * (1.0 - e2) + alt) * np.sin(lat)), axis=-1)
+    up = np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=-1)
+    east = np.stack((-np.sin(lon), np.cos(lon), np.zeros_like(lon)), axis=-1)
+    north = np.stack((-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)), axis=-1)
+    return position, up, east, north
+
+
+def _line_of_sight(sets, rows, frames, observers, times):
+    """the Earth fixed vector (km) from observer observers[n] to satellite rows[n] at times[n], for every n"""
+    r, _, _ = sets.propagate_at(rows, times)
+    return teme_to_ecef(r, times) - frames[0][observers]
+
+
+def sin_elevation(sets, rows, frames, observers, times):
+    """the sine of the elevation of satellite rows[n] from observer observers[n] at times[n], for every n"""
+    rho = _line_of_sight(sets, rows, frames, observers, times)
+    return np.einsum('ij,ij->i', rho, frames[1][observers]) / np.linalg.norm(rho, axis=1)
+
+
+def look(sets, rows, frames, observers, times):
+    """the elevation and azimuth (radians) of satellite rows[n] from observer observers[n] at times[n], for every n
+
+    an error (a decayed satellite) comes back as NaN
+    """
+    position, up, east, north = frames
+    rho = _line_of_sight(sets, rows, frames, observers, times)
+    elevation = np.arcsin(np.einsum('ij,ij->i', rho, up[observers]) / np.linalg.norm(rho, axis=1))
+    azimuth = np.mod(np.arctan2(np.einsum('ij,ij->i', rho, east[observers]),
+                                np.einsum('ij,ij->i', rho, north[observers])), 2.0 * math.pi)
+    return elevation, azimuth
+
+
+def _crossing(sets, rows, frames, observers, a, b, fa, fb, horizon):
+    """the time between a and b the elevation crosses horizon, fa and fb the sine of the elevation at a and b
+
+    false position (the Illinois variant), the horizon lies between fa and fb
+    """
+    target = math.sin(horizon)
+    a, b, fa, fb = a.copy(), b.copy(), fa - target, fb - target
+    c = b
+    for _ in range(CROSSING_ITERATIONS):
+        slope = fb - fa
+        c = np.where(slope != 0, b - fb * (b - a) / np.where(slope != 0, slope, 1.0), (a + b) / 2.0)
+        fc = sin_elevation(sets, rows, frames, observers, c) - target
+        # a stays the far end while it keeps being kept, halving its value keeps the guesses from stalling there
+        kept = fc * fb > 0
+        fa = np.where(kept, fa / 2.0, fb)
+        a = np.where(kept, a, b)
+        b, fb = c, fc
+    return c
+
+
+def predict_batch(job):
+    """predict the passes of one batch of satellites over every observer, run in a worker process
+
+    job is (tles, times, frames, minimum elevation radians). returns
+    (satellite, observer, rise, culmination, set, max elevation, rise
+    azimuth, set azimuth) arrays, satellite indexes tles, rise and set are
+    NaN when the pass began before or ended after the window
+    """
+    tles, times, frames, horizon = job
+    position, up = frames[0], frames[1]
+    n_time, n_obs = len(times), len(position)
+    # rho . up / |rho| with rho = r - p is (r . u - p . u) / sqrt(r . r - 2 r . p + p . p)
+    pu = np.einsum('ij,ij->i', position, up)
+    pp = np.einsum('ij,ij->i', position, position)
+
+    found = [[] for _ in range(8)]
+    size = max(1, BATCH_CELLS // max(n_time * n_obs, 1))
+    for first in range(0, len(tles), size):
+        sets = ElementSets(tles[first:first + size])
+        n_sat = len(sets)
+        r = teme_to_ecef(sets.propagate(times)[0], times[None, :]).reshape(-1, 3)
+        with np.errstate(invalid='ignore'):
+            grid = (r @ up.T - pu) / np.sqrt(np.einsum('ij,ij->i', r, r)[:, None] - 2.0 * (r @ position.T) + pp)
+        # (satellites, observers, times), a NaN (decayed) is below the horizon
+        grid = grid.reshape(n_sat, n_time, n_obs).transpose(0, 2, 1)
+        over = np.zeros((n_sat, n_obs, n_time + 2), dtype=np.int8)
+        with np.errstate(invalid='ignore'):
+            over[:, :, 1:-1] = grid > math.sin(horizon)
+        steps = np.diff(over, axis=2)
+        # both come back ordered by satellite, observer, step, so the n-th start and the n-th end are the same pass
+        sat, obs, start = np.nonzero(steps == 1)
+        end = np.nonzero(steps == -1)[2]
+        if not sat.size:
+            continue
+
+        # the step with the highest elevation of each pass
+        length = np.arange(int((end - start).max()))
+        index = np.minimum(start[:, None] + length, end[:, None] - 1)
+        peak = start + np.argmax(grid[sat[:, None], obs[:, None], index], axis=1)
+        grid_best = np.arcsin(grid[sat, obs, peak])
+
+        low, high = times[np.maximum(peak - 1, 0)], times[np.minimum(peak + 1, n_time - 1)]
+        span = max(float(np.max(high - low)), CULMINATION_TOLERANCE)
+        culmination = golden_section(lambda t: -sin_elevation(sets, sat, frames, obs, t), low, high,
+                                     int(math.ceil(math.log(span / CULMINATION_TOLERANCE) / -math.log(GOLDEN))))
+        best = np.arcsin(sin_elevation(sets, sat, frames, obs, culmination))
+        # the search stays between the steps around the peak, keep the peak step when it did no better
+        worse = ~(best >= grid_best)
+        culmination[worse], best[worse] = times[peak[worse]], grid_best[worse]
+
+        rise, rise_azimuth = np.full(sat.size, np.nan), np.full(sat.size, np.nan)
+        rises = start > 0
+        rise[rises] = _crossing(sets, sat[rises], frames, obs[rises], times[start[rises] - 1], times[start[rises]],
+                                grid[sat[rises], obs[rises], start[rises] - 1],
+                                grid[sat[rises], obs[rises], start[rises]], horizon)
+        rise_azimuth[rises] = look(sets, sat[rises], frames, obs[rises], rise[rises])[1]
+        setting, set_azimuth = np.full(sat.size, np.nan), np.full(sat.size, np.nan)
+        down = end < n_time
+        setting[down] = _crossing(sets, sat[down], frames, obs[down], times[end[down] - 1], times[end[down]],
+                                  grid[sat[down], obs[down], end[down] - 1],
+                                  grid[sat[down], obs[down], end[down]], horizon)
+        set_azimuth[down] = look(sets, sat[down], frames, obs[down], setting[down])[1]
+
+        for n, value in enumerate((first + sat, obs, rise, culmination, setting, best, rise_azimuth, set_azimuth)):
+            found[n].append(value)
+    return tuple(np.concatenate(part) if part else np.empty(0) for part in found)
+
+
+def predict(tles, times, observers, min_elevation=0.0, processes=None, batches_per_process=4):
+    """every pass of every TLE over every observer within times (POSIX timestamps, evenly spaced)
+
+    observers is a list of (latitude, longitude, altitude km). returns
+    (passes, statistics). passes are dicts of observer and satellite
+    (indices into observers and tles), rise, culmination and set (POSIX
+    timestamps, None when the pass began before or ended after the window),
+    max_elevation, rise_azimuth and set_azimuth (degrees), ordered by rise.
+    A pass shorter than a step, low on the horizon, can fall between two
+    steps and be missed.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    sets = ElementSets(tles)
+    # deep space and unreadable TLEs are never propagated
+    rows = np.flatnonzero(sets.error == 0)
+    stats = dict(observers=len(observers), satellites=len(tles), predicted=int(rows.size), steps=int(times.size))
+    if not rows.size or not times.size or not observers:
+        return [], stats
+
+    latitudes, longitudes, altitudes = zip(*observers)
+    frames = observer_frames(latitudes, longitudes, altitudes)
+    horizon = math.radians(min_elevation)
+    subset = [tles[n] for n in rows]
+    processes = max(1, int(processes or default_processes()))
+    cells = rows.size * times.size * len(observers)
+    count = min(rows.size, processes * batches_per_process) if processes > 1 and cells > POOL_CELLS else 1
+    bounds = np.linspace(0, rows.size, count + 1).astype(int)
+    jobs = [(subset[bounds[n]:bounds[n + 1]], times, frames, horizon) for n in range(count) if bounds[n + 1] > bounds[n]]
+    if len(jobs) > 1:
+        with process_pool(min(processes, len(jobs))) as pool:
+            parts = list(pool.map(predict_batch, jobs))
+    else:
+        parts = [predict_batch(job) for job in jobs]
+    # back from the batch to the index into tles
+    for n, part in enumerate(parts):
+        if part[0].size:
+            part[0][:] = rows[bounds[n] + part[0].astype(np.intp)]
+    sat, obs, rise, culmination, setting, best, rise_azimuth, set_azimuth = (
+        np.concatenate([part[n] for part in parts]) for n in range(8))
+
+    def values(array, convert=None):
+        """a list of floats, None where NaN (NaN is not JSON)"""
+        return [None if value != value else value for value in (convert(array) if convert else array).tolist()]
+
+    # a pass already up when the window opens sorts by its culmination
+    order = np.lexsort((obs, np.where(np.isnan(rise), culmination, rise)))
+    columns = (obs[order].astype(int).tolist(), sat[order].astype(int).tolist(), values(rise[order]),
+               culmination[order].tolist(), values(setting[order]), np.degrees(best[order]).tolist(),
+               values(rise_azimuth[order], np.degrees), values(set_azimuth[order], np.degrees))
+    fields = ('observer', 'satellite', 'rise', 'culmination', 'set', 'max_elevation', 'rise_azimuth', 'set_azimuth')
+    passes = [dict(zip(fields, row)) for row in zip(*columns)]
+    stats['passes'] = len(passes)
+    return passes, stats
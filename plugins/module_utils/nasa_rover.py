@@ -0,0 +1,205 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Helpers for nasa_mars_rover_photos: the rover manifest (photo counts and
+# cameras for every sol) cached on disk, and planning a range of sols or
+# Earth dates from it so only the lookups that return photos are sent, with
+# exactly as many pages as there are photos.
+#
+# A local SQLite index of every photo seen (id, rover, sol, camera, Earth
+# date, img_src) and, once downloaded, where it was saved and its digest, so
+# a rerun skips the images already fetched and "every NAVCAM photo of sols
+# 1000 to 1100" is answered without the API.
+
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import time
+
+# the API answers this many photos per page
+PAGE_SIZE = 25
+
+
+def cache_path(name):
+    """name in the per-user cache directory ($XDG_CACHE_HOME or ~/.cache, then rzfeeser.nasa_api), created private"""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    directory = os.path.join(root, 'rzfeeser.nasa_api')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def load_manifest(path, max_age, fetch):
+    """the photo_manifest of a rover, from the cache at path when it is younger than max_age seconds
+
+    fetch() is called to look it up otherwise, the answer is written to path
+    returns (manifest, True when it came from the cache)
+    """
+    try:
+        if time.time() - os.path.getmtime(path) < max_age:
+            with open(path) as f:
+                return json.load(f), True
+    except (OSError, ValueError):
+        pass
+    manifest = fetch()
+    # a fresh, uniquely named temporary file, never one someone else could have planted a link at
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.manifest-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return manifest, False
+
+
+def plan_lookups(manifest, days, camera=None, all_pages=True):
+    """the lookups needed for days, as (key, value, page, follow) jobs
+
+    follow is True when the number of pages is not known (a camera was
+    asked for, the manifest only lists which cameras took photos, or the
+    day is newer than the manifest), then the next page is asked for
+    whenever a page comes back full. Days the manifest says have no photos
+    (for that camera) are left out.
+    """
+    by_sol = dict((entry.get('sol'), entry) for entry in manifest.get('photos', []))
+    by_date = dict((entry.get('earth_date'), entry) for entry in manifest.get('photos', []))
+    max_sol = manifest.get('max_sol')
+    max_date = manifest.get('max_date') or (max(by_date) if by_date else None)
+
+    jobs = []
+    for key, value in days:
+        if key == 'sol':
+            entry = by_sol.get(int(value))
+            newer = max_sol is None or int(value) > int(max_sol)
+        else:
+            entry = by_date.get(value)
+            newer = max_date is None or value > max_date
+        if entry is None:
+            if newer:
+                # the manifest was cached before this day, probe it the old way
+                jobs.append((key, value, 1, all_pages))
+            continue
+        if camera:
+            if camera.upper() not in [c.upper() for c in entry.get('cameras', [])]:
+                continue
+            jobs.append((key, value, 1, all_pages))
+            continue
+        pages = int(math.ceil(int(entry.get('total_photos') or 0) / float(PAGE_SIZE))) if all_pages else 1
+        jobs.extend((key, value, page, False) for page in range(1, max(pages, 1) + 1))
+    return jobs
+
+
+def camera_name(photo):
+    camera = photo.get('camera')
+    return (camera.get('name') if isinstance(camera, dict) else camera) or ''
+
+
+def rover_name(photo):
+    rover = photo.get('rover')
+    return ((rover.get('name') if isinstance(rover, dict) else rover) or '').lower()
+
+
+class RoverPhotoIndex(object):
+    """every photo seen so far, keyed on photo id, with where it was downloaded to"""
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS photos (
+            id INTEGER PRIMARY KEY,
+            rover TEXT,
+            sol INTEGER,
+            camera TEXT,
+            earth_date TEXT,
+            img_src TEXT,
+            path TEXT,
+            bytes INTEGER,
+            digest TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS photos_camera_sol ON photos (rover, camera, sol)',
+        'CREATE INDEX IF NOT EXISTS photos_sol ON photos (rover, sol)',
+        'CREATE INDEX IF NOT EXISTS photos_earth_date ON photos (rover, earth_date)',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM photos').fetchone()[0]
+
+    def add(self, photos):
+        """record the metadata of photos, a photo already downloaded keeps its path and digest
+
+        returns how many photos were not seen before
+        """
+        new = 0
+        for photo in photos:
+            args = (rover_name(photo), photo.get('sol'), camera_name(photo).upper(), photo.get('earth_date'),
+                    photo.get('img_src'), photo.get('id'))
+            cur = self.db.execute('UPDATE photos SET rover = ?, sol = ?, camera = ?, earth_date = ?, img_src = ? '
+                                  'WHERE id = ?', args)
+            if not cur.rowcount:
+                self.db.execute('INSERT INTO photos (rover, sol, camera, earth_date, img_src, id) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', args)
+                new += 1
+        self.db.commit()
+        return new
+
+    def fetched(self, photo_id):
+        """(path, bytes, digest) of a photo downloaded before, or None"""
+        row = self.db.execute('SELECT path, bytes, digest FROM photos WHERE id = ? AND path IS NOT NULL',
+                              (photo_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def mark_fetched(self, photo_id, path, size, digest):
+        self.db.execute('UPDATE photos SET path = ?, bytes = ?, digest = ? WHERE id = ?', (path, size, digest, photo_id))
+        self.db.commit()
+
+    def query(self, rover=None, camera=None, sol_start=None, sol_end=None, date_start=None, date_end=None,
+              downloaded=None, limit=None):
+        """the recorded photos matching every filter given, ordered by sol, then id
+
+        the sol and date ranges are inclusive, downloaded=True only keeps the
+        photos with a path. returns dicts of id, rover, sol, camera,
+        earth_date, img_src, path, bytes and digest
+        """
+        where, args = [], []
+        if rover:
+            where.append('rover = ?')
+            args.append(rover.lower())
+        if camera:
+            where.append('camera = ?')
+            args.append(camera.upper())
+        if sol_start is not None:
+            where.append('sol >= ?')
+            args.append(int(sol_start))
+        if sol_end is not None:
+            where.append('sol <= ?')
+            args.append(int(sol_end))
+        if date_start:
+            where.append('earth_date >= ?')
+            args.append(date_start)
+        if date_end:
+            where.append('earth_date <= ?')
+            args.append(date_end)
+        if downloaded is not None:
+            where.append('path IS NOT NULL' if downloaded else 'path IS NULL')
+        sql = 'SELECT id, rover, sol, camera, earth_date, img_src, path, bytes, digest FROM photos'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY sol, id'
+        if limit:
+            sql += ' LIMIT ?'
+            args.append(int(limit))
+        fields = ('id', 'rover', 'sol', 'camera', 'earth_date', 'img_src', 'path', 'bytes', 'digest')
+        return [dict(zip(fields, row)) for row in self.db.execute(sql, args)]
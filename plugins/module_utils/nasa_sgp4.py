@@ -0,0 +1,415 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# SGP4 orbit propagation of many TLEs over a grid of times at once, used by
+# nasa_tle.
+#
+# This is the near-Earth branch of the SGP4 model as published by Vallado et
+# al. ("Revisiting Spacetrack Report #3", 2006, WGS-72 constants), written
+# over NumPy arrays: every element set is one row, every time one column, so
+# satellites x times are propagated in one pass per step of the model instead
+# of one satellite and one time at a time. Positions (km) and velocities
+# (km/s) come out in the TEME frame, as with every other SGP4 implementation.
+#
+# Deep-space element sets (an orbital period of 225 minutes or more, GPS,
+# GEO, Molniya, ...) need the SDP4 resonance terms, they are not propagated
+# and come back with error code 7.
+
+import math
+import os
+
+from datetime import datetime, timezone
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_tle import tle_epoch
+
+# python3 -m pip install numpy
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# WGS-72, the constants the TLEs are fitted with
+MU = 398600.8
+RADIUS_KM = 6378.135
+XKE = 60.0 / math.sqrt(RADIUS_KM ** 3 / MU)
+J2 = 0.001082616
+J3 = -0.00000253881
+J4 = -0.00000165597
+J3OJ2 = J3 / J2
+X2O3 = 2.0 / 3.0
+TWOPI = 2.0 * math.pi
+GOLDEN = (math.sqrt(5.0) - 1.0) / 2.0
+KM_PER_SEC = RADIUS_KM * XKE / 60.0
+
+# why a satellite x time could not be propagated, 0 is no error
+ERRORS = {
+    1: 'mean eccentricity out of range',
+    2: 'mean motion below zero',
+    4: 'semi-latus rectum below zero',
+    6: 'the orbit has decayed',
+    7: 'deep-space orbit, not supported',
+    8: 'the TLE could not be parsed',
+}
+
+# how many satellite x time cells are propagated at once, bounds the memory
+# used by the temporary arrays (about 40 of them, 8 bytes per cell)
+CHUNK_CELLS = 1 << 20
+
+
+def _implied(field):
+    """a TLE field with an implied decimal point and exponent, ' 12345-3' is 0.12345e-3"""
+    field = field.strip()
+    if not field:
+        return 0.0
+    sign = -1.0 if field[0] == '-' else 1.0
+    field = field.lstrip('+-')
+    mantissa, exponent = field[:-2], field[-2:]
+    return sign * float('0.' + mantissa.strip()) * 10 ** int(exponent)
+
+
+def parse_tle(line1, line2):
+    """the mean elements of a TLE, angles in radians and the mean motion in radians per minute
+
+    raises ValueError when the lines are not a TLE
+    """
+    if not line1 or not line2 or len(line1) < 63 or len(line2) < 63:
+        raise ValueError('a TLE line is too short')
+    epoch = tle_epoch(line1)
+    if epoch is None:
+        raise ValueError('the epoch could not be read')
+    deg = math.pi / 180.0
+    return dict(
+        epoch=epoch,
+        bstar=_implied(line1[53:61]),
+        inclo=float(line2[8:16]) * deg,
+        nodeo=float(line2[17:25]) * deg,
+        ecco=float('0.' + line2[26:33].strip()),
+        argpo=float(line2[34:42]) * deg,
+        mo=float(line2[43:51]) * deg,
+        no_kozai=float(line2[52:63]) * TWOPI / 1440.0,
+    )
+
+
+class ElementSets(object):
+    """the SGP4 constants of many TLEs, one array entry per TLE"""
+
+    FIELDS = ('bstar', 'inclo', 'nodeo', 'ecco', 'argpo', 'mo', 'no_kozai')
+
+    def __init__(self, tles):
+        """tles is a list of (line1, line2), a TLE that cannot be parsed is kept with error 8"""
+        elements = []
+        self.error = np.zeros(len(tles), dtype=np.int8)
+        self.epoch = np.zeros(len(tles))
+        for n, (line1, line2) in enumerate(tles):
+            try:
+                e = parse_tle(line1, line2)
+            except (TypeError, ValueError):
+                self.error[n] = 8
+                # harmless elements (a circular LEO) so the arrays stay aligned
+                e = dict(epoch=datetime(2000, 1, 1, tzinfo=timezone.utc), bstar=0.0, inclo=0.0, nodeo=0.0,
+                         ecco=0.0, argpo=0.0, mo=0.0, no_kozai=0.06)
+            elements.append(e)
+            self.epoch[n] = e['epoch'].timestamp()
+        for field in self.FIELDS:
+            setattr(self, field, np.array([e[field] for e in elements], dtype=np.float64))
+        self._init()
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def _init(self):
+        """sgp4init, near-Earth branch"""
+        ecco, inclo, no_kozai, bstar, argpo = self.ecco, self.inclo, self.no_kozai, self.bstar, self.argpo
+
+        # initl, recover the original mean motion and semi-major axis
+        eccsq = ecco * ecco
+        omeosq = 1.0 - eccsq
+        rteosq = np.sqrt(omeosq)
+        cosio = np.cos(inclo)
+        cosio2 = cosio * cosio
+        ak = (XKE / no_kozai) ** X2O3
+        d1 = 0.75 * J2 * (3.0 * cosio2 - 1.0) / (rteosq * omeosq)
+        delta = d1 / (ak * ak)
+        adel = ak * (1.0 - delta * delta - delta * (1.0 / 3.0 + 134.0 * delta * delta / 81.0))
+        delta = d1 / (adel * adel)
+        self.no_unkozai = no = no_kozai / (1.0 + delta)
+        ao = (XKE / no) ** X2O3
+        sinio = np.sin(inclo)
+        po = ao * omeosq
+        con42 = 1.0 - 5.0 * cosio2
+        self.con41 = con41 = -con42 - cosio2 - cosio2
+        posq = po * po
+        rp = ao * (1.0 - ecco)
+
+        # deep space (a period of 225 minutes or more) is left out
+        self.error[(TWOPI / no >= 225.0) & (self.error == 0)] = 7
+
+        # perigee below 220 km, the drag terms are truncated
+        self.isimp = rp < (220.0 / RADIUS_KM + 1.0)
+
+        # the atmospheric density parameter, adjusted for a perigee below 156 km
+        ss = 78.0 / RADIUS_KM + 1.0
+        qzms2t = ((120.0 - 78.0) / RADIUS_KM) ** 4
+        perige = (rp - 1.0) * RADIUS_KM
+        sfour = np.where(perige < 98.0, 20.0, perige - 78.0)
+        qzms24 = np.where(perige < 156.0, ((120.0 - sfour) / RADIUS_KM) ** 4, qzms2t)
+        sfour = np.where(perige < 156.0, sfour / RADIUS_KM + 1.0, ss)
+
+        pinvsq = 1.0 / posq
+        tsi = 1.0 / (ao - sfour)
+        self.eta = eta = ao * ecco * tsi
+        etasq = eta * eta
+        eeta = ecco * eta
+        psisq = np.abs(1.0 - etasq)
+        coef = qzms24 * tsi ** 4
+        coef1 = coef / psisq ** 3.5
+        cc2 = coef1 * no * (ao * (1.0 + 1.5 * etasq + eeta * (4.0 + etasq)) +
+                            0.375 * J2 * tsi / psisq * con41 * (8.0 + 3.0 * etasq * (8.0 + etasq)))
+        self.cc1 = cc1 = bstar * cc2
+        big_e = ecco > 1.0e-4
+        safe_ecco = np.where(big_e, ecco, 1.0)
+        cc3 = np.where(big_e, -2.0 * coef * tsi * J3OJ2 * no * sinio / safe_ecco, 0.0)
+        self.x1mth2 = x1mth2 = 1.0 - cosio2
+        self.cc4 = 2.0 * no * coef1 * ao * omeosq * (
+            eta * (2.0 + 0.5 * etasq) + ecco * (0.5 + 2.0 * etasq) -
+            J2 * tsi / (ao * psisq) * (-3.0 * con41 * (1.0 - 2.0 * eeta + etasq * (1.5 - 0.5 * eeta)) +
+                                       0.75 * x1mth2 * (2.0 * etasq - eeta * (1.0 + etasq)) * np.cos(2.0 * argpo)))
+        self.cc5 = 2.0 * coef1 * ao * omeosq * (1.0 + 2.75 * (etasq + eeta) + eeta * etasq)
+        cosio4 = cosio2 * cosio2
+        temp1 = 1.5 * J2 * pinvsq * no
+        temp2 = 0.5 * temp1 * J2 * pinvsq
+        temp3 = -0.46875 * J4 * pinvsq * pinvsq * no
+        self.mdot = no + 0.5 * temp1 * rteosq * con41 + 0.0625 * temp2 * rteosq * (13.0 - 78.0 * cosio2 + 137.0 * cosio4)
+        self.argpdot = (-0.5 * temp1 * con42 + 0.0625 * temp2 * (7.0 - 114.0 * cosio2 + 395.0 * cosio4) +
+                        temp3 * (3.0 - 36.0 * cosio2 + 49.0 * cosio4))
+        xhdot1 = -temp1 * cosio
+        self.nodedot = xhdot1 + (0.5 * temp2 * (4.0 - 19.0 * cosio2) + 2.0 * temp3 * (3.0 - 7.0 * cosio2)) * cosio
+        self.omgcof = bstar * cc3 * np.cos(argpo)
+        safe_eeta = np.where(big_e, eeta, 1.0)
+        self.xmcof = np.where(big_e, -X2O3 * coef * bstar / safe_eeta, 0.0)
+        self.nodecf = 3.5 * omeosq * xhdot1 * cc1
+        self.t2cof = 1.5 * cc1
+        # an inclination of 180 degrees would divide by zero
+        self.xlcof = -0.25 * J3OJ2 * sinio * (3.0 + 5.0 * cosio) / np.where(np.abs(cosio + 1.0) > 1.5e-12, 1.0 + cosio, 1.5e-12)
+        self.aycof = -0.5 * J3OJ2 * sinio
+        self.delmo = (1.0 + eta * np.cos(self.mo)) ** 3
+        self.sinmao = np.sin(self.mo)
+        self.x7thm1 = 7.0 * cosio2 - 1.0
+
+        # the higher order drag terms, zero for the truncated (isimp) element sets
+        cc1sq = cc1 * cc1
+        d2 = 4.0 * ao * tsi * cc1sq
+        temp = d2 * tsi * cc1 / 3.0
+        d3 = (17.0 * ao + sfour) * temp
+        d4 = 0.5 * temp * ao * tsi * (221.0 * ao + 31.0 * sfour) * cc1
+        full = ~self.isimp
+        self.d2 = np.where(full, d2, 0.0)
+        self.d3 = np.where(full, d3, 0.0)
+        self.d4 = np.where(full, d4, 0.0)
+        self.t3cof = np.where(full, d2 + 2.0 * cc1sq, 0.0)
+        self.t4cof = np.where(full, 0.25 * (3.0 * d3 + cc1 * (12.0 * d2 + 10.0 * cc1sq)), 0.0)
+        self.t5cof = np.where(full, 0.2 * (3.0 * d4 + 12.0 * cc1 * d3 + 6.0 * d2 * d2 + 15.0 * cc1sq * (2.0 * d2 + cc1sq)), 0.0)
+
+    def _take(self, rows):
+        """the per satellite constants of rows, as column vectors so they broadcast against the times"""
+        return dict((name, value[rows][:, None]) for name, value in vars(self).items()
+                    if isinstance(value, np.ndarray))
+
+    def propagate(self, times):
+        """positions (km) and velocities (km/s) in TEME of every satellite at every time
+
+        times are POSIX timestamps (seconds, UTC). returns (positions,
+        velocities, errors) with shapes (satellites, times, 3), (satellites,
+        times, 3) and (satellites, times), a cell with an error is NaN
+        """
+        times = np.asarray(times, dtype=np.float64)
+        n_sat, n_time = len(self), len(times)
+        positions = np.full((n_sat, n_time, 3), np.nan)
+        velocities = np.full((n_sat, n_time, 3), np.nan)
+        errors = np.zeros((n_sat, n_time), dtype=np.int8)
+        rows = max(1, CHUNK_CELLS // max(n_time, 1))
+        for start in range(0, n_sat, rows):
+            chunk = np.arange(start, min(start + rows, n_sat))
+            # cells that fail (decayed, hyperbolic, ...) go through NaN, they are flagged in errors
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                r, v, e = self._propagate(self._take(chunk), times[None, :])
+            positions[chunk], velocities[chunk], errors[chunk] = r, v, e
+        return positions, velocities, errors
+
+    def propagate_at(self, rows, times):
+        """the position and velocity of satellite rows[n] at times[n] (POSIX timestamp), for every n
+
+        returns (positions, velocities, errors) with shapes (n, 3), (n, 3) and (n,)
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        times = np.asarray(times, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            r, v, e = self._propagate(self._take(rows), times[:, None])
+        return r[:, 0], v[:, 0], e[:, 0]
+
+    def radii(self):
+        """the perigee and apogee distance (km, from the center of the Earth) of every mean orbit"""
+        a = (XKE / self.no_unkozai) ** X2O3 * RADIUS_KM
+        return a * (1.0 - self.ecco), a * (1.0 + self.ecco)
+
+    def _propagate(self, s, times):
+        """sgp4, near-Earth branch, for the constants s of a chunk of satellites
+
+        times broadcasts against the (satellites, 1) constants, a (1, times)
+        row gives every satellite every time, a (satellites, 1) column one
+        time per satellite
+        """
+        t = (times - s['epoch']) / 60.0  # minutes since epoch
+        error = np.broadcast_to(s['error'], t.shape).copy()
+
+        # secular gravity and atmospheric drag
+        xmdf = s['mo'] + s['mdot'] * t
+        argpdf = s['argpo'] + s['argpdot'] * t
+        nodedf = s['nodeo'] + s['nodedot'] * t
+        t2 = t * t
+        nodem = nodedf + s['nodecf'] * t2
+        delomg = s['omgcof'] * t
+        delm = s['xmcof'] * ((1.0 + s['eta'] * np.cos(xmdf)) ** 3 - s['delmo'])
+        # the truncated element sets have omgcof and xmcof, but never use them
+        dtemp = np.where(s['isimp'], 0.0, delomg + delm)
+        mm = xmdf + dtemp
+        argpm = argpdf - dtemp
+        t3 = t2 * t
+        t4 = t3 * t
+        tempa = 1.0 - s['cc1'] * t - s['d2'] * t2 - s['d3'] * t3 - s['d4'] * t4
+        tempe = s['bstar'] * s['cc4'] * t + np.where(s['isimp'], 0.0, s['bstar'] * s['cc5'] * (np.sin(mm) - s['sinmao']))
+        templ = s['t2cof'] * t2 + s['t3cof'] * t3 + t4 * (s['t4cof'] + t * s['t5cof'])
+
+        nm = np.broadcast_to(s['no_unkozai'], t.shape)
+        error[(nm <= 0.0) & (error == 0)] = 2
+        am = (XKE / nm) ** X2O3 * tempa * tempa
+        nm = XKE / np.abs(am) ** 1.5
+        em = s['ecco'] - tempe
+        error[((em >= 1.0) | (em < -0.001)) & (error == 0)] = 1
+        em = np.maximum(em, 1.0e-6)
+        mm = mm + s['no_unkozai'] * templ
+        xlm = mm + argpm + nodem
+        nodem = np.fmod(nodem, TWOPI)
+        argpm = np.fmod(argpm, TWOPI)
+        xlm = np.fmod(xlm, TWOPI)
+        mm = np.fmod(xlm - argpm - nodem, TWOPI)
+
+        # long period periodics
+        axnl = em * np.cos(argpm)
+        temp = 1.0 / (am * (1.0 - em * em))
+        aynl = em * np.sin(argpm) + temp * s['aycof']
+        xl = mm + argpm + nodem + temp * s['xlcof'] * axnl
+
+        # solve Kepler's equation, every cell takes the same 10 Newton steps at most
+        u = np.fmod(xl - nodem, TWOPI)
+        eo1 = u.copy()
+        for _ in range(10):
+            sineo1 = np.sin(eo1)
+            coseo1 = np.cos(eo1)
+            step = (u - aynl * coseo1 + axnl * sineo1 - eo1) / (1.0 - coseo1 * axnl - sineo1 * aynl)
+            step = np.clip(step, -0.95, 0.95)
+            eo1 = eo1 + step
+            if np.all(np.abs(step) < 1.0e-12):
+                break
+        sineo1 = np.sin(eo1)
+        coseo1 = np.cos(eo1)
+
+        # short period preliminary quantities
+        ecose = axnl * coseo1 + aynl * sineo1
+        esine = axnl * sineo1 - aynl * coseo1
+        el2 = axnl * axnl + aynl * aynl
+        pl = am * (1.0 - el2)
+        error[(pl < 0.0) & (error == 0)] = 4
+        pl = np.where(pl < 0.0, np.nan, pl)
+        rl = am * (1.0 - ecose)
+        rdotl = np.sqrt(am) * esine / rl
+        rvdotl = np.sqrt(pl) / rl
+        betal = np.sqrt(1.0 - el2)
+        temp = esine / (1.0 + betal)
+        sinu = am / rl * (sineo1 - aynl - axnl * temp)
+        cosu = am / rl * (coseo1 - axnl + aynl * temp)
+        su = np.arctan2(sinu, cosu)
+        sin2u = (cosu + cosu) * sinu
+        cos2u = 1.0 - 2.0 * sinu * sinu
+        temp = 1.0 / pl
+        temp1 = 0.5 * J2 * temp
+        temp2 = temp1 * temp
+
+        # short period periodics
+        mrt = rl * (1.0 - 1.5 * temp2 * betal * s['con41']) + 0.5 * temp1 * s['x1mth2'] * cos2u
+        su = su - 0.25 * temp2 * s['x7thm1'] * sin2u
+        cosip = np.cos(s['inclo'])
+        sinip = np.sin(s['inclo'])
+        xnode = nodem + 1.5 * temp2 * cosip * sin2u
+        xinc = s['inclo'] + 1.5 * temp2 * cosip * sinip * cos2u
+        mvt = rdotl - nm * temp1 * s['x1mth2'] * sin2u / XKE
+        rvdot = rvdotl + nm * temp1 * (s['x1mth2'] * cos2u + 1.5 * s['con41']) / XKE
+
+        # orientation vectors
+        sinsu, cossu = np.sin(su), np.cos(su)
+        snod, cnod = np.sin(xnode), np.cos(xnode)
+        sini, cosi = np.sin(xinc), np.cos(xinc)
+        xmx = -snod * cosi
+        xmy = cnod * cosi
+        ux = xmx * sinsu + cnod * cossu
+        uy = xmy * sinsu + snod * cossu
+        uz = sini * sinsu
+        vx = xmx * cossu - cnod * sinsu
+        vy = xmy * cossu - snod * sinsu
+        vz = sini * cossu
+
+        error[(mrt < 1.0) & (error == 0)] = 6
+        r = np.stack((mrt * ux, mrt * uy, mrt * uz), axis=-1) * RADIUS_KM
+        v = np.stack((mvt * ux + rvdot * vx, mvt * uy + rvdot * vy, mvt * uz + rvdot * vz), axis=-1) * KM_PER_SEC
+        bad = error != 0
+        r[bad] = np.nan
+        v[bad] = np.nan
+        return r, v, error
+
+
+def time_grid(start, minutes, step):
+    """POSIX timestamps from start (an aware datetime) every step minutes, for minutes (both ends included)"""
+    count = int(math.floor(minutes / float(step) + 1e-9)) + 1
+    return start.timestamp() + np.arange(count) * step * 60.0
+
+
+def golden_section(f, low, high, iterations=40):
+    """golden section search for the minimum of f between low[n] and high[n], for every n at once
+
+    f maps an array of times to an array of values, returns the times
+    """
+    a, b = low.copy(), high.copy()
+    c = b - GOLDEN * (b - a)
+    d = a + GOLDEN * (b - a)
+    fc, fd = f(c), f(d)
+    for _ in range(iterations):
+        left = fc < fd
+        # lower at c, the minimum is in [a, d]: d becomes c and a new c is probed, the other way round otherwise
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        new_c = np.where(left, b - GOLDEN * (b - a), d)
+        new_d = np.where(left, c, a + GOLDEN * (b - a))
+        fp = f(np.where(left, new_c, new_d))
+        fc, fd = np.where(left, fp, fd), np.where(left, fc, fp)
+        c, d = new_c, new_d
+    return (a + b) / 2.0
+
+
+def rows(values, errors, digits):
+    """a (satellites, times, 3) array as nested lists, rounded, a cell with an error is None (NaN is not JSON)"""
+    values = np.round(values, digits).tolist()
+    for s, row in enumerate(values):
+        for t in np.flatnonzero(errors[s]):
+            row[t] = None
+    return values
+
+
+def save_arrays(path, **arrays):
+    """write arrays to a compressed .npz at path, through a temporary file so a reader never sees half of it"""
+    # np.savez adds .npz to a name that does not end with it
+    tmp = f"{path}.tmp.npz"
+    np.savez_compressed(tmp, **dict((name, np.asarray(value)) for name, value in arrays.items()))
+    os.replace(tmp, path)
@@ -0,0 +1,131 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Helpers for nasa_tle: a local SQLite mirror of the whole TLE collection,
+# keyed on satellite number, so name and number lookups are answered locally.
+#
+# A satellite is only rewritten when the epoch of its element set changed.
+# Besides the satellite number (the primary key), every word of every name is
+# indexed, and a name is looked up as a prefix range scan over those words
+# (the B-tree walks the same path a prefix trie would), so ISS, zarya or
+# STARLINK-1 find their satellites without reading the whole catalog.
+
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_words import PREFIX_END, name_words
+
+
+def tle_epoch(line1):
+    """the epoch of a TLE (columns 19-32 of line 1, YYDDD.DDDDDDDD) as an aware UTC datetime, or None"""
+    try:
+        year = int(line1[18:20])
+        day = float(line1[20:32])
+    except (TypeError, ValueError):
+        return None
+    # two digit years, 57-99 are 1957-1999
+    year += 1900 if year >= 57 else 2000
+    return datetime(year, 1, 1, tzinfo=timezone.utc) + timedelta(days=day - 1)
+
+
+def tle_key(member):
+    """the epoch as written in line 1, compared to decide an element set changed"""
+    line1 = member.get('line1') or ''
+    return line1[18:32].strip() or member.get('date') or ''
+
+
+class TleCatalog(object):
+    """every TLE of the collection mirrored so far, keyed on satellite number"""
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS tles (
+            sat_id INTEGER PRIMARY KEY,
+            name TEXT,
+            epoch TEXT,
+            date TEXT,
+            line1 TEXT,
+            line2 TEXT,
+            updated TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS words (
+            word TEXT,
+            sat_id INTEGER,
+            PRIMARY KEY (word, sat_id)
+        ) WITHOUT ROWID''',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    )
+
+    FIELDS = ('satelliteId', 'name', 'date', 'line1', 'line2')
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM tles').fetchone()[0]
+
+    def merge(self, members):
+        """store the TLEs of one page, only the new ones and those whose epoch changed are written
+
+        returns a dict of how many were added, updated and unchanged
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        counts = dict(added=0, updated=0, unchanged=0)
+        for member in members:
+            sat_id = member.get('satelliteId')
+            if sat_id is None:
+                continue
+            epoch = tle_key(member)
+            row = self.db.execute('SELECT epoch, name FROM tles WHERE sat_id = ?', (sat_id,)).fetchone()
+            if row is not None and row[0] == epoch and row[1] == member.get('name'):
+                counts['unchanged'] += 1
+                continue
+            counts['updated' if row else 'added'] += 1
+            self.db.execute('INSERT OR REPLACE INTO tles VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (sat_id, member.get('name'), epoch, member.get('date'),
+                             member.get('line1'), member.get('line2'), now))
+            # a renamed satellite must not be found under its old words
+            self.db.execute('DELETE FROM words WHERE sat_id = ?', (sat_id,))
+            self.db.executemany('INSERT OR IGNORE INTO words VALUES (?, ?)',
+                                [(word, sat_id) for word in name_words(member.get('name'))])
+        self.db.commit()
+        return counts
+
+    def lookup(self, sat_num=None, name=None, limit=100):
+        """the stored TLEs matching sat_num, or every word of name as the prefix of a word of the satellite name
+
+        returned the way the TLE API lists them (satelliteId, name, date,
+        line1, line2), ordered by satellite number
+        """
+        where, args = [], []
+        if sat_num is not None:
+            where.append('sat_id = ?')
+            args.append(int(sat_num))
+        for word in name_words(name) if name else []:
+            where.append('sat_id IN (SELECT sat_id FROM words WHERE word >= ? AND word < ?)')
+            args.extend([word, word + PREFIX_END])
+        sql = 'SELECT sat_id, name, date, line1, line2 FROM tles'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY sat_id'
+        if limit:
+            sql += ' LIMIT ?'
+            args.append(int(limit))
+        return [dict(zip(self.FIELDS, row)) for row in self.db.execute(sql, args)]
@@ -0,0 +1,133 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# A local SQLite time series of the InSight weather report, one row per sol,
+# used by nasa_mars_weather. The report only covers the last seven sols, so
+# every run upserts what it returned and the history builds up locally.
+#
+# Each sensor (AT temperature, PRE pressure, HWS wind speed) is stored as the
+# av / mn / mx / ct columns the API already summarized the sol into, so a sol
+# range is aggregated with one indexed SQL query instead of re-reading every
+# report ever saved.
+
+import json
+import sqlite3
+
+# the sensors kept, with the name they are returned under
+SENSORS = (
+    ('AT', 'temperature'),
+    ('PRE', 'pressure'),
+    ('HWS', 'wind_speed'),
+)
+STATS = ('av', 'mn', 'mx', 'ct')
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sol_rows(report):
+    """the sols of an InSight weather report, as (sol, first_utc, last_utc, season, wind_direction, sensor columns..., data)"""
+    rows = []
+    for key in report.get('sol_keys') or []:
+        entry = report.get(key)
+        if not isinstance(entry, dict) or not str(key).isdigit():
+            continue
+        columns = []
+        for sensor, _ in SENSORS:
+            values = entry.get(sensor) or {}
+            columns.extend(_number(values.get(stat)) for stat in STATS)
+        most_common = (entry.get('WD') or {}).get('most_common') or {}
+        rows.append(tuple([int(key), entry.get('First_UTC'), entry.get('Last_UTC'), entry.get('Season'),
+                           most_common.get('compass_point')] + columns + [json.dumps(entry, sort_keys=True)]))
+    return rows
+
+
+class WeatherStore(object):
+    """every sol of the InSight weather report seen so far, keyed on sol"""
+
+    COLUMNS = ['sol', 'first_utc', 'last_utc', 'season', 'wind_direction'] + [
+        f"{sensor.lower()}_{stat}" for sensor, _ in SENSORS for stat in STATS] + ['data']
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS sols (sol INTEGER PRIMARY KEY, first_utc TEXT, last_utc TEXT, season TEXT, '
+        'wind_direction TEXT, ' + ', '.join(f"{sensor.lower()}_{stat} REAL" for sensor, _ in SENSORS for stat in STATS) +
+        ', data TEXT)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM sols').fetchone()[0]
+
+    def upsert(self, report):
+        """store every sol of a weather report, returns a dict of the sols added and updated (a sol the API revised)"""
+        diff = dict(added=[], updated=[])
+        for row in sol_rows(report):
+            known = self.db.execute('SELECT data FROM sols WHERE sol = ?', (row[0],)).fetchone()
+            if known is not None and known[0] == row[-1]:
+                continue
+            diff['updated' if known else 'added'].append(row[0])
+            self.db.execute(f"INSERT OR REPLACE INTO sols VALUES ({', '.join('?' * len(self.COLUMNS))})", row)
+        self.db.commit()
+        return diff
+
+    def query(self, sol_start=None, sol_end=None):
+        """the stored sols from sol_start to sol_end (inclusive), oldest first, and their aggregates
+
+        every sol is a dict of sol, first_utc, last_utc, season,
+        wind_direction and one dict (av, mn, mx, ct) per sensor. The
+        aggregates hold, per sensor, the lowest mn, the highest mx, the mean
+        of av weighted by ct (the number of samples) and how many sols had it
+        """
+        where, args = [], []
+        if sol_start is not None:
+            where.append('sol >= ?')
+            args.append(int(sol_start))
+        if sol_end is not None:
+            where.append('sol <= ?')
+            args.append(int(sol_end))
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+
+        sols = []
+        for row in self.db.execute(f"SELECT {', '.join(self.COLUMNS[:-1])} FROM sols{clause} ORDER BY sol", args):
+            entry = dict(zip(self.COLUMNS[:5], row[:5]))
+            for n, (sensor, name) in enumerate(SENSORS):
+                entry[name] = dict(zip(STATS, row[5 + n * len(STATS):5 + (n + 1) * len(STATS)]))
+            sols.append(entry)
+
+        parts = []
+        for sensor, _ in SENSORS:
+            s = sensor.lower()
+            parts.extend([f"MIN({s}_mn)", f"MAX({s}_mx)",
+                          # a sol without a sample count weighs as one sample
+                          f"SUM({s}_av * COALESCE({s}_ct, 1)) / SUM(CASE WHEN {s}_av IS NULL THEN NULL ELSE COALESCE({s}_ct, 1) END)",
+                          f"COUNT({s}_av)"])
+        row = self.db.execute(f"SELECT {', '.join(parts)} FROM sols{clause}", args).fetchone()
+        aggregates = dict(sols=len(sols), first_sol=sols[0]['sol'] if sols else None,
+                          last_sol=sols[-1]['sol'] if sols else None)
+        for n, (sensor, name) in enumerate(SENSORS):
+            aggregates[name] = dict(zip(('min', 'max', 'mean', 'sols'), row[n * 4:(n + 1) * 4]))
+        return sols, aggregates
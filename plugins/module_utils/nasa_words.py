@@ -0,0 +1,20 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# name word helpers shared by the rzfeeser.nasa_api SQLite stores that index
+# every word of a name and look a name up as a prefix range scan over them
+
+import re
+
+# names are split into words the same way a search is
+WORD = re.compile(r'[A-Z0-9]+')
+
+# sorts after any character a name can hold, the upper bound of a prefix range
+PREFIX_END = '\uffff'
+
+
+def name_words(name):
+    """the distinct upper case words of a name, sorted"""
+    return sorted(set(WORD.findall((name or '').upper())))
@@ -0,0 +1,129 @@
+# Copyright: (c) 2020, Russell Zachary Feeser <rzfeeser@users.noreply.github.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# shared helpers for the rzfeeser.nasa_api modules that need to run
+# several HTTP lookups (or downloads) at the same time, or to spread number
+# crunching over processes
+
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+# python3 -m pip install requests
+import requests
+
+# never let a user talk us into hammering api.nasa.gov with hundreds of threads
+MAX_WORKERS = 16
+
+
+def bounded_map(func, items, workers=4):
+    """Run func(item) for every item with at most `workers` threads.
+
+    Results come back in the same order as items. Exceptions raised by
+    func are not swallowed, so func should catch what it wants to report.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    # clamp the pool size between 1 and MAX_WORKERS (and never more threads than work)
+    workers = max(1, min(int(workers or 1), MAX_WORKERS, len(items)))
+
+    # a single worker is just a loop, skip the pool overhead
+    if workers == 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+
+def bounded_imap(func, items, workers=4):
+    """Like bounded_map, but yield each result as soon as it is ready.
+
+    Results come back in the order they finish, not the order of items.
+    At most workers * 2 items are in flight at any time, so a long (or
+    lazy) list of items never holds more than that many results in memory.
+    """
+    workers = max(1, min(int(workers or 1), MAX_WORKERS))
+
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(func, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def process_pool(processes):
+    """a process pool, forked where the platform allows it (the workers need nothing from the parent but the job)"""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+def default_processes():
+    return max(1, min(os.cpu_count() or 1, 32))
+
+
+class RateLimiter(object):
+    """token bucket shared by every worker thread
+
+    api.nasa.gov counts requests per key per hour, so a pool of workers must
+    not fire faster than `rate` requests per second (with bursts of `burst`).
+    A rate of 0 (or None) turns the limiter off.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate or 0)
+        self.burst = max(1, int(burst or 1))
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """block until the caller is allowed to send one request"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def limited_get(url, limiter=None, retries=3, **kwargs):
+    """requests.get that waits its turn on the limiter and backs off on a 429
+
+    api.nasa.gov answers 429 (Too Many Requests) once a key is over its
+    limit, honour Retry-After when given, otherwise wait 1s, 2s, 4s, ...
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        resp = requests.get(url, **kwargs)
+        if resp.status_code != 429 or attempt == retries:
+            return resp
+        retry_after = resp.headers.get('Retry-After', '')
+        time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt)
+    return resp
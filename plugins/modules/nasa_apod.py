@@ -37,6 +37,38 @@ options:
         description:
             - This is the location and name to save the APOD image (PNG format). Defaults to /tmp/example.png directory.
         required: false
+    start_date:
+        description:
+            - The first date of a range of APOD entries to retrieve. Formatted YYYY-MM-DD. Cannot be used with date or count. The whole range is returned by a single API lookup.
+        required: false
+    end_date:
+        description:
+            - The last date of a range of APOD entries to retrieve. Formatted YYYY-MM-DD. Defaults to todays date. Requires start_date.
+        required: false
+    count:
+        description:
+            - Return this many randomly chosen APOD entries. Cannot be used with date, start_date or end_date.
+        required: false
+    dest_dir:
+        description:
+            - Directory the images are saved into when start_date or count is used. Defaults to /tmp.
+        required: false
+    filename_template:
+        description:
+            - Name given to each image saved in dest_dir. Any key of the APOD entry may be used (such as {date} or {title}), as well as {ext}, the extension of the image URL. Defaults to apod-{date}{ext}
+        required: false
+    workers:
+        description:
+            - The number of images downloaded at the same time when start_date or count is used. Defaults to 4, the maximum is 16.
+        required: false
+    image_store:
+        description:
+            - Path to a content-addressed image store shared with other tasks (and nasa_earth). Images already in the store are hard linked (or reflinked / copied) to dest instead of being downloaded again. Not used by default.
+        required: false
+    image_store_max_mb:
+        description:
+            - Once the image store grows past this many MB the least recently used images are removed from it. Defaults to 0, never trim the store.
+        required: false
 
 author:
     - Russell Zachary Feeser (@rzfeeser)
@@ -56,6 +88,31 @@ EXAMPLES = '''
     date: 2019-01-01
     hd: false
     dest: /home/student/example.png
+
+# Obtain every APOD from January 2020, downloading 8 images at a time
+- name: Lookup the NASA APOD API for January 2020
+  nasa_apod:
+    apikey: DEMO_KEY
+    start_date: 2020-01-01
+    end_date: 2020-01-31
+    dest_dir: /home/student/apod/
+    filename_template: "{date}-apod{ext}"
+    workers: 8
+
+# Obtain 10 random APOD images
+- name: Lookup 10 random entries from the NASA APOD API
+  nasa_apod:
+    apikey: DEMO_KEY
+    count: 10
+    dest_dir: /home/student/apod/
+
+# Share downloaded images between tasks, keeping at most 2 GB of them
+- name: Lookup TODAYs APOD, reusing the image if another task already pulled it
+  nasa_apod:
+    apikey: DEMO_KEY
+    dest: /home/student/today.png
+    image_store: /var/cache/nasa_images
+    image_store_max_mb: 2048
 '''
 
 RETURN = '''
@@ -68,14 +125,74 @@ apodurl:
     type: str
     returned: always
 apodhdurl:
-    description: The link to the HD APOD image
+    description: The link to the HD APOD image. Empty when start_date or count is used.
     type: str
     returned: always
+items:
+    description: One entry per APOD returned when start_date or count is used. Each has date, url, dest, status (downloaded, cached, skipped or failed), msg, digest, bytes and throughput (bytes per second).
+    type: list
+    returned: when start_date or count is used
+    sample: [{"date": "2020-01-01", "url": "https://apod.nasa.gov/apod/image/2001/x.jpg", "dest": "/tmp/apod-2020-01-01.jpg", "status": "downloaded", "msg": "", "digest": "9f86d08...", "bytes": 2048576, "throughput": 1048576}]
+download:
+    description: Statistics about the image transfer - bytes, transferred, resumed, seconds, throughput (bytes per second), digest (sha256) and verified - how the digest was checked, server when the server sent a Digest, Repr-Digest or Content-MD5 header for the image and empty when it sent none (the digest is then only reported). Empty when the image came from the image store.
+    type: dict
+    returned: when start_date or count is not used
+image_store:
+    description: How the image was placed at dest when image_store is used. Has status (downloaded or cached), digest (sha256) and method (hardlink, reflink, copy or present).
+    type: dict
+    returned: when image_store is used without start_date or count
 '''
 
+import os
+
+from urllib.parse import urlparse
+
 import requests
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_imagestore import ImageStore, save_image
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import bounded_map
+
+NASAAPOD = "https://api.nasa.gov/planetary/apod"
+
+def apod_filename(entry, url, template):
+    """build the file name for one APOD entry from the filename_template"""
+    ext = os.path.splitext(urlparse(url).path)[1] or ".jpg"
+    fields = dict(entry)
+    fields['ext'] = ext
+    # titles and dates should never be able to walk us out of dest_dir
+    return os.path.basename(template.format(**fields).replace("/", "-"))
+
+def download_apod(entry, hd, dest_dir, template, store=None):
+    """download a single APOD entry, returns the status of that item"""
+    url = entry.get('hdurl') if hd and entry.get('hdurl') else entry.get('url')
+    item = dict(date=entry.get('date'), url=url, dest='', status='skipped', msg='', digest='', bytes=0, throughput=0)
+
+    # APOD is sometimes a video (youtube, vimeo, etc.) and there is nothing to save
+    if entry.get('media_type', 'image') != 'image' or not url:
+        item['msg'] = f"media_type is {entry.get('media_type')}, not an image"
+        return item
+
+    try:
+        item['dest'] = os.path.join(dest_dir, apod_filename(entry, url, template))
+    except (KeyError, IndexError, ValueError) as err:
+        item['status'] = 'failed'
+        item['msg'] = f"filename_template could not be filled in: {err}"
+        return item
+
+    saved = save_image(url, item['dest'], store)
+    item['status'] = saved['status']
+    item['msg'] = saved['msg']
+    item['digest'] = saved['digest']
+    item['bytes'] = saved['download'].get('bytes', 0)
+    item['throughput'] = saved['download'].get('throughput', 0)
+    return item
+
+def open_store(module):
+    """return the ImageStore the user asked for, or None"""
+    if not module.params.get('image_store'):
+        return None
+    return ImageStore(module.params['image_store'], max_bytes=module.params['image_store_max_mb'] * 1024 * 1024)
 
 def run_module():
     # define available arguments/parameters a user can pass to the module
@@ -83,7 +200,15 @@ def run_module():
         date=dict(type='str', required=False),
         hd=dict(type='bool', required=False, default=True),
         apikey=dict(type='str', required=False, default="DEMO_KEY"),
-        dest=dict(type='str', required=False, default="/tmp/example.png")
+        dest=dict(type='str', required=False, default="/tmp/example.png"),
+        start_date=dict(type='str', required=False),
+        end_date=dict(type='str', required=False),
+        count=dict(type='int', required=False),
+        dest_dir=dict(type='str', required=False, default="/tmp"),
+        filename_template=dict(type='str', required=False, default="apod-{date}{ext}"),
+        workers=dict(type='int', required=False, default=4),
+        image_store=dict(type='str', required=False),
+        image_store_max_mb=dict(type='int', required=False, default=0)
     )
 
     # seed the result dict in the object
@@ -104,7 +229,13 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        mutually_exclusive=[
+            ('date', 'start_date'),
+            ('date', 'count'),
+            ('count', 'start_date'),
+            ('count', 'end_date'),],
+        required_by={'end_date': 'start_date'},
     )
 
     # if the user is working with this module in only check mode we do not
@@ -113,6 +244,10 @@ def run_module():
     if module.check_mode:
         module.exit_json(**result)
 
+    # a range of dates or a random count is returned by the API as a list in ONE lookup
+    if module.params.get('start_date') or module.params.get('count'):
+        run_multi(module, result)
+
     # make the call to NASA APOD API service
     if module.params.get('date'):
         nasaresp = requests.get(f"https://api.nasa.gov/planetary/apod?hd={module.params['hd']}&api_key={module.params['apikey']}&date={module.params['date']}")
@@ -135,25 +270,67 @@ def run_module():
 
     # perform an HD download or a standard res download depending on the value the user passed in to our module
     if module.params['hd']:
-        apodimage = requests.get(nasaresp['hdurl'])
+        imageurl = nasaresp['hdurl']
     else:
-        apodimage = requests.get(nasaresp['url'])
+        imageurl = nasaresp['url']
 
-    # if nasaresp returns a non-200, exit not
-    if apodimage.status_code != 200:
-        module.fail_json(msg=f'A {nasaresp.status_code} response was returned as we tried to download APOD image from NASA. Huston, we have a problem!', **result)
+    # download the image to the location provided by the user (or link it from the image store)
+    store = open_store(module)
+    saved = save_image(imageurl, module.params['dest'], store)
+
+    # if the image could not be downloaded, exit not
+    if saved['status'] == 'failed':
+        module.fail_json(msg=f"{saved['msg']} from NASA. Huston, we have a problem!", **result)
 
-    # download the image to the location provided by the user
-    with open(module.params['dest'], 'wb') as f:
-        f.write(apodimage.content)
+    result['download'] = saved['download']
+    if store is not None:
+        result['image_store'] = dict(status=saved['status'], digest=saved['digest'], method=saved['method'])
 
-    # a photo being written out is a state change
-    result['changed'] = True
+    # a photo being written out is a state change (an identical photo already linked at dest is not)
+    result['changed'] = saved['method'] != 'present'
 
     # in the event of a successful module execution, you will want to
     # simple AnsibleModule.exit_json(), passing the key/value results
     module.exit_json(**result)
 
+def run_multi(module, result):
+    """handle start_date/end_date and count lookups, downloading every image into dest_dir"""
+    if module.params.get('count'):
+        api = f"{NASAAPOD}?hd={module.params['hd']}&api_key={module.params['apikey']}&count={module.params['count']}"
+    else:
+        api = f"{NASAAPOD}?hd={module.params['hd']}&api_key={module.params['apikey']}&start_date={module.params['start_date']}"
+        if module.params.get('end_date'):
+            api = f"{api}&end_date={module.params['end_date']}"
+
+    nasaresp = requests.get(api)
+
+    # if nasaresp returns a non-200, exit not
+    if nasaresp.status_code != 200:
+        module.fail_json(msg=f'A {nasaresp.status_code} response was returned from NASA. Huston, we have a problem!', **result)
+
+    entries = nasaresp.json()
+    result['apodjson'] = entries
+
+    dest_dir = module.params['dest_dir']
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+
+    # download the images through a bounded pool of workers
+    store = open_store(module)
+    result['items'] = bounded_map(
+        lambda entry: download_apod(entry, module.params['hd'], dest_dir, module.params['filename_template'], store),
+        entries,
+        module.params['workers'])
+
+    # any photo being written out is a state change
+    result['changed'] = any(item['status'] == 'downloaded' for item in result['items'])
+
+    failed = [item for item in result['items'] if item['status'] == 'failed']
+    if failed:
+        module.fail_json(msg=f'{len(failed)} of {len(entries)} APOD images could not be downloaded. Huston, we have a problem!', **result)
+
+    module.exit_json(**result)
+
 def main():
     run_module()
 
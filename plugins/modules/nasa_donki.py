@@ -49,6 +49,59 @@ options:
         description: 'type' could be: all, FLR, SEP, CME, IPS, MPC, GST, RBE, or report. Default: 'all'
         required: false
         type: str
+    parallel:
+        description: Split the lookup into one per type (when datatype is all) and per window_days of the span, send them at the same time, then merge the notifications sorted by messageIssueTime with duplicates dropped. Default: false
+        required: false
+        type: bool
+    window_days:
+        description: With parallel, the number of days covered by each lookup. Default: 7
+        required: false
+        type: int
+    workers:
+        description: With parallel, the number of lookups sent at the same time. Default: 4, the maximum is 16
+        required: false
+        type: int
+    rate_limit:
+        description: With parallel, the most lookups sent per second across all workers. Set to 0 to turn the limit off. Default: 2
+        required: false
+        type: float
+    sync:
+        description: Incremental sync against the local store. Only the span since the newest messageIssueTime in the store (minus sync_overlap_days) is looked up, only notifications with a messageID not in the store are appended to the output file, and donkijson holds only those. The first sync uses startdate. Requires store. Default: false
+        required: false
+        type: bool
+    store:
+        description: Path to the SQLite database of every notification fetched so far, keyed on messageID. Every notification fetched while store is set is recorded there, along with a full-text index of its messageBody.
+        required: false
+        type: str
+    query:
+        description: Search the messageBody of every notification in the store for these words, without any API lookup. Words in double quotes are matched as a phrase. Returns the best matches in matches, no file is written. Requires store.
+        required: false
+        type: str
+    query_limit:
+        description: With query, the most matches returned. Default: 20
+        required: false
+        type: int
+    linked_events:
+        description: Instead of notifications, look up the typed event endpoints (CME, FLR, GST, IPS, SEP, MPC and RBE, or only datatype when it is one of those) for the span, split by window_days and sent at the same time. The events and the links between them (linkedEvents) are recorded in the store, or kept in memory for this run when store is not set. No file is written. Default: false
+        required: false
+        type: bool
+    traverse_from:
+        description: The activity ID (such as 2021-01-01T01:00:00-FLR-001) to walk the linked events from. Answered from the store without any API lookup, unless linked_events is also true, in which case the events are fetched first.
+        required: false
+        type: str
+    traverse_path:
+        description: With traverse_from, the event types to step through, in order. [CME, GST] returns the storms linked to the CMEs linked to traverse_from. When left out, every event linked to traverse_from, directly or not, is returned.
+        required: false
+        type: list
+        elements: str
+    forward_only:
+        description: With traverse_from, never step to an event that started before the event it was reached from. Default: true
+        required: false
+        type: bool
+    sync_overlap_days:
+        description: With sync, how many days before the newest messageIssueTime in the store to look up again, to catch notifications published late. Default: 1
+        required: false
+        type: int
 
 
 # Specify this value according to your collection
@@ -83,6 +136,43 @@ EXAMPLES = r'''
     startdate: 2021-01-01
     enddate: 2021-01-04
     datatype: all   # could be: all, FLR, SEP, CME, IPS, MPC, GST, RBE, or report
+
+# Pull a whole year, one lookup per type and 30 day window, 8 at a time
+- name: Return data for 2021
+  nasa_donki:
+    name: data_2021
+    apikey: qwerty
+    startdate: 2021-01-01
+    enddate: 2021-12-31
+    parallel: true
+    window_days: 30
+    workers: 8
+
+# Poll for new notifications, appending only the ones not seen before to polled.txt
+- name: Sync new DONKI notifications
+  nasa_donki:
+    name: polled
+    apikey: qwerty
+    sync: true
+    store: /var/lib/donki/notifications.db
+
+# Search every notification fetched so far, without going over the network
+- name: Find Earth-directed CMEs with a Kp index forecast
+  nasa_donki:
+    store: /var/lib/donki/notifications.db
+    query: '"Kp index" Earth-directed'
+  register: found
+
+# Fetch January's events, then find every storm caused by CMEs from one flare
+- name: Storms caused by the CMEs of a flare
+  nasa_donki:
+    apikey: qwerty
+    startdate: 2021-01-01
+    enddate: 2021-01-31
+    linked_events: true
+    store: /var/lib/donki/notifications.db
+    traverse_from: 2021-01-20T05:00:00-FLR-001
+    traverse_path: [CME, GST]
 '''
 
 RETURN = r'''
@@ -103,19 +193,197 @@ filemade:
     returned: always
     sample: '/tmp/results.txt'
 donkijson:
-    description: The entire block of json as returned by the API lookup.
+    description: The entire block of json as returned by the API lookup. With parallel, the notifications of every lookup merged, sorted by messageIssueTime, with duplicate messageIDs dropped.
     type: json
     returned: always
     sample: {"iam": "json"}
+matches:
+    description: With query, the matching notifications, best match first. Each has messageID, messageType, messageIssueTime, snippet (the matched words in brackets) and rank (smaller is better).
+    type: list
+    returned: when query is used
+    sample: [{"messageID": "20210102-AL-001", "messageType": "CME", "messageIssueTime": "2021-01-02T12:34Z", "snippet": "...an [Earth-directed] CME...", "rank": -4.2}]
+events:
+    description: With linked_events, the number of events returned by the lookups, how many of them were new or changed in the store, and how many events the store now holds.
+    type: dict
+    returned: when linked_events is true
+    sample: {"fetched": 120, "changed": 14, "stored": 5321}
+traversal:
+    description: With traverse_from, the events reached. Each has activityID, type, time, depth (number of steps from traverse_from), via (the activity ID it was reached from) and event (the event as NASA returned it, or null when it is only known from a link).
+    type: list
+    returned: when traverse_from is used
+    sample: [{"activityID": "2021-01-22T12:00:00-GST-001", "type": "GST", "time": "2021-01-22T12:00Z", "depth": 2, "via": "2021-01-20T06:00:00-CME-001", "event": {}}]
+new_count:
+    description: With sync, the number of notifications that were not in the store before this run.
+    type: int
+    returned: when sync is true
+    sample: 3
+lookups:
+    description: With parallel, every lookup sent with its type, startDate, endDate, status_code and the number of notifications returned.
+    type: list
+    returned: when parallel is true
+    sample: [{"type": "FLR", "startDate": "2021-01-01", "endDate": "2021-01-07", "status_code": 200, "count": 3}]
 '''
 
 # you will typically always bring in this toolkit when creating an ansible module
 # other helpful tools are avail aswell
 from ansible.module_utils.basic import AnsibleModule
 
+import os
+import sqlite3
+
 # python3 -m pip install requests
 import requests
 
+from datetime import datetime, timedelta, timezone
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_dates import parse_date, split_windows
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_donki_store import EVENT_TYPES, DonkiStore
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import RateLimiter, bounded_map, limited_get
+
+NASADONKI = "https://api.nasa.gov/DONKI/notifications"
+NASADONKIROOT = "https://api.nasa.gov/DONKI/"
+
+# every value 'type' can take, other than all
+DONKITYPES = ["FLR", "SEP", "CME", "IPS", "MPC", "GST", "RBE", "report"]
+
+def merge_notifications(lists):
+    """merge lists of notifications, dropping repeated messageIDs, sorted by messageIssueTime"""
+    seen = {}
+    for notifications in lists:
+        for entry in notifications:
+            seen.setdefault(entry.get("messageID") or id(entry), entry)
+    # messageIssueTime is ISO 8601 (2021-01-02T12:34Z), so sorting the strings sorts by time
+    return sorted(seen.values(), key=lambda entry: entry.get("messageIssueTime") or "")
+
+def default_span(sd, ed):
+    """same defaults as the API, the 7 days up to the current UT date"""
+    ed = ed or datetime.now(timezone.utc).date().isoformat()
+    sd = sd or (parse_date(ed) - timedelta(days=7)).isoformat()
+    return sd, ed
+
+def parallel_lookup(module, result, sd, ed):
+    """split the span by type and window, look them all up at the same time and merge the results"""
+    apikey = module.params['apikey']
+    sd, ed = default_span(sd, ed)
+
+    try:
+        windows = split_windows(sd, ed, module.params['window_days'])
+    except ValueError as err:
+        module.fail_json(msg=f"startdate and enddate must be in format yyyy-MM-dd. {err}", **result)
+
+    types = DONKITYPES if module.params['datatype'] == "all" else [module.params['datatype']]
+    limiter = RateLimiter(module.params['rate_limit'])
+
+    def lookup(job):
+        datatype, (start, end) = job
+        api = f"{NASADONKI}?api_key={apikey}&type={datatype}&startDate={start}&endDate={end}"
+        info = dict(type=datatype, startDate=start, endDate=end, status_code=0, count=0)
+        try:
+            resp = limited_get(api, limiter)
+        except requests.exceptions.RequestException as err:
+            info['msg'] = str(err)
+            return info, []
+        info['status_code'] = resp.status_code
+        if resp.status_code != 200:
+            return info, []
+        # a 200 with an empty body means there was nothing in that window
+        if not resp.content.strip():
+            return info, []
+        try:
+            notifications = resp.json() or []
+        except ValueError:
+            # a truncated answer or a gateway error page, the window is missing
+            info['msg'] = 'the window was not valid JSON'
+            return info, []
+        info['count'] = len(notifications)
+        return info, notifications
+
+    jobs = [(datatype, window) for datatype in types for window in windows]
+    answers = bounded_map(lookup, jobs, module.params['workers'])
+
+    result['lookups'] = [info for info, _ in answers]
+    result['status_code'] = max(info['status_code'] for info in result['lookups'])
+    failed = [info for info in result['lookups'] if info['status_code'] != 200 or info.get('msg')]
+    if failed:
+        result['status_code'] = failed[0]['status_code']
+        module.fail_json(msg=f'Huston we have a problem. {len(failed)} of {len(jobs)} lookups did not return the expected 200 (or were not JSON).', **result)
+
+    return merge_notifications(notifications for _, notifications in answers)
+
+def fetch_events(module, result, store, sd, ed):
+    """look up the typed event endpoints for every window at the same time, recording them in the store"""
+    apikey = module.params['apikey']
+    sd, ed = default_span(sd, ed)
+    try:
+        windows = split_windows(sd, ed, module.params['window_days'])
+    except ValueError as err:
+        module.fail_json(msg=f"startdate and enddate must be in format yyyy-MM-dd. {err}", **result)
+
+    datatype = module.params['datatype'].upper()
+    types = [datatype] if datatype in EVENT_TYPES else list(EVENT_TYPES)
+    limiter = RateLimiter(module.params['rate_limit'])
+
+    def lookup(job):
+        etype, (start, end) = job
+        api = f"{NASADONKIROOT}{etype}?api_key={apikey}&startDate={start}&endDate={end}"
+        info = dict(type=etype, startDate=start, endDate=end, status_code=0, count=0)
+        try:
+            resp = limited_get(api, limiter)
+        except requests.exceptions.RequestException as err:
+            info['msg'] = str(err)
+            return info, []
+        info['status_code'] = resp.status_code
+        if resp.status_code != 200:
+            return info, []
+        # a 200 with an empty body means there were no events in that window
+        if not resp.content.strip():
+            return info, []
+        try:
+            events = resp.json() or []
+        except ValueError:
+            # a truncated answer or a gateway error page, the window is missing
+            info['msg'] = 'the window was not valid JSON'
+            return info, []
+        info['count'] = len(events)
+        return info, events
+
+    jobs = [(etype, window) for etype in types for window in windows]
+    answers = bounded_map(lookup, jobs, module.params['workers'])
+    result['lookups'] = [info for info, _ in answers]
+
+    # sqlite is written from this thread only, once every lookup is back
+    changed = 0
+    for info, events in answers:
+        changed += store.add_events(info['type'], events)
+    result['events'] = dict(fetched=sum(info['count'] for info in result['lookups']), changed=changed, stored=store.event_count())
+
+    failed = [info for info in result['lookups'] if info['status_code'] != 200 or info.get('msg')]
+    if failed:
+        result['status_code'] = failed[0]['status_code']
+        module.fail_json(msg=f'Huston we have a problem. {len(failed)} of {len(jobs)} lookups did not return the expected 200 (or were not JSON). Rerun to fill in the rest.', **result)
+    result['status_code'] = 200
+    return changed
+
+def run_events(module, result, sd, ed):
+    """fetch the linked events and / or walk them, then exit"""
+    persistent = bool(module.params['store'])
+    if not module.params['linked_events'] and not os.path.isfile(module.params['store']):
+        module.fail_json(msg=f"The store {module.params['store']} does not exist, fetch events into it with linked_events first", **result)
+    store = DonkiStore(module.params['store'] if persistent else ":memory:")
+
+    if module.params['linked_events']:
+        changed = fetch_events(module, result, store, sd, ed)
+        # only a store on disk is a change on the host
+        result['changed'] = persistent and changed > 0
+
+    if module.params['traverse_from']:
+        result['traversal'] = store.traverse(
+            module.params['traverse_from'],
+            path=module.params['traverse_path'],
+            forward_only=module.params['forward_only'])
+    store.close()
+    module.exit_json(**result)
+
 def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
@@ -124,7 +392,20 @@ def run_module():
         apikey=dict(type='str', required=False, default="DEMO_KEY"),
         startdate=dict(type='str', required=False),
         enddate=dict(type='str', required=False),
-        datatype=dict(type='str', required=False, default="all")
+        datatype=dict(type='str', required=False, default="all"),
+        parallel=dict(type='bool', required=False, default=False),
+        window_days=dict(type='int', required=False, default=7),
+        workers=dict(type='int', required=False, default=4),
+        rate_limit=dict(type='float', required=False, default=2.0),
+        sync=dict(type='bool', required=False, default=False),
+        store=dict(type='str', required=False),
+        sync_overlap_days=dict(type='int', required=False, default=1),
+        query=dict(type='str', required=False),
+        query_limit=dict(type='int', required=False, default=20),
+        linked_events=dict(type='bool', required=False, default=False),
+        traverse_from=dict(type='str', required=False),
+        traverse_path=dict(type='list', elements='str', required=False),
+        forward_only=dict(type='bool', required=False, default=True)
     )
 
     # seed the result dict in the object
@@ -146,15 +427,50 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        required_by={'query': 'store'},
+        required_if=[('sync', True, ('store',))],
+        mutually_exclusive=[('query', 'sync'), ('query', 'linked_events'), ('sync', 'linked_events')],
     )
 
+    # a query is answered from the local full-text index, no API lookup and no state change
+    if module.params['query']:
+        if not os.path.isfile(module.params['store']):
+            module.fail_json(msg=f"The store {module.params['store']} does not exist, fetch some notifications into it first", **result)
+        store = DonkiStore(module.params['store'])
+        result['matches'] = store.search(module.params['query'], module.params['query_limit'])
+        store.close()
+        module.exit_json(**result)
+
+    # walking events already in the store is local as well, no API lookup and no state change
+    if module.params['traverse_from'] and not module.params['linked_events']:
+        if not module.params['store']:
+            module.fail_json(msg="traverse_from needs store, or linked_events to fetch the events first", **result)
+        run_events(module, result, None, None)
+
     ## put together the API we want to lookup
     apikey = module.params['apikey']   # grab the value of apikey passed by the user or defaulting to DEMO_KEY
     datatype = module.params['datatype'] # grab the value of datatype passed by the user or default to "all"
     sd = module.params['startdate']
     ed = module.params['enddate']
-    
+
+    # a sync only asks for the span since the newest notification we already have
+    if module.params['sync']:
+        last = None
+        if os.path.isfile(module.params['store']):
+            try:
+                store = DonkiStore(module.params['store'])
+                last = store.last_issue_time()
+                store.close()
+            except sqlite3.Error as err:
+                module.fail_json(msg=f"Could not read the store {module.params['store']}: {err}", **result)
+        if last:
+            sd = (parse_date(last[:10]) - timedelta(days=module.params['sync_overlap_days'])).isoformat()
+        try:
+            sd, ed = default_span(sd, ed)
+        except ValueError as err:
+            module.fail_json(msg=f"startdate and enddate must be in format yyyy-MM-dd. {err}", **result)
+
     api = f"https://api.nasa.gov/DONKI/notifications?api_key={apikey}&type={datatype}&startDate={sd}&endDate={ed}"
     result['api_lookedup'] = api # this allows the user to run check mode and see what API would be sent an HTTP GET
 
@@ -164,34 +480,75 @@ def run_module():
     if module.check_mode:
         module.exit_json(**result)
 
-    # manipulate or modify the state as needed (this is going to be the
-    # part where your module will do what it needs to do)
-    nasaresponse = requests.get(api) # the api we created with our fstring we now send an HTTP GET
-    
-    # allow our consumer to know what response code was returned
-    result['status_code'] = nasaresponse.status_code
-
-    if nasaresponse.status_code != 200:
-        module.fail_json(msg='Huston we have a problem. HTTP status code returned was not the expected 200.', **result)
+    # the typed event endpoints are fetched into the store (or memory), not into a file
+    if module.params['linked_events']:
+        run_events(module, result, sd, ed)
 
     fl = module.params['dest'].rstrip("/")  # strip off any trailing slash that may or may not be there
     fn = module.params['name']
     savloc = f"{fl}/{fn}.txt"
 
-    if nasaresponse.json():
-        nj = nasaresponse.json()
+    # manipulate or modify the state as needed (this is going to be the
+    # part where your module will do what it needs to do)
+    if module.params['parallel']:
+        # many smaller lookups sent at the same time, merged back into one list
+        nj = parallel_lookup(module, result, sd, ed)
+        if not nj and not module.params['sync']:
+            module.exit_json(**result)  # nothing was returned in any window, no file produced (no state change)
     else:
-        module.exit_json(**result)  # lookup was given 200, but there was no JSON attached to it :(
-                                    # no file produced (no state change)
+        nasaresponse = requests.get(api) # the api we created with our fstring we now send an HTTP GET
+
+        # allow our consumer to know what response code was returned
+        result['status_code'] = nasaresponse.status_code
+
+        if nasaresponse.status_code != 200:
+            module.fail_json(msg='Huston we have a problem. HTTP status code returned was not the expected 200.', **result)
+
+        if nasaresponse.json():
+            nj = nasaresponse.json()
+        elif module.params['sync']:
+            nj = []
+        else:
+            module.exit_json(**result)  # lookup was given 200, but there was no JSON attached to it :(
+                                        # no file produced (no state change)
+
+    # keep only the notifications the store has not seen, those are appended to the file
+    mode = "w"
+    store = None
+    if module.params['sync']:
+        store = DonkiStore(module.params['store'])
+        # only marked as seen once they are in the file, a failed write is retried by the next sync
+        nj = store.add(merge_notifications([nj]), commit=False)
+        result['new_count'] = len(nj)
+        if not nj:
+            store.set_meta('last_sync', datetime.now(timezone.utc).isoformat())
+            store.close()
+            module.exit_json(**result)  # nothing new since the last sync (no state change)
+        mode = "a"
 
     result['donkijson'] = nj  # return ALL of the json within our results
                               # thought is a consumer might want data beyond "just" the messageBody key
 
     # open our file we want to write out our data to
-    with open(savloc, "w") as nasaf:
-        for entry in nj:
-            nasaf.write(entry.get("messageBody"))
-            nasaf.write("\n------\n")
+    try:
+        with open(savloc, mode) as nasaf:
+            for entry in nj:
+                nasaf.write(entry.get("messageBody") or "")
+                nasaf.write("\n------\n")
+    except OSError as err:
+        if store is not None:
+            store.db.rollback()
+            store.close()
+        module.fail_json(msg=f"Could not write {savloc}: {err}", **result)
+
+    if store is not None:
+        store.set_meta('last_sync', datetime.now(timezone.utc).isoformat())  # commits the new messageIDs too
+        store.close()
+    elif module.params['store']:
+        # record (and index) everything fetched, the file still gets all of it
+        store = DonkiStore(module.params['store'])
+        store.add(merge_notifications([nj]))
+        store.close()
 
     result['filemade'] = savloc  # this is the location of the file we just created
     # if we made it this far, a file was created on the host executing the module
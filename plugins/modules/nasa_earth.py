@@ -37,6 +37,14 @@ options:
         description:
             - This is the location and name to save the PNG to. Defaults to /tmp/example.png
         required: false
+    image_store:
+        description:
+            - Path to a content-addressed image store shared with other tasks (and nasa_apod). An image already in the store is hard linked (or reflinked / copied) to dest instead of being downloaded again. Not used by default.
+        required: false
+    image_store_max_mb:
+        description:
+            - Once the image store grows past this many MB the least recently used images are removed from it. Defaults to 0, never trim the store.
+        required: false
 
 author:
     - Russell Zachary Feeser (@rzfeeser)
@@ -51,6 +59,16 @@ EXAMPLES = '''
     lat:
     dest: /tmp/example.png
     date: 2016-03-09
+
+# Reuse the image if any task on this host already pulled it
+- name: Pull an image from the NASA Image API through the shared image store
+  nasaimagery:
+    apikey: DEMO_KEY
+    lon: 77.593675
+    lat: 12.972172
+    dest: /tmp/bangalore.png
+    image_store: /var/cache/nasa_images
+    image_store_max_mb: 2048
 '''
 
 RETURN = '''
@@ -62,10 +80,18 @@ urlearth:
     description: URL to Google Earth thumbnail that was used to download PNG
     type: str
     returned: always
+download:
+    description: Statistics about the image transfer - bytes, transferred, resumed, seconds, throughput (bytes per second), digest (sha256) and verified - how the digest was checked, server when the server sent a Digest, Repr-Digest or Content-MD5 header for the image and empty when it sent none (the digest is then only reported). Empty when the image came from the image store.
+    type: dict
+    returned: always
+image_store:
+    description: How the image was placed at dest when image_store is used. Has status (downloaded or cached), digest (sha256) and method (hardlink, reflink, copy or present).
+    type: dict
+    returned: when image_store is used
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-import requests
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_imagestore import ImageStore, save_image
 
 def run_module():
     # define available arguments/parameters a user can pass to the module
@@ -74,7 +100,9 @@ def run_module():
         date=dict(type='str', required=False, default="2016-03-09"),
         lon=dict(type='float', required=True),
         lat=dict(type='float', required=True),
-        dest=dict(type='str', required=False, default="/tmp/example.png")
+        dest=dict(type='str', required=False, default="/tmp/example.png"),
+        image_store=dict(type='str', required=False),
+        image_store_max_mb=dict(type='int', required=False, default=0)
     )
 
     # seed the result dict in the object
@@ -110,24 +138,25 @@ def run_module():
         module.exit_json(**result)
 
 
-    # begin NASA lookup
-    nasaresp = requests.get(nasaurl)
-    # if a non-200 response, then FAIL
-    if nasaresp.status_code != 200:
-        module.fail_json(msg='A non-200 response was returned from NASA', **result)        
-    # strip off json response and reassign to nasaresp
-    # nasaresp = nasaresp.json()
+    # the same lon/lat/date always returns the same picture, so when the
+    # user gave us an image store, link the picture from there if we have it
+    store = None
+    if module.params['image_store']:
+        store = ImageStore(module.params['image_store'], max_bytes=module.params['image_store_max_mb'] * 1024 * 1024)
 
-    # begin Google Earth lookup (url taken from NASA lookup)
-    # googleearth = requests.get( nasaresp["url"] )
+    # begin NASA lookup, the picture is streamed to dest (resuming a partial
+    # download left behind by an earlier run) rather than held in memory
+    saved = save_image(nasaurl, module.params['dest'], store)
     # if a non-200 response, then FAIL
-    if nasaresp.status_code != 200:
-        module.fail_json(msg='A non-200 response was returned from Google Earth', **result)
-    # save the picture to the dest provided
-    with open( module.params['dest'], 'wb') as f:
-        f.write(nasaresp.content)
+    if saved['status'] == 'failed':
+        module.fail_json(msg=f"{saved['msg']} (a non-200 response was returned from NASA)", **result)
+
+    result['download'] = saved['download']
+    if store is not None:
+        result['image_store'] = dict(status=saved['status'], digest=saved['digest'], method=saved['method'])
 
-    result['changed'] = True
+    # an identical picture already linked at dest is not a change
+    result['changed'] = saved['method'] != 'present'
 
     # in the event of a successful module execution, you will want to
     # simple AnsibleModule.exit_json(), passing the key/value results
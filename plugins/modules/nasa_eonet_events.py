@@ -25,9 +25,13 @@ options:
         description:
             - Filter the returned events by the Source. Multiple sources can be included in the parameter as a comma seperated list. For values within source, see https://eonet.sci.gsfc.nasa.gov/docs/v3#sourceFields
         required: false
+    category:
+        description:
+            - Filter the returned events by the Category id (such as wildfires or severeStorms). Multiple categories can be included in the parameter as a comma seperated list. For values within category, see https://eonet.sci.gsfc.nasa.gov/docs/v3#categoriesAPI
+        required: false
     status:
         description:
-            - May take the value of "open" or "closed". Events that have ended are assigned a closed date and the existence of that date will allow you to filter for only-open or only-closed events. Omitting the status parameter will return only the currently open events.
+            - May take the value of "open", "closed" or "all". Events that have ended are assigned a closed date and the existence of that date will allow you to filter for only-open or only-closed events. Omitting the status parameter will return only the currently open events (all events when sync is true).
         required: false
     limit:
         description:
@@ -63,6 +67,53 @@ options:
         description:
            - Path a save the converted YAML file to, defaults to current directory. The outputted file is saved in the format eonet-YYYY-MM-DDtoYYY-MM-DD.yml
         required: false
+    sync:
+        description:
+           - Keep the local event store at store up to date instead of writing a dated YAML file. Only the events updated since the last sync are asked for (start is set to the last sync date, less sync_overlap_days, unless start or days is given). New geometry points and closed dates are merged into the events already stored, and every stored event is written to eonet-sync.yml in savepath whenever something changed. Default: false
+        required: false
+        type: bool
+    store:
+        description:
+           - Path to the SQLite event store used by sync. It is created when it does not exist.
+        required: false
+        type: str
+    sync_overlap_days:
+        description:
+           - With sync, how many days before the last sync to ask for, so late updates are not missed. Default: 1
+        required: false
+        type: int
+    spatial_index:
+        description:
+           - With sync, also keep a spatial-temporal index over every geometry point and polygon in the store (an SQLite R*Tree, or a uniform grid when sqlite3 has no R*Tree support), so query_store can answer locally. An existing store is indexed the first time. Default: false
+        required: false
+        type: bool
+    backfill:
+        description:
+           - Pull every event between start and end (both required) as many smaller lookups instead of one. The span is split by calendar month, and by every category and / or source when partition_by is given. The lookups are sent at the same time (workers, under rate_limit lookups per second), and the events are written to eonet-backfill-YYYY-MM-DDtoYYYY-MM-DD.yml in savepath as the lookups come back, dropping repeated event ids, so memory does not grow with the size of the backfill. status defaults to all. When store is set, the events are merged into it as well. Default: false
+        required: false
+        type: bool
+    partition_by:
+        description:
+           - With backfill, also split every month by category and / or source. The values given to category or source are used, otherwise every category (or source) EONET knows about.
+        required: false
+        type: list
+        elements: str
+        choices: [category, source]
+    workers:
+        description:
+           - With backfill, how many lookups are sent at the same time (at most 16). Default: 4
+        required: false
+        type: int
+    rate_limit:
+        description:
+           - With backfill, the most lookups sent per second, across every worker. 0 turns the limit off. Default: 2.0
+        required: false
+        type: float
+    query_store:
+        description:
+           - Answer bbox, start, end (or days), category, status and limit from the spatial index of store instead of the EONET API. Only the geometry points that matched are kept in each event returned. The index is built first if the store does not have one yet, which reports changed (in check mode it is not built and no events are returned). Default: false
+        required: false
+        type: bool
 
 author:
     - Russell Zachary Feeser (@rzfeeser)
@@ -78,6 +129,35 @@ EXAMPLES = '''
   nasa_eonet_event:
     start: 2020-06-15
 
+# Keep a local copy of every event, only asking for what changed since the last run
+- name: Sync EONET events
+  nasa_eonet_event:
+    sync: true
+    store: /var/lib/eonet/events.db
+    savepath: /var/lib/eonet/
+    spatial_index: true
+
+# Every closed wildfire and volcano event of 2019 and 2020, one lookup per month and category
+- name: Backfill EONET events
+  nasa_eonet_event:
+    backfill: true
+    start: 2019-01-01
+    end: 2020-12-31
+    status: closed
+    category: wildfires,volcanoes
+    partition_by: [category]
+    workers: 8
+
+# Wildfires inside a bounding box during June, answered from the local store
+- name: Query synced EONET events
+  nasa_eonet_event:
+    query_store: true
+    store: /var/lib/eonet/events.db
+    bbox: -125,42,-114,32
+    start: 2020-06-01
+    end: 2020-06-30
+    category: wildfires
+
 '''
 
 RETURN = '''
@@ -105,12 +185,36 @@ end_date:
     description: The end date supplied to the NASA EONET Event API
     tye: str
     returned: always
+sync:
+    description: With sync, how many events were added, updated (new geometry points or changed fields) and closed, how many are stored (and still open), and the ids of the events behind each count.
+    type: dict
+    returned: when sync is true
+    sample: {"added": 2, "updated": 5, "closed": 1, "stored": 310, "open": 120, "ids": {"added": ["EONET_6201", "EONET_6202"], "updated": [], "closed": []}}
+backfill:
+    description: With backfill, how many lookups (partitions) were sent, how many events were written, how many repeated events were dropped and the lookups that failed.
+    type: dict
+    returned: when backfill is true
+    sample: {"partitions": 48, "events": 1532, "duplicates": 211, "failed": []}
+events:
+    description: With query_store, the stored events that matched, each with only its matching geometry points.
+    type: list
+    returned: when query_store is true
+query_ms:
+    description: With query_store, how long the local query took, in milliseconds.
+    type: float
+    returned: when query_store is true
 '''
 NASAEONET = "https://eonet.sci.gsfc.nasa.gov/api/v3/events?"
+NASAEONETROOT = "https://eonet.sci.gsfc.nasa.gov/api/v3/"
+
+# the module parameters that are sent to the EONET API as query parameters
+EONETPARAMS = ("source", "category", "status", "limit", "days", "start", "end", "magID", "magMin", "magMax", "bbox")
 
 import os
+import sqlite3
+import time
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from pathlib import Path
 
@@ -123,11 +227,161 @@ import requests
 # python3 -m pip install pyyaml
 import yaml
 
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_dates import parse_date, split_months
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_eonet_store import EonetStore, parse_bbox
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import RateLimiter, bounded_imap, limited_get
+
+def run_query(module, result):
+    """answer the bbox / date range / category filters from the local store, then exit"""
+    if not os.path.isfile(module.params["store"]):
+        module.fail_json(msg=f"The store {module.params['store']} does not exist, sync some events into it first", **result)
+    try:
+        bbox = parse_bbox(module.params["bbox"]) if module.params["bbox"] else None
+        start, end = module.params["start"], module.params["end"]
+        if module.params["days"]:
+            start = (datetime.now(timezone.utc).date() - timedelta(days=int(module.params["days"]) - 1)).isoformat()
+        for d in (start, end):
+            if d:
+                parse_date(d)
+        limit = int(module.params["limit"]) if module.params["limit"] else None
+    except ValueError as err:
+        module.fail_json(msg=f"Could not query the store: {err}", **result)
+    categories = [c.strip() for c in (module.params["category"] or "").split(",") if c.strip()]
+    # same default as the API, only the open events
+    status = module.params["status"] or "open"
+
+    # the index is only built outside check mode, building it is a change to the store
+    store = EonetStore(module.params["store"], spatial=not module.check_mode)
+    if not store.spatial:
+        store.close()
+        result['changed'] = True
+        module.exit_json(msg="The store has no spatial index yet, it would be built first", **result)
+    result['changed'] = store.built
+    started = time.perf_counter()
+    result['events'] = store.query(bbox=bbox, start=start, end=end, categories=categories,
+                                   status=None if status == "all" else status, limit=limit)
+    result['query_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    store.close()
+    result['start_date'] = start
+    result['end_date'] = end
+    module.exit_json(**result)
+
+def partition_values(module, result, field, limiter):
+    """the values to split a backfill by, as given to the module or every one EONET lists"""
+    if module.params[field]:
+        return [v.strip() for v in module.params[field].split(",") if v.strip()]
+    plural = "categories" if field == "category" else "sources"
+    try:
+        resp = limited_get(f"{NASAEONETROOT}{plural}", limiter)
+    except requests.exceptions.RequestException as err:
+        module.fail_json(msg=f"The NASA EONET {plural} lookup was not successful. {err}", **result)
+    if resp.status_code != 200:
+        module.fail_json(msg=f"The NASA EONET {plural} lookup was not successful. STATUS CODE - {resp.status_code}", **result)
+    try:
+        return [entry["id"] for entry in resp.json().get(plural, [])]
+    except (ValueError, AttributeError, KeyError, TypeError):
+        # not JSON, or not the {plural: [{id: ...}]} object EONET lists them in
+        module.fail_json(msg=f"The NASA EONET {plural} lookup did not return the expected JSON", **result)
+
+def run_backfill(module, result):
+    """look up start..end as one partition per month (and category / source), streaming the events to the file"""
+    try:
+        months = split_months(module.params["start"], module.params["end"])
+    except ValueError as err:
+        module.fail_json(msg=f"start and end must be in format YYYY-MM-DD. {err}", **result)
+
+    limiter = RateLimiter(module.params["rate_limit"])
+    splits = dict((field, [module.params[field]]) for field in ("category", "source"))
+    for field in module.params["partition_by"]:
+        splits[field] = partition_values(module, result, field, limiter)
+
+    # every other filter is sent with every partition
+    fixed = dict((mp, module.params[mp]) for mp in EONETPARAMS if mp not in ("start", "end", "days", "category", "source"))
+    if fixed["status"] is None:
+        fixed["status"] = "all"
+
+    def partitions():
+        for start, end in months:
+            for category in splits["category"]:
+                for source in splits["source"]:
+                    yield dict(fixed, start=start, end=end, category=category, source=source)
+
+    def lookup(params):
+        qp = "&".join(f"{mp}={params[mp]}" for mp in EONETPARAMS if params.get(mp) is not None)
+        info = dict(start=params["start"], end=params["end"], category=params["category"], source=params["source"], status_code=0)
+        try:
+            resp = limited_get(f"{NASAEONET}{qp}", limiter, timeout=120)
+        except requests.exceptions.RequestException as err:
+            info["msg"] = str(err)
+            return info, None
+        info["status_code"] = resp.status_code
+        if resp.status_code != 200:
+            return info, None
+        try:
+            return info, resp.json().get("events", [])
+        except ValueError:
+            # a gateway error page with a 200, the partition failed
+            info["msg"] = "the partition was not valid JSON"
+            return info, None
+
+    sp = module.params["savepath"]
+    savename = f"eonet-backfill-{module.params['start']}to{module.params['end']}.yml"
+    part = os.path.join(sp, f"{savename}.part")
+    store = EonetStore(module.params["store"], spatial=module.params["spatial_index"]) if module.params["store"] else None
+
+    # only the event ids are kept for the whole run, every event is written out as soon as it arrives
+    seen = set()
+    stats = dict(partitions=0, events=0, duplicates=0, failed=[])
+    try:
+        with open(part, "w") as myfile:
+            myfile.write("events:\n")
+            for info, events in bounded_imap(lookup, partitions(), module.params["workers"]):
+                stats["partitions"] += 1
+                if events is None:
+                    stats["failed"].append(info)
+                    continue
+                fresh = []
+                for event in events:
+                    if event.get("id") in seen:
+                        stats["duplicates"] += 1
+                        continue
+                    seen.add(event.get("id"))
+                    fresh.append(event)
+                if fresh:
+                    myfile.write(yaml.dump(fresh))
+                if store is not None:
+                    store.merge(events)
+                stats["events"] += len(fresh)
+    except BaseException:
+        # never leave a half written backfill behind
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
+
+    if store is not None:
+        store.close()
+    result['backfill'] = stats
+    result['start_date'] = module.params["start"]
+    result['end_date'] = module.params["end"]
+    if stats["failed"]:
+        os.unlink(part)
+        result['status_code'] = stats["failed"][0]["status_code"]
+        module.fail_json(msg=f"{len(stats['failed'])} of {stats['partitions']} EONET backfill lookups were not successful, no file was written", **result)
+
+    # the file only appears once every partition made it
+    os.replace(part, os.path.join(sp, savename))
+    result['status_code'] = 200
+    result['file_loc'] = sp
+    result['yaml_output_file'] = savename
+    result['changed'] = True
+    module.exit_json(**result)
+
 def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         source=dict(type='str', required=False),
-        status=dict(type='str', required=False, choices=["open", "closed"]),
+        category=dict(type='str', required=False),
+        status=dict(type='str', required=False, choices=["open", "closed", "all"]),
         limit=dict(type='str', required=False),
         days=dict(type='str', required=False),
         start=dict(type='str', required=False),
@@ -136,7 +390,16 @@ def run_module():
         magMin=dict(type='str', required=False),
         magMax=dict(type='str', required=False),
         bbox=dict(type='str', required=False),
-        savepath=dict(type='str', required=False, default=os.getcwd())
+        savepath=dict(type='str', required=False, default=os.getcwd()),
+        sync=dict(type='bool', required=False, default=False),
+        store=dict(type='str', required=False),
+        sync_overlap_days=dict(type='int', required=False, default=1),
+        spatial_index=dict(type='bool', required=False, default=False),
+        backfill=dict(type='bool', required=False, default=False),
+        partition_by=dict(type='list', elements='str', required=False, default=[], choices=["category", "source"]),
+        workers=dict(type='int', required=False, default=4),
+        rate_limit=dict(type='float', required=False, default=2.0),
+        query_store=dict(type='bool', required=False, default=False)
     )
 
     # seed the result dict in the object
@@ -160,25 +423,48 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        required_if=[('sync', True, ('store',)), ('query_store', True, ('store',)), ('backfill', True, ('start', 'end'))],
+        mutually_exclusive=[('sync', 'query_store'), ('sync', 'backfill'), ('query_store', 'backfill')],
     )
 
+    # a query is answered from the spatial index of the store, no API lookup (the only change is building the index)
+    if module.params["query_store"]:
+        run_query(module, result)
+
     # if the user is working with this module in only check mode we do not
     # want to make any changes to the environment, just return the current
     # state with no modifications
     if module.check_mode:
         module.exit_json(**result)
 
+    if module.params["backfill"]:
+        run_backfill(module, result)
+
     # manipulate or modify the state as needed (this is going to be the
     # part where your module will do what it needs to do)
     
     ## create a compelte URI to query (including params)
     ## https://eonet.sci.gsfc.nasa.gov/api/v3/events
+    params = dict((mp, module.params[mp]) for mp in EONETPARAMS)
+
+    # a sync asks for every event (open or closed) updated since the last sync
+    if module.params["sync"]:
+        try:
+            store = EonetStore(module.params["store"], spatial=module.params["spatial_index"])
+            last = store.get_meta("last_sync")
+        except sqlite3.Error as err:
+            module.fail_json(msg=f"Could not read the store {module.params['store']}: {err}", **result)
+        if params["status"] is None:
+            params["status"] = "all"
+        if last and params["start"] is None and params["days"] is None:
+            params["start"] = (parse_date(last) - timedelta(days=module.params["sync_overlap_days"])).isoformat()
+
     queryparams = []
 
-    for mp in module.params:
-        if module.params[mp] is not None and mp != "savepath":
-            queryparams.append(f"{mp}={module.params[mp]}&")
+    for mp in EONETPARAMS:
+        if params[mp] is not None:
+            queryparams.append(f"{mp}={params[mp]}&")
 
     qp = "".join(queryparams).rstrip("&")
 
@@ -194,6 +480,31 @@ def run_module():
     ## strip JSON off HTTP 200 response
     nasaJson = resp.json()
 
+    # merge what changed into the store, the sync file is rewritten only when something did
+    if module.params["sync"]:
+        changes = store.merge(nasaJson.get("events", []))
+        store.set_meta("last_sync", datetime.now(timezone.utc).date().isoformat())
+        result['sync'] = dict(
+            added=len(changes["added"]),
+            updated=len(changes["updated"]),
+            closed=len(changes["closed"]),
+            stored=store.count(),
+            open=store.count("open"),
+            ids=changes,
+        )
+        result['original_nasa_json'] = nasaJson
+        result['status_code'] = resp.status_code
+        result['file_loc'] = module.params["savepath"]
+        result['yaml_output_file'] = "eonet-sync.yml"
+        result['start_date'] = params["start"]
+        result['end_date'] = params["end"]
+        if changes["added"] or changes["updated"]:
+            with open(os.path.join(module.params["savepath"], "eonet-sync.yml"), "w") as myfile:
+                myfile.write(yaml.dump({"events": store.events()}))
+            result['changed'] = True
+        store.close()
+        module.exit_json(**result)
+
     ## convvert JSON to YAML
     nasaYaml = yaml.dump(nasaJson)
 
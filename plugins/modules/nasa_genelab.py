@@ -36,6 +36,50 @@ options:
         description: Number of results returned per page in pagination. Defaults to 25. Use in conjunction with page_number to limit the number of results writtin into output file.
         required: false
         type: int
+    all_pages:
+        description: Write every page of results, not just page_number. The first page tells how many results there are, the remaining pages are then looked up at the same time and written to the output file as they come back. Defaults to false.
+        required: false
+        type: bool
+    workers:
+        description: With all_pages (or manifest, groups of studies), how many pages are looked up at the same time (at most 16). Defaults to 4.
+        required: false
+        type: int
+    rate_limit:
+        description: With all_pages or manifest, the most lookups sent per second, across every worker. 0 turns the limit off. Defaults to 2.0.
+        required: false
+        type: float
+    manifest:
+        description: Path to a local SQLite manifest of every study file seen (study id to file urls, with their metadata and when they were last seen). When given, glds_study_ids is expanded on this host and the studies are looked up in groups of group_size at the same time (workers), every page of each group. Only the files that are new or changed since the last run are appended to the output file, and the difference is returned in diff. It is created when it does not exist.
+        required: false
+        type: str
+    group_size:
+        description: With manifest, how many studies are asked for in one lookup. Defaults to 10.
+        required: false
+        type: int
+    file_pattern:
+        description: With manifest, only write (and download) the files whose name matches this glob, such as *_counts*.csv. Case sensitive.
+        required: false
+        type: str
+    file_category:
+        description: With manifest, only write (and download) the files of this category, such as Processed Data. Case is ignored.
+        required: false
+        type: str
+    catalog_only:
+        description: Answer from the manifest without any API lookup. The files recorded for glds_study_ids that match file_pattern and file_category are written to the output file (replacing what was there) and returned in files. Defaults to false.
+        required: false
+        type: bool
+    download:
+        description: Also download every study file listed, into download_dir/<study>/<file name>. Files are streamed to disk at the same time (workers, but never more than per_host from one host), a partial file left by an interrupted run is resumed, and the size and md5 checksum are verified when the API provides them. Files already present and verified are skipped (with manifest, without hashing them again). Defaults to false.
+        required: false
+        type: bool
+    download_dir:
+        description: With download, the directory the studies are downloaded into. Defaults to path.
+        required: false
+        type: str
+    per_host:
+        description: With download, the most files downloaded from one host at the same time. Defaults to 4.
+        required: false
+        type: int
 
 author:
     - RZFeeser (@RZFeeser)
@@ -57,6 +101,35 @@ EXAMPLES = r'''
   nasa_genelab:
     path: /tmp/
     glds_study_ids: 102,104
+
+- name: Return every page of results, 8 pages at a time
+  nasa_genelab:
+    glds_study_ids: 87-95,137
+    all_pages: true
+    workers: 8
+
+- name: Append only the files that are new or changed since the last run
+  nasa_genelab:
+    glds_study_ids: 87-95,137
+    manifest: /var/lib/genelab/manifest.db
+
+- name: List the processed counts tables already in the manifest, without any API lookup
+  nasa_genelab:
+    glds_study_ids: 87-95,137
+    manifest: /var/lib/genelab/manifest.db
+    catalog_only: true
+    file_pattern: "*counts*"
+    file_category: Processed Data
+    name: counts.txt
+
+- name: Download every file of the studies, 8 at a time
+  nasa_genelab:
+    glds_study_ids: 87-95,137
+    manifest: /var/lib/genelab/manifest.db
+    download: true
+    download_dir: /data/genelab
+    workers: 8
+    per_host: 8
 '''
 
 RETURN = r'''
@@ -76,12 +149,315 @@ filemade:
     type: str
     returned: always
     sample: '/home/student/ans/gene-results.txt'
+total_hits:
+    description: With all_pages, the number of files the first page said there are.
+    type: int
+    returned: when all_pages is true
+    sample: 1337
+pages:
+    description: With all_pages, every page looked up with its status code and the number of files written from it, and msg when it could not be looked up.
+    type: list
+    returned: when all_pages is true
+    sample: [{"page": 0, "status_code": 200, "files": 25}]
+diff:
+    description: With manifest, how many files are new, changed (different url, size, dates or checksum) or removed (no longer listed) since the last run, the files behind each count, and how many files the manifest holds.
+    type: dict
+    returned: when manifest is used
+    sample: {"new": 1, "changed": 0, "removed": 0, "stored": 91, "files": {"new": [{"study_id": "GLDS-87", "file_name": "GLDS-87_metadata.zip", "url": "https://genelab-data.ndc.nasa.gov/genelab/static/media/dataset/GLDS-87_metadata.zip"}], "changed": [], "removed": []}}
+downloads:
+    description: With download, how many files were downloaded, already present (and verified), or failed, and the bytes transferred, followed by every file with its status (downloaded, present or failed), msg, dest, bytes and throughput.
+    type: dict
+    returned: when download is true
+    sample: {"downloaded": 3, "present": 88, "failed": 0, "bytes": 73400320, "files": [{"study_id": "GLDS-87", "file_name": "GLDS-87_metadata.zip", "dest": "/data/genelab/GLDS-87/GLDS-87_metadata.zip", "status": "downloaded", "msg": "", "bytes": 24466773, "throughput": 52428800}]}
+files:
+    description: With catalog_only, the files selected from the manifest.
+    type: list
+    returned: when catalog_only is true
+    sample: [{"study_id": "GLDS-87", "file_name": "GLDS-87_counts.csv", "url": "https://genelab-data.ndc.nasa.gov/genelab/static/media/dataset/GLDS-87_counts.csv", "file_size": 1024, "category": "Processed Data", "date_created": "2020-01-01"}]
+groups:
+    description: With manifest, every group of studies looked up, with its status code and the number of files listed, and msg when it could not be looked up.
+    type: list
+    returned: when manifest is used
+    sample: [{"ids": "87,88,89", "status_code": 200, "files": 27}]
 '''
 
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+
+from urllib.parse import urlparse
+
 import requests
 
 from ansible.module_utils.basic import AnsibleModule
 
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_download import DownloadError, download
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_genelab import GenelabManifest, expand_study_ids, group_ids, matches
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import RateLimiter, bounded_imap, limited_get
+
+# prepend url to lookup with nasa API authority
+NASAROOT = "https://genelab-data.ndc.nasa.gov"
+
+
+def genelab_api(ids, page, size):
+    """the GeneLab files API for one page of results"""
+    return f"{NASAROOT}/genelab/data/glds/files/{ids}/?page={page}&size={size}"
+
+
+def write_page(myfile, rjson, listed=None):
+    """write every study of one page followed by its file urls, returns the number of files written
+
+    every (study, study file) written is also added to listed, when given
+    """
+    files = 0
+    # loop through the data starting by grabbing a study name
+    for study in rjson.get("studies"):
+        myfile.write(f"{study}" + "\n")
+        for studydata in rjson.get("studies").get(study).get("study_files"):
+            myfile.write(f"{NASAROOT}{studydata.get('remote_url')}" + "\n")
+            files += 1
+            if listed is not None:
+                listed.append((study, studydata))
+    return files
+
+
+def total_hits(rjson):
+    """how many files the query matches, over every page"""
+    if rjson.get("total_hits") is not None:
+        return int(rjson["total_hits"])
+    return sum(int(study.get("file_count") or len(study.get("study_files") or [])) for study in rjson.get("studies", {}).values())
+
+
+def write_all_pages(module, result, first, myfile, listed=None):
+    """write the first page, then look up every other page at the same time, writing each as it comes back"""
+    ids = module.params.get('glds_study_ids')
+    size = module.params.get('results_per_page')
+    result["total_hits"] = total_hits(first)
+    result["pages"] = [dict(page=0, status_code=200, files=write_page(myfile, first, listed))]
+    pages = range(1, int(math.ceil(result["total_hits"] / float(size))) if size else 1)
+    limiter = RateLimiter(module.params.get('rate_limit'))
+
+    def lookup(page):
+        try:
+            resp = limited_get(genelab_api(ids, page, size), limiter)
+        except requests.exceptions.RequestException as err:
+            return dict(page=page, status_code=0, msg=str(err)), None
+        if resp.status_code != 200:
+            return dict(page=page, status_code=resp.status_code), None
+        try:
+            return dict(page=page, status_code=200), resp.json()
+        except ValueError:
+            return dict(page=page, status_code=200, msg="the page was not valid JSON"), None
+
+    # the file is only ever written from this thread, in the order the pages finish
+    for info, rjson in bounded_imap(lookup, pages, module.params.get('workers')):
+        if rjson is not None:
+            info["files"] = write_page(myfile, rjson, listed)
+        result["pages"].append(info)
+    result["pages"].sort(key=lambda info: info["page"])
+
+
+def fetch_group(ids, size, limiter):
+    """every page of the files API for one group of studies, returns (info, {study: [study_files]})"""
+    info = dict(ids=ids, status_code=0, files=0)
+    studies = {}
+    page, pages = 0, 1
+    while page < pages:
+        try:
+            resp = limited_get(genelab_api(ids, page, size), limiter)
+        except requests.exceptions.RequestException as err:
+            info["msg"] = str(err)
+            return info, None
+        info["status_code"] = resp.status_code
+        if resp.status_code != 200:
+            return info, None
+        try:
+            rjson = resp.json()
+        except ValueError:
+            info["msg"] = "the page was not valid JSON"
+            return info, None
+        if page == 0:
+            pages = int(math.ceil(total_hits(rjson) / float(size))) if size else 1
+        for study, data in (rjson.get("studies") or {}).items():
+            studies.setdefault(study, []).extend(data.get("study_files") or [])
+        page += 1
+    info["files"] = sum(len(files) for files in studies.values())
+    return info, studies
+
+
+def write_manifest_diff(module, result, myfile, listed=None):
+    """look up every study in groups at the same time, appending only new or changed files to the output"""
+    try:
+        ids = expand_study_ids(module.params.get('glds_study_ids'))
+    except ValueError as err:
+        module.fail_json(msg=f"glds_study_ids could not be expanded: {err}", **result)
+    try:
+        manifest = GenelabManifest(module.params.get('manifest'))
+    except sqlite3.Error as err:
+        module.fail_json(msg=f"Could not open the manifest {module.params.get('manifest')}: {err}", **result)
+
+    size = module.params.get('results_per_page')
+    limiter = RateLimiter(module.params.get('rate_limit'))
+    pattern, category = module.params.get('file_pattern'), module.params.get('file_category')
+    diff = dict(new=[], changed=[], removed=[])
+    result["groups"] = []
+
+    # the manifest and the file are only ever written from this thread, as each group comes back
+    for info, studies in bounded_imap(lambda group: fetch_group(group, size, limiter),
+                                      group_ids(ids, module.params.get('group_size')),
+                                      module.params.get('workers')):
+        result["groups"].append(info)
+        if studies is None:
+            continue
+        # a study of the group that was not listed at all has no files (any more)
+        for number in info["ids"].split(","):
+            studies.setdefault(f"GLDS-{number}", [])
+        for study in sorted(studies):
+            # everything is recorded, only the selection is written (and downloaded)
+            selected = set(f.get("file_name") for f in studies[study] if matches(f, pattern, category))
+            if listed is not None:
+                listed.extend((study, f) for f in studies[study] if f.get("file_name") in selected)
+            changes = manifest.update(study, studies[study], NASAROOT)
+            written = [entry for entry in changes["new"] + changes["changed"] if entry["file_name"] in selected]
+            if written:
+                myfile.write(f"{study}" + "\n")
+                for entry in written:
+                    myfile.write(entry["url"] + "\n")
+            for key in diff:
+                diff[key].extend(changes[key])
+
+    result["diff"] = dict(new=len(diff["new"]), changed=len(diff["changed"]), removed=len(diff["removed"]),
+                          stored=manifest.count(), files=diff)
+    manifest.close()
+    result["status_code"] = max(info["status_code"] for info in result["groups"]) if result["groups"] else 0
+    return any(diff.values())
+
+
+def write_catalog_selection(module, result, filetocreate, listed=None):
+    """write the files the manifest holds for the studies that match the filters, without any API lookup"""
+    try:
+        ids = expand_study_ids(module.params.get('glds_study_ids'))
+    except ValueError as err:
+        module.fail_json(msg=f"glds_study_ids could not be expanded: {err}", **result)
+    if not os.path.isfile(module.params.get('manifest')):
+        module.fail_json(msg=f"The manifest {module.params.get('manifest')} does not exist, run without catalog_only first", **result)
+    manifest = GenelabManifest(module.params.get('manifest'))
+    selected = manifest.select([f"GLDS-{n}" for n in ids], module.params.get('file_pattern'),
+                               module.params.get('file_category'), NASAROOT)
+    manifest.close()
+
+    lines = []
+    for study, study_file in selected:
+        if not lines or lines[-1][0] != study:
+            lines.append((study, []))
+        lines[-1][1].append(f"{NASAROOT}{study_file.get('remote_url')}")
+    text = "".join(f"{study}\n" + "".join(url + "\n" for url in urls) for study, urls in lines)
+
+    result["files"] = [dict(study_id=study, file_name=f["file_name"], url=f"{NASAROOT}{f['remote_url']}", file_size=f["file_size"],
+                            category=f["category"], date_created=f["date_created"]) for study, f in selected]
+    if listed is not None:
+        listed.extend(selected)
+
+    # the output file is the selection, only rewritten when the selection changed
+    current = None
+    if os.path.isfile(filetocreate):
+        with open(filetocreate) as myfile:
+            current = myfile.read()
+    if current == text:
+        return False
+    with open(filetocreate, "w") as myfile:
+        myfile.write(text)
+    return True
+
+
+def file_digest(path, algorithm):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def download_files(module, result, listed):
+    """download every listed study file into download_dir/<study>/, skipping the ones already there and verified"""
+    root = module.params.get('download_dir') or module.params.get('path')
+    manifest = GenelabManifest(module.params.get('manifest')) if module.params.get('manifest') else None
+    per_host = max(1, module.params.get('per_host'))
+    slots = {}
+    slots_lock = threading.Lock()
+
+    def host_slot(url):
+        host = urlparse(url).netloc
+        with slots_lock:
+            if host not in slots:
+                slots[host] = threading.BoundedSemaphore(per_host)
+            return slots[host]
+
+    def jobs():
+        # runs in this thread, the manifest (sqlite) is never touched by a worker
+        seen = set()
+        for study, study_file in listed:
+            # never let a file name from the API climb out of the study directory
+            name = os.path.basename(study_file.get("file_name") or urlparse(study_file.get("remote_url") or "").path)
+            dest = os.path.join(root, os.path.basename(study), name)
+            # a study file listed on two pages (or twice in a range) is downloaded once
+            if dest in seen:
+                continue
+            seen.add(dest)
+            size = study_file.get("file_size")
+            size = int(size) if str(size or "").isdigit() else None
+            checksum = study_file.get("md5") or study_file.get("checksum")
+            known = False
+            if manifest is not None and os.path.isfile(dest):
+                st = os.stat(dest)
+                known = manifest.verified(dest, st.st_size, st.st_mtime, checksum)
+            yield dict(study_id=study, file_name=name, dest=dest, url=f"{NASAROOT}{study_file.get('remote_url')}",
+                       size=size, checksum=checksum, known=known)
+
+    def fetch(job):
+        dest, size, checksum = job["dest"], job["size"], job["checksum"]
+        item = dict(study_id=job["study_id"], file_name=job["file_name"], dest=dest, status="failed", msg="",
+                    bytes=0, throughput=0, digest="")
+
+        if os.path.isfile(dest):
+            st = os.stat(dest)
+            if job["known"]:
+                item.update(status="present", bytes=st.st_size)
+                return item
+            if size is None or st.st_size == size:
+                digest = file_digest(dest, "md5") if checksum else ""
+                if not checksum or digest == checksum.lower():
+                    item.update(status="present", bytes=st.st_size, digest=digest)
+                    return item
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            with host_slot(job["url"]):
+                stats = download(job["url"], dest, expected_size=size, expected_digest=checksum,
+                                 algorithm="md5" if checksum else "sha256")
+        except (DownloadError, OSError) as err:
+            item["msg"] = str(err)
+            return item
+        item.update(status="downloaded", bytes=stats["bytes"], throughput=stats["throughput"], digest=stats["digest"])
+        return item
+
+    items = []
+    for item in bounded_imap(fetch, jobs(), module.params.get('workers')):
+        # record what was just verified, the next run skips it without hashing it again
+        digest = item.pop("digest")
+        if manifest is not None and digest:
+            st = os.stat(item["dest"])
+            manifest.mark_verified(item["dest"], st.st_size, st.st_mtime, digest)
+        items.append(item)
+    if manifest is not None:
+        manifest.close()
+    items.sort(key=lambda item: item["dest"])
+    counts = dict((status, sum(1 for item in items if item["status"] == status)) for status in ("downloaded", "present", "failed"))
+    result["downloads"] = dict(counts, bytes=sum(item["bytes"] for item in items if item["status"] == "downloaded"), files=items)
+    return counts["downloaded"] > 0
+
 
 def run_module():
     # define available arguments/parameters a user can pass to the module
@@ -91,6 +467,17 @@ def run_module():
         glds_study_ids=dict(type='str', required=True),
         page_number=dict(type='int', required=False, default=0),
         results_per_page=dict(type='int', required=False, default=25),
+        all_pages=dict(type='bool', required=False, default=False),
+        workers=dict(type='int', required=False, default=4),
+        rate_limit=dict(type='float', required=False, default=2.0),
+        manifest=dict(type='str', required=False),
+        group_size=dict(type='int', required=False, default=10),
+        download=dict(type='bool', required=False, default=False),
+        download_dir=dict(type='str', required=False),
+        per_host=dict(type='int', required=False, default=4),
+        file_pattern=dict(type='str', required=False),
+        file_category=dict(type='str', required=False),
+        catalog_only=dict(type='bool', required=False, default=False),
     )
 
     # seed the result dict in the object
@@ -111,15 +498,17 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        required_by={'file_pattern': 'manifest', 'file_category': 'manifest'},
+        required_if=[('catalog_only', True, ('manifest',))],
     )
 
     # https://genelab-data.ndc.nasa.gov/genelab/data/glds/files/{GLDS_STUDY_IDs}/?page={CURRENT_PAGE_NUMBER}&size={RESULTS_PER_PAGE}
     # what is the API we are going to lookup
     x = module.params.get('glds_study_ids')
-    y = module.params.get('page_number')
+    y = 0 if module.params.get('all_pages') else module.params.get('page_number')
     z = module.params.get('results_per_page')
-    nasa_api = f"https://genelab-data.ndc.nasa.gov/genelab/data/glds/files/{x}/?page={y}&size={z}"
+    nasa_api = genelab_api(x, y, z)
 
     result["api_lookedup"] = nasa_api  # determined the API to lookup
 
@@ -135,34 +524,57 @@ def run_module():
     if module.check_mode:
         module.exit_json(**result)
 
-    # manipulate or modify the state as needed (this is going to be the
-    # part where your module will do what it needs to do)
-    apilookup = requests.get(nasa_api)
-
-    # write the status code into our results
-    result["status_code"] = apilookup.status_code
-
-    # if a 200 was not returned, fail
-    if apilookup.status_code != 200:
-        module.fail_json(**result)
-
-    # strip json off of HTTP 200+json and convert to pythonic data
-    rjson = apilookup.json()
-
-    # prepend url to lookup with nasa API authority
-    nasaroot =  "https://genelab-data.ndc.nasa.gov"
-
-    with open(filetocreate, "a") as myfile:
-        # loop through the data starting by grabbing a study name
-        for study in rjson.get("studies"):
-            myfile.write(f"{study}"+ "\n")
-            for studydata in rjson.get("studies").get(study).get("study_files"):
-                myfile.write(f"{nasaroot}{studydata.get('remote_url')}" + "\n")
+    # every (study, study file) listed, when they are downloaded as well
+    listed = [] if module.params.get('download') else None
+
+    # a selection from the manifest is answered locally
+    if module.params.get('catalog_only'):
+        result["changed"] = write_catalog_selection(module, result, filetocreate, listed)
+        failed = []
+        lookup_msg = ""
+    # with a manifest, only what changed since the last run is written
+    elif module.params.get('manifest'):
+        with open(filetocreate, "a") as myfile:
+            result["changed"] = write_manifest_diff(module, result, myfile, listed)
+        failed = [info for info in result["groups"] if info["status_code"] != 200 or info.get("msg")]
+        lookup_msg = f"{len(failed)} of {len(result['groups'])} groups of studies could not be looked up (not a 200, or not JSON), rerun to pick them up"
+    else:
+        # manipulate or modify the state as needed (this is going to be the
+        # part where your module will do what it needs to do)
+        apilookup = requests.get(nasa_api)
+
+        # write the status code into our results
+        result["status_code"] = apilookup.status_code
+
+        # if a 200 was not returned, fail
+        if apilookup.status_code != 200:
+            module.fail_json(**result)
+
+        # strip json off of HTTP 200+json and convert to pythonic data
+        rjson = apilookup.json()
+
+        with open(filetocreate, "a") as myfile:
+            if module.params.get('all_pages'):
+                write_all_pages(module, result, rjson, myfile, listed)
+            else:
+                write_page(myfile, rjson, listed)
+        result["changed"] = True
+
+        failed = [info for info in result.get("pages", []) if info["status_code"] != 200 or info.get("msg")]
+        lookup_msg = f"{len(failed)} of {len(result.get('pages', []))} pages could not be looked up (not a 200, or not JSON), the other pages were written"
+
+    # the files of the studies that were looked up are downloaded even when a lookup failed
+    if module.params.get('download'):
+        if download_files(module, result, listed):
+            result["changed"] = True
+        if result["downloads"]["failed"]:
+            module.fail_json(msg=f"{result['downloads']['failed']} of {len(result['downloads']['files'])} files could not be downloaded, rerun to resume them", **result)
+
+    if failed:
+        module.fail_json(msg=lookup_msg, **result)
 
     # in the event of a successful module execution, you will want to
     # simple AnsibleModule.exit_json(), passing the key/value results
-    
-    result["changed"] = True
     module.exit_json(**result)
 
 
@@ -28,6 +28,66 @@ options:
         description: This is a int
         required: false
         type: int || str
+    sol_start:
+        description: Look up every sol from sol_start to sol_end (inclusive) instead of sol.
+        required: false
+        type: int
+    sol_end:
+        description: The last sol looked up with sol_start. Defaults to sol_start.
+        required: false
+        type: int
+    earth_date:
+        description: Look up the photos taken on this Earth date (YYYY-MM-DD) instead of a sol. With earth_date_end, every date from earth_date to earth_date_end (inclusive).
+        required: false
+        type: str
+    earth_date_end:
+        description: The last Earth date (YYYY-MM-DD) looked up with earth_date.
+        required: false
+        type: str
+    camera:
+        description: Only the photos of this camera (FHAZ, RHAZ, MAST, CHEMCAM, MAHLI, MARDI, NAVCAM, PANCAM or MINITES).
+        required: false
+        type: str
+    all_pages:
+        description: The API answers 25 photos per page. Look up every page instead of only the first. Defaults to false, unless a range (sol_start or earth_date_end) is given.
+        required: false
+        type: bool
+    workers:
+        description: How many lookups are sent at the same time for a range or all_pages (at most 16). Defaults to 4.
+        required: false
+        type: int
+    rate_limit:
+        description: The most lookups sent per second, across every worker. 0 turns the limit off. Defaults to 2.0.
+        required: false
+        type: float
+    use_manifest:
+        description: Plan a range (or all_pages) from the rover manifest, which lists the photo count and cameras of every sol. Days without photos (for camera) are never looked up, and without camera exactly as many pages as there are photos are asked for. Defaults to false.
+        required: false
+        type: bool
+    manifest_cache:
+        description: With use_manifest, the file the manifest is cached in. Defaults to mars-rover-manifest-<rover_name>.json in the per-user cache directory, $XDG_CACHE_HOME/rzfeeser.nasa_api or ~/.cache/rzfeeser.nasa_api
+        required: false
+        type: str
+    manifest_max_age:
+        description: With use_manifest, how many hours a cached manifest is used before it is looked up again. Defaults to 24.
+        required: false
+        type: int
+    download:
+        description: Also download the image (img_src) of every photo found, into download_dir/<rover_name>/<sol>/<camera>/<file name>. Images are streamed to disk, workers at a time. Images already downloaded (recorded in photo_index, or already on disk) are skipped. Defaults to false.
+        required: false
+        type: bool
+    download_dir:
+        description: With download, the directory the images are saved in. Defaults to /tmp/mars-rover-photos
+        required: false
+        type: str
+    photo_index:
+        description: A local SQLite index of every photo found (id, sol, camera, Earth date, img_src) and, once downloaded, its path and sha256 digest. Created when it does not exist.
+        required: false
+        type: str
+    query_index:
+        description: Answer sol (or sol_start / sol_end, or earth_date / earth_date_end) and camera from photo_index instead of the API. Defaults to false.
+        required: false
+        type: bool
 
 author:
     - Russell Zachary Feeser (@rzfeeser)
@@ -40,6 +100,48 @@ EXAMPLES = r'''
     apikey: DEMO_KEY
     rover_name: opportunity
     sol: 1000
+
+# Every NAVCAM photo metadata of sols 1000 to 1100, every page, 8 lookups at a time
+- name: Photo metadata for a range of sols
+  nasa_mars_rover_photos:
+    apikey: DEMO_KEY
+    rover_name: curiosity
+    sol_start: 1000
+    sol_end: 1100
+    camera: NAVCAM
+    workers: 8
+
+# Only look up the sols (and pages) the rover manifest says have photos
+- name: Photo metadata for a sparse range of sols
+  nasa_mars_rover_photos:
+    apikey: DEMO_KEY
+    rover_name: curiosity
+    sol_start: 0
+    sol_end: 3000
+    camera: CHEMCAM
+    use_manifest: true
+
+# Download every MAST image of sols 1000 to 1010, recording them in an index
+- name: Download rover images
+  nasa_mars_rover_photos:
+    apikey: DEMO_KEY
+    rover_name: curiosity
+    sol_start: 1000
+    sol_end: 1010
+    camera: MAST
+    download: true
+    download_dir: /data/mars
+    photo_index: /data/mars/photos.db
+
+# Every NAVCAM photo of sols 1000 to 1100 already in the index, without the API
+- name: Query the photo index
+  nasa_mars_rover_photos:
+    rover_name: curiosity
+    sol_start: 1000
+    sol_end: 1100
+    camera: NAVCAM
+    photo_index: /data/mars/photos.db
+    query_index: true
 '''
 
 RETURN = r'''
@@ -58,17 +160,239 @@ json:
     description: The is the json attached to the 200 response to the API we call
     type: dict
     sample: {"photos":[{"id":119096,"sol":1,"camera": ... ... ...
+lookups:
+    description: For a range or all_pages, how many lookups were sent, how many failed, and how many photos were found (after dropping repeated photo ids).
+    type: dict
+    returned: when a range or all_pages is used
+    sample: {"sent": 140, "failed": 0, "photos": 2875}
+plan:
+    description: With use_manifest, how many days were asked for, how many of them are looked up (the manifest says they have photos, or they are newer than the manifest), the lookups planned from it, and whether the manifest came from the cache.
+    type: dict
+    returned: when use_manifest is true and a range or all_pages is used
+    sample: {"days": 101, "days_looked_up": 26, "planned": 64, "cached": true}
+downloads:
+    description: With download, how many images were downloaded, already present, or failed, and the bytes transferred, followed by every image with its id, status (downloaded, present or failed), msg, dest and bytes.
+    type: dict
+    returned: when download is true
+    sample: {"downloaded": 12, "present": 40, "failed": 0, "bytes": 1572864, "files": [{"id": 424905, "status": "downloaded", "msg": "", "dest": "/data/mars/curiosity/1000/MAST/1000MR0044631300503690E01_DXXX.jpg", "bytes": 131072}]}
+index:
+    description: With photo_index, how many photos are in the index, and how many of them were new.
+    type: dict
+    returned: when photo_index is given and the API was looked up
+    sample: {"photos": 2875, "new": 130}
+photos:
+    description: With query_index, the photos in photo_index that matched, ordered by sol, with id, rover, sol, camera, earth_date, img_src, and path, bytes and digest (null until downloaded).
+    type: list
+    returned: when query_index is true
 '''
 
+import os
+
+from datetime import timedelta
+from urllib.parse import urlparse
+
 from ansible.module_utils.basic import AnsibleModule
 import requests
 
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_dates import parse_date
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_download import DownloadError, download
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_rover import (
+    PAGE_SIZE, RoverPhotoIndex, cache_path, camera_name, load_manifest, plan_lookups)
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import RateLimiter, bounded_imap, bounded_map, limited_get
+
+NASAROVERS = "https://api.nasa.gov/mars-photos/api/v1/rovers/"
+NASAMANIFESTS = "https://api.nasa.gov/mars-photos/api/v1/manifests/"
+
+
+def plan_days(module):
+    """the (key, value) of every sol or earth_date to look up, in order"""
+    p = module.params
+    if p['sol_start'] is not None:
+        end = p['sol_end'] if p['sol_end'] is not None else p['sol_start']
+        if end < p['sol_start']:
+            raise ValueError(f"sol_end {end} is before sol_start {p['sol_start']}")
+        return [('sol', sol) for sol in range(p['sol_start'], end + 1)]
+    if p['earth_date'] is not None:
+        start = parse_date(p['earth_date'])
+        end = parse_date(p['earth_date_end'] or p['earth_date'])
+        if end < start:
+            raise ValueError(f"earth_date_end {p['earth_date_end']} is before earth_date {p['earth_date']}")
+        return [('earth_date', (start + timedelta(days=n)).isoformat()) for n in range((end - start).days + 1)]
+    return [('sol', p['sol'])]
+
+
+def photos_url(module, key, value, page):
+    url = f"{NASAROVERS}{module.params['rover_name']}/photos?{key}={value}&page={page}&api_key={module.params['apikey']}"
+    if module.params['camera']:
+        url += f"&camera={module.params['camera']}"
+    return url
+
+
+def fetch_manifest(module, limiter):
+    """the photo_manifest of the rover, from the cache when it is fresh enough"""
+    path = module.params['manifest_cache'] or cache_path(f"mars-rover-manifest-{module.params['rover_name'].lower()}.json")
+
+    def fetch():
+        resp = limited_get(f"{NASAMANIFESTS}{module.params['rover_name']}?api_key={module.params['apikey']}", limiter)
+        if resp.status_code != 200:
+            raise ValueError(f"the manifest lookup returned {resp.status_code}")
+        try:
+            return resp.json().get('photo_manifest') or {}
+        except ValueError:
+            raise ValueError("the manifest lookup did not return valid JSON")
+
+    return load_manifest(path, module.params['manifest_max_age'] * 3600, fetch)
+
+
+def fetch_photos(module, jobs, limiter):
+    """look up every (key, value, page, follow) job at the same time, then the next page of every followed job whose page was full
+
+    returns the merged photos (ordered by sol, then id, repeated ids dropped)
+    and the lookups that failed
+    """
+    def lookup(job):
+        key, value, page, follow = job
+        info = dict(key=key, value=value, page=page, follow=follow, status_code=0)
+        try:
+            resp = limited_get(photos_url(module, key, value, page), limiter)
+        except requests.exceptions.RequestException as err:
+            info['msg'] = str(err)
+            return info, None
+        info['status_code'] = resp.status_code
+        if resp.status_code != 200:
+            return info, None
+        try:
+            return info, resp.json().get('photos') or []
+        except ValueError:
+            # a gateway error page with a 200, report the lookup as failed
+            info['msg'] = 'the page was not valid JSON'
+            return info, None
+
+    photos = {}
+    failed = []
+    sent = 0
+    while jobs:
+        answers = bounded_map(lookup, jobs, module.params['workers'])
+        sent += len(jobs)
+        jobs = []
+        for info, page in answers:
+            if page is None:
+                failed.append(info)
+                continue
+            for photo in page:
+                photos.setdefault(photo.get('id'), photo)
+            # a full page means there may be another one, when the number of pages is not known
+            if info['follow'] and len(page) >= PAGE_SIZE:
+                jobs.append((info['key'], info['value'], info['page'] + 1, True))
+
+    merged = sorted(photos.values(), key=lambda photo: (photo.get('sol') or 0, photo.get('id') or 0))
+    return merged, failed, sent
+
+
+def run_query(module, result):
+    """answer the sol or date range and camera from photo_index, then exit"""
+    p = module.params
+    if not os.path.isfile(p['photo_index']):
+        module.fail_json(msg=f"The photo index {p['photo_index']} does not exist, look up some photos into it first", **result)
+    try:
+        days = plan_days(module)
+        sols = dates = (None, None)
+        if days[0][0] == 'sol':
+            sols = (int(days[0][1]), int(days[-1][1]))
+        else:
+            dates = (days[0][1], days[-1][1])
+    except ValueError as err:
+        module.fail_json(msg=f"Could not plan the query: {err}", **result)
+    index = RoverPhotoIndex(p['photo_index'])
+    result['photos'] = index.query(p['rover_name'], p['camera'], sols[0], sols[1], dates[0], dates[1])
+    index.close()
+    module.exit_json(**result)
+
+
+def download_photos(module, result, photos, index):
+    """download the img_src of every photo into download_dir/<rover>/<sol>/<camera>/, skipping the ones already there"""
+    root = os.path.join(module.params['download_dir'], module.params['rover_name'].lower())
+
+    def jobs():
+        # runs in this thread, the index (sqlite) is never touched by a worker
+        for photo in photos:
+            url = photo.get('img_src')
+            if not url:
+                continue
+            # never let a name from the API climb out of the download directory
+            dest = os.path.join(root, str(int(photo.get('sol') or 0)), os.path.basename(camera_name(photo)) or 'unknown',
+                                os.path.basename(urlparse(url).path))
+            known = index.fetched(photo.get('id')) if index is not None else None
+            yield dict(id=photo.get('id'), url=url, dest=dest, known=known)
+
+    def fetch(job):
+        dest = job['dest']
+        item = dict(id=job['id'], status='failed', msg='', dest=dest, bytes=0, digest='')
+        if os.path.isfile(dest):
+            size = os.path.getsize(dest)
+            # recorded in the index with this path and size, or (without an index) simply there
+            if index is None or (job['known'] and job['known'][0] == dest and job['known'][1] == size):
+                item.update(status='present', bytes=size)
+                return item
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            stats = download(job['url'], dest)
+        except (DownloadError, OSError) as err:
+            item['msg'] = str(err)
+            return item
+        item.update(status='downloaded', bytes=stats['bytes'], digest=stats['digest'])
+        return item
+
+    items = []
+    for item in bounded_imap(fetch, jobs(), module.params['workers']):
+        # record what was just downloaded, the next run skips it
+        digest = item.pop('digest')
+        if index is not None and digest:
+            index.mark_fetched(item['id'], item['dest'], item['bytes'], digest)
+        items.append(item)
+    items.sort(key=lambda item: item['dest'])
+    counts = dict((status, sum(1 for item in items if item['status'] == status)) for status in ('downloaded', 'present', 'failed'))
+    result['downloads'] = dict(counts, bytes=sum(item['bytes'] for item in items if item['status'] == 'downloaded'), files=items)
+    return counts['downloaded'] > 0
+
+
+def save_photos(module, result, photos):
+    """record photos in photo_index and download them when asked to, returns True when anything was downloaded"""
+    index = RoverPhotoIndex(module.params['photo_index']) if module.params['photo_index'] else None
+    changed = False
+    if index is not None:
+        new = index.add(photos)
+        result['index'] = dict(photos=index.count(), new=new)
+    if module.params['download']:
+        changed = download_photos(module, result, photos, index)
+    if index is not None:
+        index.close()
+    if result.get('downloads', {}).get('failed'):
+        module.fail_json(msg=f"{result['downloads']['failed']} of {len(result['downloads']['files'])} images could not be downloaded, rerun to resume them", **result)
+    return changed
+
+
 def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         rover_name=dict(type='str', required=True),
         sol=dict(type='str', required=False, default="1000"),
         apikey=dict(type='str', required=False, default="DEMO_KEY"),
+        sol_start=dict(type='int', required=False),
+        sol_end=dict(type='int', required=False),
+        earth_date=dict(type='str', required=False),
+        earth_date_end=dict(type='str', required=False),
+        camera=dict(type='str', required=False),
+        all_pages=dict(type='bool', required=False),
+        workers=dict(type='int', required=False, default=4),
+        rate_limit=dict(type='float', required=False, default=2.0),
+        use_manifest=dict(type='bool', required=False, default=False),
+        manifest_cache=dict(type='str', required=False),
+        manifest_max_age=dict(type='int', required=False, default=24),
+        download=dict(type='bool', required=False, default=False),
+        download_dir=dict(type='str', required=False, default='/tmp/mars-rover-photos'),
+        photo_index=dict(type='str', required=False),
+        query_index=dict(type='bool', required=False, default=False),
     )
 
     # seed the result dict in the object
@@ -89,14 +413,32 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        mutually_exclusive=[('sol_start', 'earth_date'), ('query_index', 'download')],
+        required_by={'sol_end': 'sol_start', 'earth_date_end': 'earth_date'},
+        required_if=[('query_index', True, ('photo_index',))],
     )
 
+    # a range always wants every page of every day
+    ranged = module.params['sol_start'] is not None or module.params['earth_date'] is not None
+    if module.params['all_pages'] is None:
+        module.params['all_pages'] = ranged
+    try:
+        days = plan_days(module)
+    except ValueError as err:
+        module.fail_json(msg=f"Could not plan the lookups: {err}", **result)
+
     # we can now set our rover name in our resutls we would return
     result['rover_name'] = module.params['rover_name']
 
+    # a query is answered from the photo index, no API lookup and no state change
+    if module.params['query_index']:
+        run_query(module, result)
+
     # put together URL we are about to lookup
     nasaurl2lookup = f"https://api.nasa.gov/mars-photos/api/v1/rovers/{ module.params['rover_name'] }/photos?sol={ module.params['sol'] }&api_key={ module.params['apikey'] }"
+    if ranged or module.params['all_pages'] or module.params['camera']:
+        nasaurl2lookup = photos_url(module, days[0][0], days[0][1], 1)
 
     result['nasa_url'] = nasaurl2lookup
 
@@ -108,9 +450,32 @@ def run_module():
 
     # manipulate or modify the state as needed (this is going to be the
     # part where your module will do what it needs to do)
+    if ranged or module.params['all_pages']:
+        limiter = RateLimiter(module.params['rate_limit'])
+        jobs = [(key, value, 1, module.params['all_pages']) for key, value in days]
+        if module.params['use_manifest']:
+            try:
+                manifest, cached = fetch_manifest(module, limiter)
+            except (ValueError, OSError, requests.exceptions.RequestException) as err:
+                module.fail_json(msg=f"Could not get the {module.params['rover_name']} manifest: {err}", **result)
+            jobs = plan_lookups(manifest, days, module.params['camera'], module.params['all_pages'])
+            result['plan'] = dict(days=len(days), days_looked_up=len(set((key, value) for key, value, _, _ in jobs)),
+                                  planned=len(jobs), cached=cached)
+        photos, failed, sent = fetch_photos(module, jobs, limiter)
+        result['json'] = dict(photos=photos)
+        result['lookups'] = dict(sent=sent, failed=len(failed), photos=len(photos))
+        # the photos that were found are recorded (and downloaded) even when a lookup failed
+        if module.params['photo_index'] or module.params['download']:
+            result['changed'] = save_photos(module, result, photos)
+        if failed:
+            module.fail_json(msg=f"{len(failed)} of {sent} lookups failed (not a 200, or not JSON), the first was {failed[0]}", **result)
+        module.exit_json(**result)
+
     r = requests.get(nasaurl2lookup)
     
     result['json'] = r.json()
+    if module.params['photo_index'] or module.params['download']:
+        result['changed'] = save_photos(module, result, result['json'].get('photos') or [])
     
     # in the event of a successful module execution, you will want to
     # simple AnsibleModule.exit_json(), passing the key/value results
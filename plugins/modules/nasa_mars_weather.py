@@ -36,6 +36,22 @@ options:
         description: This is the NASA API key to send to the module. Default to DEMO_KEY.
         required: false
         type: str
+    store:
+        description: A local SQLite time series of every sol seen (created when it does not exist). Each sol of the report is upserted into it, with the min, max and mean temperature, pressure and wind speed the API reported for it.
+        required: false
+        type: str
+    query_store:
+        description: Answer sol_start to sol_end from store instead of the API, with aggregates over the range. Default to false.
+        required: false
+        type: bool
+    sol_start:
+        description: With query_store, the first sol returned. Defaults to the oldest sol in store.
+        required: false
+        type: int
+    sol_end:
+        description: With query_store, the last sol returned. Defaults to the newest sol in store.
+        required: false
+        type: int
 
 author:
     - RZFeeser (@rzfeeser)
@@ -59,6 +75,21 @@ EXAMPLES = r'''
     name: weatherreport         # the module add *.txt to the file name
     apikey: just1234example     # api key avail from api.nasa.gov
     file_loc: /tmp/
+
+# Keep every sol in a local time series
+- name: Pull Mars weather into a local store
+  nasa_mars_weather:
+    name: weatherreport
+    store: /var/lib/mars/weather.db
+
+# Read sols 400 to 460, with their aggregates, without calling the API
+- name: Query the local store
+  nasa_mars_weather:
+    name: weatherreport
+    store: /var/lib/mars/weather.db
+    query_store: true
+    sol_start: 400
+    sol_end: 460
 '''
 
 RETURN = r'''
@@ -83,11 +114,28 @@ apisearched:
     type: str
     returned: always
     sample: https://api.nasa.gov/insight_weather/?api_key=DEMO_KEY&feedtype=json&ver=1
+sync:
+    description: With store, the sols added to it and the sols updated (revised by the API since they were stored), and how many sols it holds.
+    type: dict
+    returned: when store is given and the API was looked up
+    sample: {"added": [675], "updated": [674], "sols": 211}
+history:
+    description: With query_store, every stored sol of the range, oldest first, with first_utc, last_utc, season, wind_direction (the most common compass point) and the av, mn, mx and ct of temperature, pressure and wind_speed.
+    type: list
+    returned: when query_store is true
+aggregates:
+    description: With query_store, over the range, the number of sols and for temperature, pressure and wind_speed the lowest mn, the highest mx, the mean of av weighted by the number of samples, and how many sols had a reading.
+    type: dict
+    returned: when query_store is true
+    sample: {"sols": 61, "first_sol": 400, "last_sol": 460, "temperature": {"min": -97.2, "max": -12.4, "mean": -62.8, "sols": 61}}
 '''
 
 NASAAPI = "https://api.nasa.gov/insight_weather/?api_key="
 
 # std library imports are first
+import os
+
+from datetime import datetime, timezone
 
 # 3rd party libraries are next
 # python3 -m pip install requests
@@ -95,6 +143,18 @@ import requests
 
 from ansible.module_utils.basic import AnsibleModule
 
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_weather import WeatherStore
+
+
+def run_query(module, result):
+    """answer sol_start to sol_end from the local store, then exit"""
+    if not os.path.isfile(module.params['store']):
+        module.fail_json(msg=f"The store {module.params['store']} does not exist, pull some weather into it first", **result)
+    store = WeatherStore(module.params['store'])
+    result['history'], result['aggregates'] = store.query(module.params['sol_start'], module.params['sol_end'])
+    store.close()
+    module.exit_json(**result)
+
 
 def run_module():
     # define available arguments/parameters a user can pass to the module
@@ -104,6 +164,10 @@ def run_module():
         version=dict(type='int', required=False, default=1),
         feedtype=dict(type='str', required=False, default="json"),
         apikey=dict(type='str', required=False, default="DEMO_KEY"),
+        store=dict(type='str', required=False),
+        query_store=dict(type='bool', required=False, default=False),
+        sol_start=dict(type='int', required=False),
+        sol_end=dict(type='int', required=False),
     )
 
     # seed the result dict in the object
@@ -125,9 +189,14 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        required_if=[('query_store', True, ('store',))],
     )
 
+    # a query is answered from the local store, no API lookup and no state change
+    if module.params['query_store']:
+        run_query(module, result)
+
     # what is the save location going to be
     saveloc = f"{module.params['file_loc']}/{module.params['name']}"
     result["savelocation"] = saveloc
@@ -147,11 +216,24 @@ def run_module():
     r = requests.get(api)
 
     result['status_code'] = r.status_code
+    if r.status_code != 200:
+        module.fail_json(msg=f"A {r.status_code} response was returned by {NASAAPI}", **result)
 
     # pull the JSON response off the 200 code
-    weather = r.json()
+    try:
+        weather = r.json()
+    except ValueError:
+        module.fail_json(msg="The weather report was not valid JSON", **result)
     result['mars_weather'] = weather
 
+    # upsert every sol of the report into the local time series
+    if module.params['store']:
+        store = WeatherStore(module.params['store'])
+        diff = store.upsert(weather)
+        store.set_meta('last_sync', datetime.now(timezone.utc).isoformat())
+        result['sync'] = dict(diff, sols=store.count())
+        store.close()
+
     # save out the file
     with open(f"{saveloc}.txt", "w") as mw:
         mw.write(r.text)
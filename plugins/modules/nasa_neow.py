@@ -21,14 +21,18 @@ description:
     - "This module gets data from NASA NEOW service and converts this data to YAML format, saving it on the local system. The outputted file is saved in the format neow-YYYY-MM-DDtoYYY-MM-DD.yml. By default the file is saved to the local folder, however, the user can control the path as to where the output file is placed. This module will only show CHANGED if the module creates a YAML output file. If the module FAILS it will display the HTTP code associated with the failed response."
 
 options:
+    mode:
+        description:
+            - feed looks up the NEOW feed between startdate and enddate. mirror pages through the whole NEOW browse catalog into the local catalog database. lookup searches the local catalog database, without using the network. Defaults to feed.
+        required: false
     startdate:
         description:
-            - YYYY-MM-DD string format of the start date
-        required: true
+            - YYYY-MM-DD string format of the start date. Required when mode is feed.
+        required: false
     enddate:
         description:
-            - YYYY-MM-DD string format of the end date
-        required: true
+            - YYYY-MM-DD string format of the end date. Required when mode is feed.
+        required: false
     apikey:
         description:
             - Users API key issued from NASA, defaults to DEMO_KEY
@@ -36,7 +40,58 @@ options:
     savepath:
         description:
            - Path a save the converted YAML file to, defaults to current directory
-
+    workers:
+        description:
+           - The NEOW feed only allows 7 days per lookup, so longer ranges are split into 7 day windows. This is the number of windows looked up at the same time. Defaults to 4, the maximum is 16.
+        required: false
+    rate_limit:
+        description:
+           - The most API lookups sent per second across all workers. Defaults to 2. Set to 0 to turn the limit off.
+        required: false
+    summary:
+        description:
+           - Also return a compact summary of every close approach in the feed (nearest misses, fastest objects, potentially hazardous counts per day and diameter statistics). Uses numpy when it is installed. Defaults to false.
+        required: false
+    top_k:
+        description:
+           - The number of nearest misses and fastest objects returned in the summary. Defaults to 5.
+        required: false
+    return_feed:
+        description:
+           - Return the feed in original_nasa_json. Set to false together with summary to avoid shipping the whole feed back to the controller. The YAML file is always written. Defaults to true.
+        required: false
+    catalog:
+        description:
+           - Path to the SQLite database the browse catalog is mirrored into, and searched by mode lookup. Required when mode is mirror or lookup.
+        required: false
+    refresh:
+        description:
+           - In mode mirror, fetch every page again, even those an interrupted mirror already got. Otherwise a mirror that failed part way resumes with the pages it did not get, while a mirror that completed starts over on the next run (fetching every page), so changed objects are picked up. Defaults to false.
+        required: false
+    neo_id:
+        description:
+           - In mode lookup, the NEO reference ID to return.
+        required: false
+    name:
+        description:
+           - In mode lookup, return objects with a word of their name starting with each word of this text (case insensitive), so eros finds 433 Eros (A898 PA) and 2010 pk finds (2010 PK9).
+        required: false
+    hazardous:
+        description:
+           - In mode lookup, return only potentially hazardous (true) or only harmless (false) objects.
+        required: false
+    orbit_class:
+        description:
+           - In mode lookup, return only objects of this orbit class (such as APO, ATE, AMO or IEO).
+        required: false
+    limit:
+        description:
+           - In mode lookup, the most objects returned. Defaults to 100, 0 returns every match.
+        required: false
+    checkpoint:
+        description:
+           - Path to a checkpoint file. Every window that is looked up is recorded here, and windows already in the checkpoint are not looked up again, so an interrupted backfill resumes where it stopped. The checkpoint is removed once every window was looked up and the file is written, so a later run asks the API again. Not used by default.
+        required: false
 
 
 author:
@@ -64,13 +119,55 @@ EXAMPLES = '''
    apikey: DEMO_KEY
    savepath: /home/student/
 
+# Backfill all of 2019, 7 day windows are looked up 8 at a time and recorded
+# in a checkpoint, so rerunning after a failure only looks up what is missing
+- name: Get a year of astroid data
+  nasa_neow:
+    startdate: 2019-01-01
+    enddate: 2019-12-31
+    apikey: DEMO_KEY
+    workers: 8
+    checkpoint: /home/student/neow-2019.checkpoint
+
+# Return only the 10 nearest misses / fastest objects, not the whole feed
+- name: Which astroids came closest
+  nasa_neow:
+    startdate: 2020-06-01
+    enddate: 2020-06-30
+    apikey: DEMO_KEY
+    summary: true
+    top_k: 10
+    return_feed: false
+
+# Mirror the whole NEOW catalog into a local database (rerun to resume)
+- name: Mirror the NEOW browse catalog
+  nasa_neow:
+    mode: mirror
+    catalog: /home/student/neow-catalog.db
+    apikey: DEMO_KEY
+    workers: 8
+
+# Search the local catalog, no API lookups are sent
+- name: Find potentially hazardous Apollo astroids
+  nasa_neow:
+    mode: lookup
+    catalog: /home/student/neow-catalog.db
+    hazardous: true
+    orbit_class: APO
+    limit: 20
+
 '''
 
 RETURN = '''
 original_nasa_json:
-    description: This is the JSON as returned by NASA by their NEOW API
+    description: This is the JSON as returned by NASA by their NEOW API. Empty when return_feed is false.
     type: dict
     returned: always
+summary:
+    description: The close approach summary - objects, close_approaches, hazardous_objects, nearest_misses, fastest, hazardous_per_day, diameter_km (count, min, max, mean, median) and backend (numpy or array)
+    type: dict
+    returned: when summary is true
+    sample: {"objects": 120, "close_approaches": 120, "hazardous_objects": 9, "nearest_misses": [{"id": "3542519", "name": "(2010 PK9)", "date": "2020-06-15", "miss_distance_km": 384000.2, "velocity_kps": 12.5, "hazardous": false}], "hazardous_per_day": {"2020-06-15": 2}, "backend": "numpy"}
 status_code:
     description: The status code the JSON was returned on
     type: str
@@ -91,10 +188,27 @@ end_date:
     description: The end date supplied to the NASA NEOW API
     tye: str
     returned: always
+catalog:
+    description: In mode mirror, the state of the local catalog - path, objects (rows in the catalog), pages (total pages in the NEOW catalog), pages_fetched and changed (rows added or updated)
+    type: dict
+    returned: when mode is mirror
+    sample: {"path": "/home/student/neow-catalog.db", "objects": 31482, "pages": 1575, "pages_fetched": 1575, "changed": 31482}
+neos:
+    description: In mode lookup, the objects found in the local catalog, exactly as NASA returned them
+    type: list
+    returned: when mode is lookup
+windows:
+    description: The 7 day windows the range was split into, and whether each was looked up or read from the checkpoint
+    type: list
+    returned: always
+    sample: [{"start": "2019-01-01", "end": "2019-01-07", "source": "api"}]
 '''
 NASANEOW = "https://api.nasa.gov/neo/rest/v1/feed?"
+NASANEOWBROWSE = "https://api.nasa.gov/neo/rest/v1/neo/browse?"
 
+import json
 import os
+import threading
 
 from pathlib import Path
 
@@ -107,13 +221,140 @@ import requests
 # python3 -m pip install pyyaml
 import yaml
 
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_dates import split_windows
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_neo import NeoCatalog, summarize_feed
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import RateLimiter, bounded_map, limited_get
+
+# the NEOW feed refuses lookups longer than 7 days
+WINDOW_DAYS = 7
+
+# the largest page the NEOW browse endpoint hands out
+BROWSE_PAGE_SIZE = 20
+
+def read_checkpoint(path):
+    """return {(start, end): json} for every window recorded in the checkpoint file"""
+    done = {}
+    if not path or not os.path.isfile(path):
+        return done
+    with open(path) as cp:
+        for line in cp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short when the last run was interrupted
+            done[(entry['start'], entry['end'])] = entry['json']
+    return done
+
+def merge_windows(results):
+    """merge the json of each window into one feed, near_earth_objects in date order"""
+    neos = {}
+    for nasaJson in results:
+        neos.update(nasaJson.get('near_earth_objects', {}))
+    ordered = {day: neos[day] for day in sorted(neos)}
+    return dict(
+        element_count=sum(len(objs) for objs in ordered.values()),
+        near_earth_objects=ordered
+    )
+
+def run_mirror(module, result):
+    """page through the NEOW browse catalog into the local catalog database"""
+    ak = module.params['apikey']
+    catalog = NeoCatalog(module.params['catalog'])
+    if module.params['refresh']:
+        catalog.reset_pages()
+    limiter = RateLimiter(module.params['rate_limit'])
+
+    def lookup(page):
+        lookMeUp = f"{NASANEOWBROWSE}page={page}&size={BROWSE_PAGE_SIZE}&api_key={ak}"
+        try:
+            resp = limited_get(lookMeUp, limiter)
+        except requests.exceptions.RequestException as err:
+            return dict(page=page, status_code=0, json=None, msg=str(err))
+        if resp.status_code != 200:
+            return dict(page=page, status_code=resp.status_code, json=None, msg='')
+        try:
+            return dict(page=page, status_code=200, json=resp.json(), msg='')
+        except ValueError:
+            return dict(page=page, status_code=200, json=None, msg='the page was not valid JSON')
+
+    ## the first page tells us how many pages there are
+    first = lookup(0)
+    result['status_code'] = first['status_code']
+    if first['json'] is None:
+        catalog.close()
+        module.fail_json(msg=f"The NASA API lookup was not successful. STATUS CODE - {first['status_code']} {first['msg']}", **result)
+
+    pages = first['json'].get('page', {}).get('total_pages', 1)
+    done = catalog.done_pages()
+    changed = catalog.add_page(0, first['json'].get('near_earth_objects', []))
+    todo = [p for p in range(1, pages) if p not in done]
+
+    ## fetch the rest in batches, so a batch is written (and recorded) before the
+    ## next starts, and memory does not grow with the size of the catalog
+    failed = []
+    batch = max(1, module.params['workers']) * 4
+    for i in range(0, len(todo), batch):
+        for page in bounded_map(lookup, todo[i:i + batch], module.params['workers']):
+            if page['json'] is None:
+                failed.append(page)
+                continue
+            changed += catalog.add_page(page['page'], page['json'].get('near_earth_objects', []))
+
+    catalog.set_meta('total_pages', pages)
+    catalog.db.commit()
+    if not failed:
+        # the checkpoint only lasts until a run completes, the next mirror fetches every page again
+        catalog.reset_pages()
+    result['catalog'] = dict(
+        path=module.params['catalog'],
+        objects=catalog.count(),
+        pages=pages,
+        pages_fetched=1 + len(todo) - len(failed),
+        changed=changed
+    )
+    catalog.close()
+    result['changed'] = changed > 0
+
+    if failed:
+        missing = ", ".join(f"{p['page']} ({p['msg'] or p['status_code']})" for p in failed[:20])
+        module.fail_json(msg=f"{len(failed)} catalog pages could not be looked up, rerun to resume. Pages: {missing}", **result)
+    module.exit_json(**result)
+
+def run_lookup(module, result):
+    """search the local catalog database, no network involved"""
+    if not os.path.isfile(module.params['catalog']):
+        module.fail_json(msg=f"The catalog {module.params['catalog']} does not exist, run with mode mirror first", **result)
+    catalog = NeoCatalog(module.params['catalog'])
+    result['neos'] = catalog.lookup(
+        neo_id=module.params['neo_id'],
+        name=module.params['name'],
+        hazardous=module.params['hazardous'],
+        orbit_class=module.params['orbit_class'],
+        limit=module.params['limit'])
+    catalog.close()
+    module.exit_json(**result)
+
 def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
-        startdate=dict(type='str', required=True),
-        enddate=dict(type='str', required=True),
+        mode=dict(type='str', required=False, default="feed", choices=["feed", "mirror", "lookup"]),
+        startdate=dict(type='str', required=False),
+        enddate=dict(type='str', required=False),
         apikey=dict(type='str', required=False, default="DEMO_KEY"),
-        savepath=dict(type='str', required=False, default=os.getcwd())
+        savepath=dict(type='str', required=False, default=os.getcwd()),
+        workers=dict(type='int', required=False, default=4),
+        rate_limit=dict(type='float', required=False, default=2.0),
+        checkpoint=dict(type='str', required=False),
+        summary=dict(type='bool', required=False, default=False),
+        top_k=dict(type='int', required=False, default=5),
+        return_feed=dict(type='bool', required=False, default=True),
+        catalog=dict(type='str', required=False),
+        refresh=dict(type='bool', required=False, default=False),
+        neo_id=dict(type='str', required=False),
+        name=dict(type='str', required=False),
+        hazardous=dict(type='bool', required=False),
+        orbit_class=dict(type='str', required=False),
+        limit=dict(type='int', required=False, default=100)
     )
 
     # seed the result dict in the object
@@ -128,7 +369,8 @@ def run_module():
         file_loc='',
         yaml_output_file='',
         start_date='',
-        end_date=''
+        end_date='',
+        windows=[]
     )
 
     # the AnsibleModule object will be our abstraction working with Ansible
@@ -137,7 +379,11 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        required_if=[
+            ('mode', 'feed', ('startdate', 'enddate')),
+            ('mode', 'mirror', ('catalog',)),
+            ('mode', 'lookup', ('catalog',)),],
     )
 
     # if the user is working with this module in only check mode we do not
@@ -146,6 +392,12 @@ def run_module():
     if module.check_mode:
         module.exit_json(**result)
 
+    # the browse catalog is mirrored into (and searched in) a local database
+    if module.params['mode'] == 'mirror':
+        run_mirror(module, result)
+    elif module.params['mode'] == 'lookup':
+        run_lookup(module, result)
+
     # manipulate or modify the state as needed (this is going to be the
     # part where your module will do what it needs to do)
     
@@ -157,17 +409,56 @@ def run_module():
     ak = module.params['apikey']
     sp = module.params['savepath']
 
-    lookMeUp = f"{NASANEOW}start_date={sd}&end_date={ed}&api_key={ak}"
-
-    ## Send an HTTP GET - API call to nasa based on compelted URI+queryparams
-    resp = requests.get(lookMeUp)
-
-    ## if the response was NOT a 200, ansible module should FAIL
-    if resp.status_code != 200:
-        module.fail_json(msg=f"The NASA API lookup was not successful. STATUS CODE - {resp.status_code}", **result)
-
-    ## strip JSON off HTTP 200 response
-    nasaJson = resp.json()
+    ## the feed only answers 7 days at a time, so split the range into windows
+    try:
+        windows = split_windows(sd, ed, WINDOW_DAYS)
+    except ValueError as err:
+        module.fail_json(msg=f"startdate and enddate must be YYYY-MM-DD. {err}", **result)
+
+    ## windows recorded by an earlier (interrupted) run are not looked up again
+    cpath = module.params['checkpoint']
+    done = read_checkpoint(cpath)
+    cplock = threading.Lock()
+    limiter = RateLimiter(module.params['rate_limit'])
+
+    def lookup(window):
+        if window in done:
+            return dict(window=window, source='checkpoint', status_code=200, json=done[window])
+        lookMeUp = f"{NASANEOW}start_date={window[0]}&end_date={window[1]}&api_key={ak}"
+        ## Send an HTTP GET - API call to nasa based on compelted URI+queryparams
+        try:
+            resp = limited_get(lookMeUp, limiter)
+        except requests.exceptions.RequestException as err:
+            return dict(window=window, source='api', status_code=0, json=None, msg=str(err))
+        if resp.status_code != 200:
+            return dict(window=window, source='api', status_code=resp.status_code, json=None)
+        ## strip JSON off HTTP 200 response, a gateway error page is not JSON
+        try:
+            nasaJson = resp.json()
+        except ValueError:
+            return dict(window=window, source='api', status_code=200, json=None, msg='the window was not valid JSON')
+        ## record the finished window before moving on
+        if cpath:
+            with cplock:
+                with open(cpath, "a") as cp:
+                    cp.write(json.dumps(dict(start=window[0], end=window[1], json=nasaJson)) + "\n")
+        return dict(window=window, source='api', status_code=200, json=nasaJson)
+
+    lookups = bounded_map(lookup, windows, module.params['workers'])
+    result['windows'] = [dict(start=l['window'][0], end=l['window'][1], source=l['source']) for l in lookups]
+
+    ## if any response was NOT a 200, ansible module should FAIL
+    failed = [l for l in lookups if l['json'] is None]
+    if failed:
+        result['status_code'] = failed[0]['status_code']
+        missing = ", ".join(f"{l['window'][0]}to{l['window'][1]} ({l.get('msg') or l['status_code']})" for l in failed)
+        module.fail_json(msg=f"The NASA API lookup was not successful. STATUS CODE - {failed[0]['status_code']}. Windows not looked up: {missing}", **result)
+
+    ## a single window is returned exactly as NASA sent it
+    if len(lookups) == 1:
+        nasaJson = lookups[0]['json']
+    else:
+        nasaJson = merge_windows(l['json'] for l in lookups)
 
     ## convvert JSON to YAML
     nasaYaml = yaml.dump(nasaJson)
@@ -180,9 +471,16 @@ def run_module():
             myfile.write(nasaYaml)
         result['changed'] = True
 
+    ## every window is in the file now, the checkpoint only lasts until a run completes
+    if cpath and os.path.isfile(cpath):
+        os.unlink(cpath)
+
     # set results that will be returned via JSON to the ansible module
-    result['original_nasa_json'] = nasaJson # the JSON gathered from NASA
-    result['status_code'] = resp.status_code # the HTTP response code
+    if module.params['summary']:
+        result['summary'] = summarize_feed(nasaJson, top_k=module.params['top_k']) # close approach analytics
+    if module.params['return_feed']:
+        result['original_nasa_json'] = nasaJson # the JSON gathered from NASA
+    result['status_code'] = 200 # the HTTP response code (every window was a 200)
     result['file_loc'] = sp # the path to the save filed
     result['yaml_output_file'] = f"neow-{sd}to{ed}.yml" # name of the YAML output file created
     result['start_date'] = sd # the start search date
@@ -27,6 +27,94 @@ options:
         description: This is the number of the satellite you wish to look up. Mutually exclusive with sat_name. Must choose to search by sat_name or sat_number.
         required: false
         type: int
+    catalog:
+        description: A local SQLite mirror of the whole TLE collection, created when it does not exist. Needed by mirror and query_catalog.
+        required: false
+        type: str
+    mirror:
+        description: Page through the whole TLE collection (workers pages at a time) into catalog. Only the satellites that are new, renamed, or whose epoch changed are written. Default is false.
+        required: false
+        type: bool
+    query_catalog:
+        description: Answer sat_num or sat_name from catalog instead of the API. Every word of sat_name must start a word of the satellite name, so zarya finds ISS (ZARYA) and STARLINK-1 finds every STARLINK-1xxx. Default is false.
+        required: false
+        type: bool
+    limit:
+        description: With query_catalog, the most satellites returned. 0 returns every match. Default is 100.
+        required: false
+        type: int
+    page_size:
+        description: With mirror, how many TLEs are asked for per page (at most 100). Default is 100.
+        required: false
+        type: int
+    workers:
+        description: With mirror, how many pages are looked up at the same time (at most 16). Default is 4.
+        required: false
+        type: int
+    rate_limit:
+        description: With mirror, the most pages looked up per second, across every worker. 0 turns the limit off. Default is 2.0.
+        required: false
+        type: float
+    propagate:
+        description: Propagate every TLE returned (by the API or query_catalog) with SGP4 from start, every step minutes, for duration minutes. All satellites and times are computed at once with numpy arrays. Deep-space orbits (a period of 225 minutes or more) are not supported and come back with an error. Requires numpy. Skipped in check mode. Default is false.
+        required: false
+        type: bool
+    start:
+        description: With propagate, screen or observers, the first time (ISO 8601, UTC when no offset is given) or now. Default is now.
+        required: false
+        type: str
+    duration:
+        description: With propagate, screen or observers, how many minutes after start are propagated. Default is 90.
+        required: false
+        type: float
+    step:
+        description: With propagate, screen or observers, the minutes between two times. Default is 1.
+        required: false
+        type: float
+    propagation_file:
+        description: With propagate, write the positions and velocities to this compressed numpy file (.npz, float32 arrays of satellites x times x 3) instead of returning them. It also holds satellite_ids, names, times (POSIX seconds) and errors.
+        required: false
+        type: str
+    screen:
+        description: Screen every TLE returned (by the API or query_catalog) for close approaches under threshold between start and start + duration minutes. Satellites whose orbital shells (perigee to apogee) can not meet are never compared, the rest are binned into cubes at every step so only neighbours are compared, and every pair that may come close is refined to its time of closest approach. The steps are split over processes. The screening step is at most 1/20 of the shortest orbital period screened (about 4.5 minutes in low Earth orbit), a coarser step is screened on that finer grid instead, as it would merge or miss encounters. Below that a smaller step screens fewer pairs per step and a larger one propagates fewer times. Requires numpy. Skipped in check mode. Default is false.
+        required: false
+        type: bool
+    threshold:
+        description: With screen, the miss distance (km) under which a close approach is reported. Default is 5.
+        required: false
+        type: float
+    processes:
+        description: With screen or observers, how many processes share the work. Defaults to the number of CPUs.
+        required: false
+        type: int
+    top:
+        description: With screen, the most conjunctions returned, closest first. 0 returns every one. Default is 100.
+        required: false
+        type: int
+    observers:
+        description: Predict the passes of every TLE returned (by the API or query_catalog) over each of these ground stations between start and start + duration minutes, with their rise, culmination and set. Every satellite is propagated once, its elevation above every observer at every step is computed in one batch, and the rise, culmination and set of every pass are then refined to the second. Large observers x satellites x times batches are split over processes. A pass shorter than a step that barely clears min_elevation can be missed. Requires numpy. Skipped in check mode.
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            name:
+                description: What the observer is returned as. Defaults to its position in the list (0 for the first one).
+                type: str
+            latitude:
+                description: Geodetic latitude (degrees, north is positive).
+                required: true
+                type: float
+            longitude:
+                description: Longitude (degrees, east is positive).
+                required: true
+                type: float
+            altitude:
+                description: Height above the WGS-84 ellipsoid (metres). Default is 0.
+                type: float
+    min_elevation:
+        description: With observers, the elevation (degrees) a satellite rises above and sets below, the antenna mask of the ground stations. Default is 0, the horizon.
+        required: false
+        type: float
 # Specify this value according to your collection
 # in format of namespace.collection.doc_fragment_name
 extends_documentation_fragment:
@@ -53,6 +141,62 @@ EXAMPLES = r'''
   rzfeeser.nasa.nasa_tle:
        name: 44859
   register: results
+
+# Mirror the whole collection locally, 8 pages at a time
+- name: mirror the TLE catalog
+  rzfeeser.nasa.nasa_tle:
+       catalog: /var/lib/tle/catalog.db
+       mirror: true
+       workers: 8
+
+# Search the local mirror by name, without the API
+- name: every STARLINK satellite in the mirror
+  rzfeeser.nasa.nasa_tle:
+       catalog: /var/lib/tle/catalog.db
+       query_catalog: true
+       sat_name: starlink
+       limit: 0
+  register: results
+
+# Positions and velocities of the whole mirror, every minute for a day
+- name: propagate the catalog
+  rzfeeser.nasa.nasa_tle:
+       catalog: /var/lib/tle/catalog.db
+       query_catalog: true
+       limit: 0
+       propagate: true
+       start: 2023-04-10T00:00:00Z
+       duration: 1440
+       step: 1
+       propagation_file: /var/lib/tle/positions.npz
+
+# Every close approach under 2 km in the next 24 hours, across the whole mirror
+- name: screen the catalog for conjunctions
+  rzfeeser.nasa.nasa_tle:
+       catalog: /var/lib/tle/catalog.db
+       query_catalog: true
+       limit: 0
+       screen: true
+       threshold: 2
+       duration: 1440
+       processes: 8
+  register: conjunctions
+
+# Every ISS pass over two ground stations in the next 24 hours, above 10 degrees
+- name: predict ground station passes
+  rzfeeser.nasa.nasa_tle:
+       sat_num: 25544
+       duration: 1440
+       min_elevation: 10
+       observers:
+           - name: svalbard
+             latitude: 78.23
+             longitude: 15.41
+             altitude: 500
+           - name: wallops
+             latitude: 37.94
+             longitude: -75.46
+  register: passes
 '''
 
 RETURN = r'''
@@ -71,17 +215,282 @@ status:
     type: int
     returned: always
     sample: 200
+mirror:
+    description: With mirror, how many pages were looked up and failed, how many satellites were added, updated (renamed or a new epoch) or unchanged, and how many the catalog holds.
+    type: dict
+    returned: when mirror is true
+    sample: {"pages": 120, "failed": 0, "added": 12, "updated": 8410, "unchanged": 3520, "satellites": 11942}
+propagation:
+    description: With propagate, the times (ISO 8601 UTC), every satellite (satelliteId, name, and the error that stopped it, if any) and, without propagation_file, the TEME positions (km) and velocities (km/s) per satellite per time (null where it could not be propagated). With propagation_file, the file written instead of the arrays. seconds is how long the propagation took.
+    type: dict
+    returned: when propagate is true
+    sample: {"times": ["2023-04-10T00:00:00+00:00"], "satellites": [{"satelliteId": 25544, "name": "ISS (ZARYA)", "error": ""}], "positions": [[[-4132.512, 2931.771, 4321.049]]], "velocities": [[[-3.921417, -6.524885, 0.679354]]], "seconds": 0.002}
+conjunctions:
+    description: With screen, the close approaches under threshold, closest first, each with both satellites, the time of closest approach (ISO 8601 UTC), the miss distance (km) and the relative speed (km/s). A pair that meets more than once is listed once per encounter.
+    type: list
+    returned: when screen is true
+    sample: [{"satellite_1": 48274, "name_1": "CSS (TIANHE)", "satellite_2": 49863, "name_2": "FENGYUN 1C DEB", "tca": "2023-04-10T13:02:41.512000+00:00", "miss_km": 0.874, "relative_speed_kps": 11.42}]
+screening:
+    description: With screen, how many satellites were given and how many were screened (near-Earth, with a shell that overlaps another one), the steps screened (more than the window has when step was capped), the candidate pair steps and encounters refined, how many conjunctions were found, the processes used and how long it took.
+    type: dict
+    returned: when screen is true
+    sample: {"satellites": 11942, "screened": 9310, "steps": 1441, "candidates": 5120, "encounters": 4987, "conjunctions": 37, "processes": 8, "seconds": 41.2}
+passes:
+    description: With observers, every pass, ordered by rise, with the observer, the satellite, its rise, culmination and set (ISO 8601 UTC, null when the pass was already under way when the window opened or still is when it closes), the highest elevation (degrees), the azimuth (degrees from north) it rises and sets at and how long it lasts (seconds, null without both rise and set).
+    type: list
+    returned: when observers are given
+    sample: [{"observer": "wallops", "satelliteId": 25544, "name": "ISS (ZARYA)", "rise": "2023-04-10T01:12:08.311000+00:00", "culmination": "2023-04-10T01:17:31.905000+00:00", "set": "2023-04-10T01:22:55.642000+00:00", "max_elevation": 47.81, "rise_azimuth": 224.15, "set_azimuth": 47.93, "duration": 647.331}]
+pass_prediction:
+    description: With observers, how many observers and satellites were given, how many satellites were predicted (near-Earth ones), the steps, how many passes were found, the processes used and how long it took.
+    type: dict
+    returned: when observers are given
+    sample: {"observers": 2, "satellites": 1, "predicted": 1, "steps": 1441, "passes": 9, "processes": 8, "seconds": 0.041}
 '''
 
+import math
+import os
+import time
+
+from datetime import datetime, timezone
+
 import requests
 
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_conjunction import screen
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_dates import parse_time
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_passes import predict
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_sgp4 import (
+    ERRORS, HAS_NUMPY, ElementSets, rows, save_arrays, time_grid)
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_tle import TleCatalog
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_workers import RateLimiter, bounded_imap, default_processes, limited_get
+
+NASATLE = "https://tle.ivanstanojevic.me/api/tle/"
+
+# the TLE service will not respond unless you make it think you are a browser,
+# say who we are next to it
+USER_AGENT = 'Mozilla/5.0 (compatible; rzfeeser.nasa_api nasa_tle)'
+
+
+def run_query(module, result):
+    """answer sat_num or sat_name from the local catalog, then exit"""
+    if not os.path.exists(module.params['catalog']):
+        module.fail_json(msg=f"no catalog at {module.params['catalog']}, mirror it first", **result)
+    catalog = TleCatalog(module.params['catalog'])
+    members = catalog.lookup(module.params['sat_num'], module.params['sat_name'], module.params['limit'])
+    catalog.close()
+    result['json'] = dict(totalItems=len(members), member=members)
+    analyze(module, result)
+    module.exit_json(**result)
+
+
+def analyze(module, result):
+    """propagate, screen and / or predict the passes of the TLEs in result['json'], when asked to
+
+    none of it runs in check mode (it can take minutes), a propagation_file
+    would be written so the result says changed
+    """
+    if module.check_mode:
+        result['changed'] = bool(module.params['propagate'] and module.params['propagation_file'])
+        return
+    if module.params['propagate']:
+        propagate(module, result)
+    if module.params['screen']:
+        screen_conjunctions(module, result)
+    if module.params['observers']:
+        predict_passes(module, result)
+
+
+def members_of(found):
+    """the TLEs of an API answer, a search lists them in member, a lookup by number is one TLE"""
+    if 'member' in found:
+        return [m for m in found.get('member') or [] if m.get('line1')]
+    return [found] if found.get('line1') else []
+
+
+def window(module, result):
+    """the times (POSIX timestamps) from start, every step minutes, for duration minutes"""
+    try:
+        start = parse_time(module.params['start'])
+    except ValueError as err:
+        module.fail_json(msg=f"start is not an ISO 8601 time: {err}", **result)
+    if module.params['step'] <= 0 or module.params['duration'] < 0:
+        module.fail_json(msg="step must be above 0 and duration 0 or more", **result)
+    return time_grid(start, module.params['duration'], module.params['step'])
+
+
+def propagate_members(module, result, members):
+    """the element sets of members and their time grid, propagated
+
+    returns (times, positions, velocities, errors, seconds)
+    """
+    times = window(module, result)
+    began = time.time()
+    sets = ElementSets([(m.get('line1'), m.get('line2')) for m in members])
+    positions, velocities, errors = sets.propagate(times)
+    return times, positions, velocities, errors, round(time.time() - began, 3)
+
+
+def propagate(module, result):
+    """propagate every TLE in result['json'], the arrays are returned or written to propagation_file"""
+    members = members_of(result['json'])
+    times, positions, velocities, errors, seconds = propagate_members(module, result, members)
+    satellites = []
+    for n, member in enumerate(members):
+        # the first error a satellite ran into, its other times may still be fine
+        codes = errors[n][errors[n] != 0]
+        satellites.append(dict(satelliteId=member.get('satelliteId'), name=member.get('name'),
+                               error=ERRORS.get(int(codes[0]), str(codes[0])) if codes.size else ''))
+    result['propagation'] = dict(
+        times=[datetime.fromtimestamp(t, timezone.utc).isoformat() for t in times],
+        satellites=satellites,
+        seconds=seconds,
+    )
+    path = module.params['propagation_file']
+    if path:
+        save_arrays(path, satellite_ids=[m.get('satelliteId') or 0 for m in members], names=[m.get('name') or '' for m in members],
+                    times=times, positions=positions.astype('float32'), velocities=velocities.astype('float32'), errors=errors)
+        result['propagation']['file'] = path
+        result['changed'] = True
+        return
+    result['propagation']['positions'] = rows(positions, errors, 3)
+    result['propagation']['velocities'] = rows(velocities, errors, 6)
+
+
+def screen_conjunctions(module, result):
+    """screen every TLE in result['json'] for close approaches under threshold within the window"""
+    members = members_of(result['json'])
+    times = window(module, result)
+    if module.params['threshold'] <= 0:
+        module.fail_json(msg="threshold must be above 0", **result)
+    processes = module.params['processes'] or default_processes()
+    began = time.time()
+    found, stats = screen([(m.get('line1'), m.get('line2')) for m in members], times, module.params['threshold'], processes)
+    top = module.params['top']
+    conjunctions = []
+    for c in found[:top] if top else found:
+        first, second = members[c['i']], members[c['j']]
+        conjunctions.append(dict(
+            satellite_1=first.get('satelliteId'), name_1=first.get('name'),
+            satellite_2=second.get('satelliteId'), name_2=second.get('name'),
+            tca=datetime.fromtimestamp(c['tca'], timezone.utc).isoformat(),
+            miss_km=round(c['miss_km'], 3), relative_speed_kps=round(c['relative_speed_kps'], 3),
+        ))
+    result['conjunctions'] = conjunctions
+    result['screening'] = dict(stats, conjunctions=len(found), processes=processes, seconds=round(time.time() - began, 3))
+
+
+def predict_passes(module, result):
+    """predict the passes of every TLE in result['json'] over every observer within the window"""
+    members = members_of(result['json'])
+    times = window(module, result)
+    observers = module.params['observers']
+    for observer in observers:
+        if not -90 <= observer['latitude'] <= 90:
+            module.fail_json(msg=f"latitude must be between -90 and 90, not {observer['latitude']}", **result)
+    processes = module.params['processes'] or default_processes()
+    began = time.time()
+    found, stats = predict([(m.get('line1'), m.get('line2')) for m in members], times,
+                           [(o['latitude'], o['longitude'], (o['altitude'] or 0) / 1000.0) for o in observers],
+                           module.params['min_elevation'], processes)
+
+    def iso(value):
+        return None if value is None else datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+    def degrees(value):
+        return None if value is None else round(value, 2)
+
+    passes = []
+    for p in found:
+        observer = observers[p['observer']]
+        member = members[p['satellite']]
+        passes.append(dict(
+            observer=observer['name'] if observer['name'] is not None else p['observer'],
+            satelliteId=member.get('satelliteId'), name=member.get('name'),
+            rise=iso(p['rise']), culmination=iso(p['culmination']), set=iso(p['set']),
+            max_elevation=round(p['max_elevation'], 2),
+            rise_azimuth=degrees(p['rise_azimuth']), set_azimuth=degrees(p['set_azimuth']),
+            duration=round(p['set'] - p['rise'], 3) if p['rise'] is not None and p['set'] is not None else None,
+        ))
+    result['passes'] = passes
+    result['pass_prediction'] = dict(stats, processes=processes, seconds=round(time.time() - began, 3))
+
+
+def mirror_catalog(module, result):
+    """page the whole TLE collection into the catalog, returns True when a satellite was added or updated"""
+    page_size = max(1, min(module.params['page_size'], 100))
+    limiter = RateLimiter(module.params['rate_limit'])
+
+    def lookup(page):
+        url = f"{NASATLE}?page={page}&page-size={page_size}"
+        try:
+            resp = limited_get(url, limiter, headers={'User-Agent': USER_AGENT}, timeout=60)
+        except requests.exceptions.RequestException as err:
+            return page, 0, None, str(err)
+        if resp.status_code != 200:
+            return page, resp.status_code, None, ''
+        try:
+            return page, resp.status_code, resp.json(), ''
+        except ValueError:
+            return page, resp.status_code, None, 'the page was not valid JSON'
+
+    # the first page says how many pages there are
+    page, status, first, msg = lookup(1)
+    result['status'] = status
+    if first is None:
+        module.fail_json(msg=f"The first page of the TLE collection could not be looked up, the status code was {status} {msg}", **result)
+    pages = max(1, int(math.ceil(int(first.get('totalItems') or 0) / float(page_size))))
+
+    catalog = TleCatalog(module.params['catalog'])
+    counts = catalog.merge(first.get('member') or [])
+    failed = []
+    # pages are merged as they arrive, this thread is the only one touching the catalog
+    for page, status, body, msg in bounded_imap(lookup, range(2, pages + 1), module.params['workers']):
+        if body is None:
+            failed.append(dict(page=page, status_code=status, msg=msg))
+            continue
+        for key, value in catalog.merge(body.get('member') or []).items():
+            counts[key] += value
+    if not failed:
+        catalog.set_meta('last_mirror', datetime.now(timezone.utc).isoformat())
+    result['mirror'] = dict(pages=pages, failed=len(failed), satellites=catalog.count(), **counts)
+    catalog.close()
+    changed = counts['added'] + counts['updated'] > 0
+    if failed:
+        failed.sort(key=lambda f: f['page'])
+        result['changed'] = changed
+        module.fail_json(msg=f"{len(failed)} of {pages} pages could not be looked up, the first was {failed[0]}. Rerun to fill them in", **result)
+    return changed
+
 
 def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         sat_name=dict(type='str', required=False),
-        sat_num=dict(type='int', required=False)
+        sat_num=dict(type='int', required=False),
+        catalog=dict(type='str', required=False),
+        mirror=dict(type='bool', required=False, default=False),
+        query_catalog=dict(type='bool', required=False, default=False),
+        limit=dict(type='int', required=False, default=100),
+        page_size=dict(type='int', required=False, default=100),
+        workers=dict(type='int', required=False, default=4),
+        rate_limit=dict(type='float', required=False, default=2.0),
+        propagate=dict(type='bool', required=False, default=False),
+        start=dict(type='str', required=False, default='now'),
+        duration=dict(type='float', required=False, default=90.0),
+        step=dict(type='float', required=False, default=1.0),
+        propagation_file=dict(type='str', required=False),
+        screen=dict(type='bool', required=False, default=False),
+        threshold=dict(type='float', required=False, default=5.0),
+        processes=dict(type='int', required=False),
+        top=dict(type='int', required=False, default=100),
+        observers=dict(type='list', elements='dict', required=False, options=dict(
+            name=dict(type='str', required=False),
+            latitude=dict(type='float', required=True),
+            longitude=dict(type='float', required=True),
+            altitude=dict(type='float', required=False, default=0.0),
+        )),
+        min_elevation=dict(type='float', required=False, default=0.0),
     )
 
     # seed the result dict in the object
@@ -104,10 +513,19 @@ def run_module():
         argument_spec=module_args,
         supports_check_mode=True,
         mutually_exclusive=[
-            ('sat_name', 'sat_num'),],
+            ('sat_name', 'sat_num'), ('mirror', 'query_catalog'), ('mirror', 'propagate'), ('mirror', 'screen'),
+            ('mirror', 'observers')],
+        required_if=[('mirror', True, ('catalog',)), ('query_catalog', True, ('catalog',))],
         )
 
-    api = "https://tle.ivanstanojevic.me/api/tle/"
+    if (module.params['propagate'] or module.params['screen'] or module.params['observers']) and not HAS_NUMPY:
+        module.fail_json(msg=missing_required_lib('numpy'), **result)
+
+    # a query is answered from the local catalog, no API lookup and no state change
+    if module.params['query_catalog']:
+        run_query(module, result)
+
+    api = NASATLE
 
     if module.params['sat_name']:   # if the user passed in sat_name
         api = f"{api}?search={module.params['sat_name']}"
@@ -118,15 +536,20 @@ def run_module():
 
     # if the user is working with this module in only check mode we do not
     # want to make any changes to the environment, just return the current
-    # state with no modifications
+    # state with no modifications (analyze only says whether a
+    # propagation_file would be written, as it does for query_catalog)
     if module.check_mode:
+        analyze(module, result)
+        module.exit_json(**result)
+
+    if module.params['mirror']:
+        result['changed'] = mirror_catalog(module, result)
         module.exit_json(**result)
 
     #s = requests.Session()
     #r = s.get(api)
 
-    # the TLE service will not respond unless you make it think you are a browser
-    r = requests.get(api, allow_redirects=True, headers={'User-Agent': 'Mozilla/5.0'}) # send an HTTP get to our API
+    r = requests.get(api, allow_redirects=True, headers={'User-Agent': USER_AGENT}) # send an HTTP get to our API
 
     # set the results with the returned status code
     result['status'] = r.status_code
@@ -138,6 +561,8 @@ def run_module():
     # part where your module will do what it needs to do)
 
     result['json'] = r.json() # strip JSON off the 200 that was returned
+
+    analyze(module, result)
     
 
     # our code does NOT produce a state change
@@ -0,0 +1,61 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import pytest
+
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_download import DownloadError, download
+from ansible_collections.rzfeeser.nasa_api.plugins.module_utils.nasa_imagestore import save_image
+
+
+class FakeResponse:
+    """just enough of requests.Response to stream one body"""
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.headers = {'Content-Length': str(len(body))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def close(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        yield self.body
+
+
+class FakeSession:
+
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, url, **kwargs):
+        return FakeResponse(self.body)
+
+
+def test_download_bad_url_is_a_download_error(tmp_path):
+    with pytest.raises(DownloadError):
+        download('www.example.com/a.jpg', str(tmp_path / 'a.jpg'))
+
+
+def test_download_unwritable_part_is_a_download_error(tmp_path):
+    dest = tmp_path / 'missing' / 'a.jpg'
+    with pytest.raises(DownloadError):
+        download('https://www.example.com/a.jpg', str(dest), session=FakeSession(b'image'))
+
+
+def test_download_writes_dest(tmp_path):
+    dest = tmp_path / 'a.jpg'
+    stats = download('https://www.example.com/a.jpg', str(dest), session=FakeSession(b'image'))
+    assert dest.read_bytes() == b'image'
+    assert stats['bytes'] == 5
+
+
+def test_save_image_bad_url_is_failed(tmp_path):
+    item = save_image('www.example.com/a.jpg', str(tmp_path / 'a.jpg'))
+    assert item['status'] == 'failed'
+    assert item['msg']